@@ -1,6 +1,7 @@
 
 import time
 import os
+import copy
 import shutil
 import re
 import random
@@ -28,8 +29,7 @@ from tools import remove_invalid_char
 
 from fetcher import Fetcher
 from page import Page
-# from werkzeug.contrib.atom import AtomFeed
-from feedgen.feed import FeedGenerator
+from feed import feed_builder
 
 from colorlog import ColoredFormatter
 import logging
@@ -133,7 +133,7 @@ class Collector:
     os.mkdir(path)
     tools.yaml_save(config, path + '/.config.yaml')
     if config.get('project_option', {}).get('version_control') == 'git':
-      ignore = "# project\n.ipynb_checkpoints\n__pycache__/\n*.py[cod]\ntodo.txt\n**/feed.xml"
+      ignore = "# project\n.ipynb_checkpoints\n__pycache__/\n*.py[cod]\ntodo.txt\n**/feed.xml\n**/*.yaml.pickle"
       tools.text_save(os.path.join(path, '.gitignore'), ignore)
       cmd = f'cd "{path}" && git init'
       tools.run_command(cmd)
@@ -293,53 +293,18 @@ class Collector:
 
 
   def to_rss_feed(self, folder, limit=150, order='edit_date', site=''):
-    ''' 生成 RSS, 内容为全部 pages, 
-        按照添加任务的顺序倒序排列 (按照更新时间排列? TODO)
-        RSS Feed 文件名为 path, alias? TODO
-        limit=-1 时迭代所有Page
+    ''' 生成 RSS, 内容为最新的 limit 个 pages
+        limit=-1 时包含所有Page
         order=edit_date|create_date|title
+        由 feed.FeedBuilder 增量生成, 只渲染有变化的页面, 窗口内页面都未变化时复用上次的 feed.xml
         TODO: 指定输出 xml 文件位置
         TODO: rss 订阅源的设置 site link, 等
     '''
     watcher_path = self.find_watcher_path(folder)
     if not watcher_path: 
-      log(f'WARN: generate_feed path {watcher_path} not found')
+      log.warning(f'generate_feed path {folder} not found')
       return None
-    feed_name = os.path.basename(watcher_path)
-    pages = []
-    for path in tools.all_files(watcher_path, patterns='*.md'):
-      if limit == 0: break
-      limit -= 1
-      try:
-        page = Page.load(path)
-        pages.append(page)
-      except:
-        log(f'error Page.load({path})')
-        raise
-
-    fg = FeedGenerator()
-    fg.id(site + feed_name)
-    fg.title(feed_name)
-    # <link>https://xxx.com/thread.php?fid=1</link>
-    # fg.link(href=site + feed_name, rel='alternate')
-    # fg.logo('http://ex.com/logo.jpg')
-    fg.subtitle('generated by The North Remembers')
-    # <atom:link href="http://rsshub.app/xxx" rel="self" type="application/rss+xml"/>
-    fg.link(href=site + feed_name + '/feed', rel='self')  # 订阅源网站
-    fg.language('zh-cn')
-    for page in sorted(pages, key=lambda page: page.edit_date):  # 这里不需要 reverse=True
-      # log(f'prepare feed entry {page}')
-      fe = fg.add_entry()
-      fe.id(page.metadata['url'])
-      fe.title(tools.clean_xml(page.metadata['title']))
-      fe.link(href=page.metadata['url'])
-      fe.published(page.edit_date+'+08:00')  
-      # fe.updated(page.edit_date+'+08:00')  # 在这种 RSS 似乎不起作用
-      fe.description(tools.clean_xml(page.to_html()))
-    feed_path = os.path.join(watcher_path, 'feed.xml')
-    fg.rss_file(feed_path, pretty=True)
-    # log(f'generate_feed `{feed_path}` done')
-    return feed_path
+    return feed_builder(watcher_path).build(limit=limit, order=order, site=site)
 
   def to_epub(self, path):
     pass
@@ -380,7 +345,24 @@ RSS Feed
 folder 是 rss feed 的基本单位, 
 如果需要过滤 folder 内的条目, 或者聚合多个 folder, 先用别的 feed 工具
 
-
+抓取页面的 route (/url/..., /api/zhihu/..., 单页面) 交给后台 JobQueue 执行,
+最多等待 ?wait= 秒 (默认 JOB_WAIT_SECONDS, 不超过 JOB_WAIT_MAX), 完成则直接返回结果,
+否则返回 202 和 job_id, 由 /api/jobs/<job_id> 轮询, 慢的抓取不会占住其他请求
+同一 url 的并发请求共用一次抓取, 抓取到的原始数据在 result_cache 中缓存 RESULT_CACHE_TTL 秒,
+html / markdown / json 各 route 共用同一份原始数据, 生成的 html markdown 也一起缓存,
+响应头 X-Cache 为 HIT (缓存) / MISS (新抓取) / COALESCED (合并到进行中的抓取),
+?refresh=1 忽略缓存重新抓取
+
+列表类 route (/author/<id>, /api/zhihu/zhuanlan/<id>) 在 ?format=ndjson
+或 Accept: application/x-ndjson 时以 NDJSON 流式返回, 每取到一条即发送一行
+
+部署
+  开发      python collector.py
+  WSGI      gunicorn -w 4 --threads 8 'collector:create_app()'
+  ASGI      uvicorn --interface wsgi --factory collector:create_app
+  项目路径由环境变量 COLLECTOR_PROJECT 指定, 后台抓取线程数为 COLLECTOR_JOB_WORKERS
+  job 状态写入 jobs.JOB_ROOT, 多个 worker 进程之间也能轮询
+  压测见 load_test.py
 
 '''
 
@@ -392,39 +374,126 @@ from flask import render_template
 from flask import Response
 from flask import make_response
 from flask import abort
-from flask import after_this_request
+from flask import send_file
 from flask import send_from_directory     
+from flask import url_for
+from flask import stream_with_context
+import json
+
+from jobs import JobQueue
+from jobs import ResultCache
 
 app = Flask(__name__)
 
+col = None             # Collector, 由 create_app 创建
+job_queue = None
+JOB_WORKERS = 4
+JOB_WAIT_SECONDS = 10  # 抓取 route 同步等待的时间, 超时后返回 job_id 供轮询
+JOB_WAIT_MAX = 60      # ?wait= 的上限, 避免请求长时间占住 worker
+LISTER_LIMIT_MAX = 300  # 列表类 route ?limit= 的上限
+FEED_LIMIT_MAX = 500    # feed ?limit= 的上限, 超过的页面需要另外生成
+RESULT_CACHE_SIZE = 256
+RESULT_CACHE_TTL = 600
+result_cache = ResultCache(max_items=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL)
+
+
+def create_app(project_path=None, job_workers=None):
+  ''' WSGI 入口, 参数缺省时读取环境变量 COLLECTOR_PROJECT COLLECTOR_JOB_WORKERS '''
+  global col, job_queue
+  project_path = project_path or os.environ.get('COLLECTOR_PROJECT')
+  if project_path:
+    col = Collector(project_path=project_path)
+  job_workers = job_workers or int(os.environ.get('COLLECTOR_JOB_WORKERS', JOB_WORKERS))
+  if job_queue:
+    job_queue.shutdown(wait=False)
+  job_queue = JobQueue(workers=job_workers)
+  return app
+
+
+def get_job_queue():
+  global job_queue
+  if job_queue is None:
+    job_queue = JobQueue(workers=JOB_WORKERS)
+  return job_queue
+
+
+def run_job(name, func, *args, respond=None, render=None, key=None):
+  ''' 在后台执行 func, 最多等待 ?wait= 秒
+      完成时返回 respond(render(result)), 失败返回 500, 未完成返回 202 和轮询地址
+      给出 key (如 url) 时, func 的结果以 key 缓存, 同一 key 进行中的抓取合并为一次
+      同一 key 的 func 应返回相同的数据, 不同 route 的差别放在 render 和 respond 中
+      render 的结果 (如 html markdown) 按 name 与原始数据存放在一起, 命中时不再重新生成 '''
+  respond = respond or (lambda result: result)
+
+  def output(result, record=None):
+    if render is None:
+      return respond(result)
+    if record is None or record['raw'] is not result:  # 未缓存, 或已被新的抓取替换
+      return respond(render(result))
+    if name not in record['rendered']:
+      record['rendered'][name] = render(result)
+    return respond(record['rendered'][name])
+
+  if key is not None and not request.args.get('refresh'):
+    record = result_cache.get(key)
+    if record is not None:
+      resp = make_response(output(record['raw'], record))
+      resp.headers['X-Cache'] = 'HIT'
+      resp.headers['Age'] = str(int(result_cache.age(key) or 0))
+      return resp
+
+  def crawl(*args):
+    result = func(*args)
+    if key is not None:
+      json.dumps(result, ensure_ascii=False)  # 无法转为 json 时在这里出错, job 记为 failed, 不进入缓存
+      result_cache.put(key, {'raw': result, 'rendered': {}})
+    return result
+
+  queue = get_job_queue()
+  job = queue.submit(name, crawl, *args, key=key)
+  cache_status = 'COALESCED' if job.get('coalesced') else 'MISS'
+  wait = request.args.get('wait', JOB_WAIT_SECONDS, type=float)  # 无法解析时为默认值
+  if not wait >= 0:  # 负数或 nan
+    wait = 0
+  job = queue.wait(job['id'], timeout=min(wait, JOB_WAIT_MAX))
+  if job['status'] == 'done':
+    record = result_cache.peek(key) if key is not None else None
+    resp = make_response(output(job['result'], record))
+  elif job['status'] == 'failed':
+    resp = jsonify({'data': None, 'error_code': 1, 'message': job['error'], 'job_id': job['id']})
+    resp.status_code = 500
+  else:
+    poll_url = url_for('get_job', job_id=job['id'])
+    resp = jsonify({'data': None, 'error_code': 0, 'message': 'pending',
+                    'job_id': job['id'], 'status': job['status'], 'poll': poll_url})
+    resp.status_code = 202
+    resp.headers['Location'] = poll_url
+  resp.headers['X-Cache'] = cache_status
+  return resp
+
+
+def wants_ndjson():
+  return (request.args.get('format') == 'ndjson' or
+          'application/x-ndjson' in request.headers.get('Accept', ''))
+
 
-import gzip, functools
-from io import BytesIO
+def lister_limit(default):
+  ''' ?limit= 无法解析时为 default, 限制在 0 到 LISTER_LIMIT_MAX 之间 '''
+  return min(max(request.args.get('limit', default, type=int), 0), LISTER_LIMIT_MAX)
 
-def gzipped(f):
-  @functools.wraps(f)
-  def view_func(*args, **kwargs):
-    @after_this_request
-    def zipper(response):
-      accept_encoding = request.headers.get('Accept-Encoding', '')
-      if 'gzip' not in accept_encoding.lower(): return response
 
-      response.direct_passthrough = False
-      if (response.status_code < 200 or
-          response.status_code >= 300 or
-          'Content-Encoding' in response.headers):
-          return response
-      gzip_buffer = BytesIO()
-      gzip_file = gzip.GzipFile(mode='wb', fileobj=gzip_buffer)
-      gzip_file.write(response.data)
-      gzip_file.close()
-      response.data = gzip_buffer.getvalue()
-      response.headers['Content-Encoding'] = 'gzip'
-      response.headers['Vary'] = 'Accept-Encoding'
-      response.headers['Content-Length'] = len(response.data)
-      return response
-    return f(*args, **kwargs)
-  return view_func
+def ndjson_response(items):
+  ''' 每个 item 一行 json, 边迭代边发送
+      中途出错时最后一行为 {"error": ...} '''
+  def generate():
+    try:
+      for item in items:
+        yield json.dumps(item, ensure_ascii=False) + '\n'
+    except Exception as e:
+      log.error(f'ndjson stream error {e!r}')
+      yield json.dumps({'error': repr(e)}, ensure_ascii=False) + '\n'
+  return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 
 
 
@@ -480,22 +549,24 @@ def hello():
 
 
 
+def yield_author_answer_items(author_id, limit, min_voteup):
+  for answer in zhihu.yield_author_answers(author_id, limit=limit, min_voteup=min_voteup):
+    yield {'url': zhihu.zhihu_answer_url(answer),
+           'title': answer.question.title,
+           'voteup_count': answer.voteup_count,
+           'created_time': tools.time_to_str(tools.time_from_stamp(answer.created_time)),
+           'updated_time': tools.time_to_str(tools.time_from_stamp(answer.updated_time)),
+           'author_name': answer.author.name,
+          }
+
 @app.route('/author/<author_id>')
 def list_zhihu_answers_by_author(author_id):
-  from zhihu_answer import yield_author_answers
-  ret = []
-  limit = int(request.args.get('limit', 10))
-  min_voteup = int(request.args.get('min_voteup', 300))
-  for answer in yield_author_answers(author_id, limit=limit, min_voteup=min_voteup):
-    url = zhihu_answer_url(answer)
-    ret.append({'url': url,
-                'title': answer.question.title,
-                'voteup_count': answer.voteup_count,
-                'created_time': convert_time(answer.created_time),
-                'updated_time': convert_time(answer.updated_time),
-                'author_name': answer.author.name,
-               })
-  return jsonify(ret)
+  limit = lister_limit(10)
+  min_voteup = request.args.get('min_voteup', 300, type=int)
+  items = yield_author_answer_items(author_id, limit, min_voteup)
+  if wants_ndjson():
+    return ndjson_response(items)
+  return jsonify(list(items))
 
 
 
@@ -533,38 +604,47 @@ def favicon():
 
 
 @app.route('/<folder_name>/feed')
-@gzipped
 def get_feed(folder_name):
-  log(f'getting feed {folder_name} for {request.url}')
-  limit = int(request.args.get('limit', 120))
-  feed_path = col.generate_feed(folder_name, limit=limit, site=request.url_root)
-  log(f'generate_feed done {feed_path}')
-  if feed_path:
-    return Response(open(feed_path, encoding='utf-8').read(), mimetype='application/xml')
-  else:
+  ''' feed 生成时已预先压缩, 按 Accept-Encoding 直接发送对应的文件, 不再逐次压缩
+      ETag 取 feed 内容的 hash, 内容未变时对 If-None-Match / If-Modified-Since 返回 304 '''
+  log.info(f'getting feed {folder_name} for {request.url}')
+  limit = min(max(request.args.get('limit', 120, type=int), 1), FEED_LIMIT_MAX)  # 无法解析时为 120
+  feed_path = col.to_rss_feed(folder_name, limit=limit, site=request.url_root)
+  log.info(f'generate_feed done {feed_path}')
+  if not feed_path:
     abort(404)
-    # raise RuntimeError(f'cannot generate_feed {folder_name}')
+  builder = feed_builder(os.path.dirname(feed_path))
+  encoding = request.accept_encodings.best_match(builder.encodings)
+  path = builder.variant_path(encoding) if encoding else feed_path
+  etag = builder.etag + (f'-{encoding}' if encoding else '')  # 不同编码的内容不同, ETag 也要区分
+  response = send_file(os.path.abspath(path), mimetype='application/xml',
+                       etag=etag, conditional=True, max_age=0)
+  response.headers['Vary'] = 'Accept-Encoding'
+  if encoding:
+    response.headers['Content-Encoding'] = encoding
+  return response
 
 
 
 # Fetch Single Page 
 
 from crawler import zhihu
+
+def page_html(data):
+  ''' data 来自 result_cache, 多个请求共用, 复制后再生成页面 '''
+  return Page.create(copy.deepcopy(data)).to_html()
+
 @app.route('/https://zhuanlan.zhihu.com/p/<int:article_id>')
 def fetch_zhihu_single_article(article_id):
-  log(f'get zhuanlan article_id {article_id}')
+  log.info(f'get zhuanlan article_id {article_id}')
   url = f'https://zhuanlan.zhihu.com/p/{article_id}'
-  data = zhihu.fetch_zhihu_article(url)
-  page = Page.create(data)
-  return page.to_html()
+  return run_job('zhihu_article_html', zhihu.fetch_zhihu_article, url, render=page_html, key=url)
 
 @app.route('/https://www.zhihu.com/question/<int:q_id>/answer/<int:a_id>')
 def fetch_zhihu_single_answer(q_id, a_id):
-  log(f'get question {q_id} answer {a_id}')
+  log.info(f'get question {q_id} answer {a_id}')
   url = f'https://www.zhihu.com/question/{q_id}/answer/{a_id}'
-  data = zhihu.fetch_zhihu_answer(url)
-  page = Page.create(data)
-  return page.to_html()
+  return run_job('zhihu_answer_html', zhihu.fetch_zhihu_answer, url, render=page_html, key=url)
 
 
 
@@ -588,46 +668,55 @@ def allow_origin(data):
 @app.route('/api/zhihu/zhuanlan/<zhuanlan_id>')
 def api_fetch_zhihu_zhuanlan_articles(zhuanlan_id):
   '''专栏文章列表'''
-  log(f'api get zhuanlan articles {zhuanlan_id}')
+  log.info(f'api get zhuanlan articles {zhuanlan_id}')
   url = f'https://zhuanlan.zhihu.com/{zhuanlan_id}'
-  data = Fetcher.create({'url': url, 'limit': 20}).request()
-  return allow_origin(data)
+  fetcher = Fetcher.create(url, {'limit': lister_limit(20)})
+  if wants_ndjson():
+    return ndjson_response(fetcher.request_iter())
+  return run_job('zhihu_zhuanlan', fetcher.request, respond=allow_origin)
 
 @app.route('/api/zhihu/p/<int:article_id>')
 def api_fetch_zhihu_single_article(article_id):
   '''专栏文章页'''
-  log(f'api get zhuanlan article_id {article_id}')
+  log.info(f'api get zhuanlan article_id {article_id}')
   url = f'https://zhuanlan.zhihu.com/p/{article_id}'
-  data = zhihu.fetch_zhihu_article(url)
-  return allow_origin(data)
+  return run_job('zhihu_article', zhihu.fetch_zhihu_article, url, respond=allow_origin, key=url)
 
 @app.route('/api/zhihu/question/<int:q_id>/answer/<int:a_id>')
 def api_fetch_zhihu_single_answer(q_id, a_id):
-  log(f'api get question {q_id} answer {a_id}')
+  log.info(f'api get question {q_id} answer {a_id}')
   url = f'https://www.zhihu.com/question/{q_id}/answer/{a_id}'
-  data = zhihu.fetch_zhihu_answer(url)
-  return allow_origin(data)
+  return run_job('zhihu_answer', zhihu.fetch_zhihu_answer, url, respond=allow_origin, key=url)
+
+
+@app.route('/api/jobs/<job_id>')
+def get_job(job_id):
+  ''' 轮询后台 job, 完成后 data 为抓取结果 '''
+  job = get_job_queue().get(job_id)
+  if job is None:
+    abort(404)
+  return allow_origin(job)
+
 
 
+def page_markdown(data):
+  data = copy.deepcopy(data)
+  data['metadata']['folder'] = './'
+  return {'mdtxt': Page.create(data).render()}
 
 @app.route('/url/<path:url>')
 def fetch_common_url(url):
 
   log.info(f'GET common_url `{url}`')
-  data = {'key': 123}
   url_type = parse_type(url)
   if url_type == UrlType.ZhihuColumnPage:
-    data = zhihu.fetch_zhihu_article(url)
+    fetch = zhihu.fetch_zhihu_article
   elif url_type == UrlType.ZhihuAnswerPage:
-    data = zhihu.fetch_zhihu_answer(url)
+    fetch = zhihu.fetch_zhihu_answer
   else:
     log.error('GET common_url cannot parse')
-    return 404
-
-  data['metadata']['folder'] = './'
-  page = Page.create(data)
-  mdtxt = page.render()
-  return allow_origin({'mdtxt': mdtxt})
+    abort(404)
+  return run_job('common_url', fetch, url, render=page_markdown, respond=allow_origin, key=url)
 
 
 
@@ -646,12 +735,12 @@ def fetch_common_url(url):
 if __name__ == '__main__':
   if tools.is_windows():
     project_path = 'D:/DataStore/Test Collector2' 
-    # col = Collector(project_path=project_path)
-    app.run(debug=True, host='0.0.0.0', port=80)
+    # create_app(project_path)
+    app.run(debug=True, host='0.0.0.0', port=80, threaded=True)
   elif tools.is_linux():
     project_path = '/project'
-    # col = Collector(project_path=project_path)
-    app.run(debug=True, host='0.0.0.0', port=443,
+    # create_app(project_path)
+    app.run(debug=True, host='0.0.0.0', port=443, threaded=True,
             ssl_context=('cert.pem', 'key.pem'))
   else:
     raise RuntimeError('Platform unsupported')
\ No newline at end of file
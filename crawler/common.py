@@ -9,6 +9,10 @@ import tools
 import shutil
 import re
 import requests
+import hashlib
+import atexit
+import threading
+from collections import Counter
 
 from tools import create_logger
 log = create_logger(__file__)
@@ -18,33 +22,458 @@ log_error = create_logger(__file__ + '.error')
 UA = "Mozilla/5.0 (Windows NT 6.3; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/49.0.2623.13 Safari/537.36"
 session = requests.Session()
 
+
+CACHE_ROOT = 'temp/http_cache'
+CACHE_MAX_BYTES = 200 * 1024 * 1024
+CACHE_INDEX_SAVE_SECONDS = 60  # 命中只改动 access_time, 最多每隔这么久写一次 index
+# 按 url 类型设定缓存有效期 (秒), 自上而下取第一个匹配项
+CACHE_TTLS = [
+  (r'//rsshub\.app/', 1800),                       # RSSHub 订阅源
+  (r'//wemp\.app/accounts/', 3600),                # 公众号文章列表
+  (r'//wemp\.app/posts/', 7 * 24 * 3600),          # 公众号文章
+  (r'//api\.bilibili\.com/x/article/viewinfo', 600),  # 专栏文章统计数
+  (r'//api\.bilibili\.com/', 3600),
+  (r'//www\.bilibili\.com/read/cv', 24 * 3600),
+  (r'//www\.v2ex\.com/t/', 600),
+  (r'', 3600),
+]
+
+
+class HttpCache:
+  ''' common_get 使用的磁盘缓存
+      root/objects/ab/abcdef...  以内容的 sha1 存放响应正文, 相同内容只存一份
+      root/index.json            url => {blob, size, etag, last_modified, fetch_time, access_time}
+      过期后如果有 ETag / Last-Modified, 以条件请求验证, 服务器返回 304 时继续使用缓存
+      总大小超过 max_bytes 时, 按 access_time 淘汰最久未使用的条目, access_time 随 index 保存
+      stats 记录 hit miss revalidated 次数, cache=False 的请求不计入
+  '''
+  def __init__(self, root=CACHE_ROOT, max_bytes=CACHE_MAX_BYTES, ttls=CACHE_TTLS):
+    self.root = root
+    self.max_bytes = max_bytes
+    self.ttls = [(re.compile(pat), seconds) for pat, seconds in ttls]
+    self.stats = Counter()
+    self.lock = threading.RLock()
+    self._index = None
+    self.dirty = False    # index 有未保存的 access_time
+    self.saved_time = 0
+
+  @property
+  def index_path(self):
+    return os.path.join(self.root, 'index.json')
+
+  @property
+  def index(self):
+    if self._index is None:
+      try:
+        self._index = tools.json_load(self.index_path)
+      except (FileNotFoundError, ValueError):
+        self._index = {}
+    return self._index
+
+  def save_index(self):
+    os.makedirs(self.root, exist_ok=True)
+    temp_path = self.index_path + '.tmp'
+    tools.json_save(self.index, temp_path)
+    os.replace(temp_path, self.index_path)
+    self.dirty = False
+    self.saved_time = time.time()
+
+  def flush(self):
+    ''' 保存命中时更新的 access_time, 进程退出时调用 '''
+    with self.lock:
+      if self.dirty:
+        self.save_index()
+
+  def blob_path(self, blob):
+    return os.path.join(self.root, 'objects', blob[:2], blob)
+
+  @property
+  def total_bytes(self):
+    blobs = {entry['blob']: entry['size'] for entry in self.index.values()}
+    return sum(blobs.values())
+
+  def ttl(self, url):
+    for pat, seconds in self.ttls:
+      if pat.search(url):
+        return seconds
+    return 3600
+
+  def lookup(self, url):
+    ''' 返回 url 的缓存条目, 没有缓存或正文文件丢失时返回 None '''
+    with self.lock:
+      entry = self.index.get(url)
+      if entry and not os.path.exists(self.blob_path(entry['blob'])):
+        del self.index[url]
+        return None
+      return entry
+
+  def is_fresh(self, url, entry):
+    return time.time() - entry['fetch_time'] < self.ttl(url)
+
+  def conditional_headers(self, entry):
+    headers = {}
+    if entry.get('etag'): headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'): headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+  def read(self, url, entry):
+    ''' 读取正文并更新 access_time, 正文文件已被删除 (如其他线程 evict) 时移除条目, 返回 None '''
+    with self.lock:
+      try:
+        with open(self.blob_path(entry['blob']), 'rb') as f:
+          content = f.read()
+      except FileNotFoundError:
+        if self.index.get(url) is entry:
+          del self.index[url]
+        return None
+      entry['access_time'] = time.time()
+      self.dirty = True
+      if time.time() - self.saved_time >= CACHE_INDEX_SAVE_SECONDS:
+        self.save_index()
+      return content
+
+  def store(self, url, content, headers=None):
+    headers = headers or {}
+    blob = hashlib.sha1(content).hexdigest()
+    path = self.blob_path(blob)
+    with self.lock:
+      if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+          f.write(content)
+        os.replace(temp_path, path)
+      now = time.time()
+      self.index[url] = {'blob': blob, 'size': len(content),
+                         'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified'),
+                         'fetch_time': now, 'access_time': now}
+      self.evict()
+      self.save_index()
+
+  def refresh(self, url, entry, headers=None):
+    ''' 条件请求得到 304, 缓存内容仍然有效 '''
+    headers = headers or {}
+    with self.lock:
+      entry['fetch_time'] = entry['access_time'] = time.time()
+      entry['etag'] = headers.get('ETag') or entry.get('etag')
+      entry['last_modified'] = headers.get('Last-Modified') or entry.get('last_modified')
+      self.save_index()
+
+  def evict(self):
+    ''' 按 access_time 淘汰最久未使用的条目, 直到总大小不超过 max_bytes
+        不再被任何 url 引用的正文文件随之删除 '''
+    with self.lock:
+      total = self.total_bytes
+      if total <= self.max_bytes:
+        return 0
+      removed = 0
+      for url, entry in sorted(self.index.items(), key=lambda item: item[1]['access_time']):
+        if total <= self.max_bytes:
+          break
+        del self.index[url]
+        removed += 1
+        if not any(e['blob'] == entry['blob'] for e in self.index.values()):
+          total -= entry['size']
+          try:
+            os.remove(self.blob_path(entry['blob']))
+          except FileNotFoundError:
+            pass
+      self.stats['evicted'] += removed
+      return removed
+
+  def clear(self):
+    with self.lock:
+      shutil.rmtree(self.root, ignore_errors=True)
+      self._index = {}
+      self.stats.clear()
+
+
+http_cache = HttpCache()
+
+@atexit.register
+def _http_cache_flush():
+  http_cache.flush()
+
+
 def common_get(url, cache=True, referer=None):
-  '''# requests with UA, referer, cache'''
-  md5 = tools.md5(url, 6)
-  file_url = tools.remove_invalid_char(','.join(url.split('/')[2:]))
-  cache_file = f'temp/{file_url}-{md5}'
-  
-  if cache and os.path.exists(cache_file):
-    modify_time = tools.time_now_stamp() - os.path.getmtime(cache_file)
-    if modify_time < 3600: # 在60分钟以内修改
-      log(f'using cached `{url}`\n    `{cache_file}`')
-      return tools.text_load(cache_file)
-
-  # 没有 cache, 需要抓取
+  '''# requests with UA, referer, cache
+     cache=True 时使用 http_cache, 有效期内直接返回缓存, 过期后以 ETag / Last-Modified 条件请求'''
+  entry = http_cache.lookup(url) if cache else None
+  if entry and http_cache.is_fresh(url, entry):
+    content = http_cache.read(url, entry)
+    if content is not None:
+      http_cache.stats['hit'] += 1
+      log(f'using cached `{url}`')
+      return bytes.decode(content, encoding='utf-8')
+    entry = None  # 正文刚被淘汰, 当作没有缓存
+
+  # 没有 cache 或已过期, 需要抓取
   if referer is None: referer = '/'.join(url.split('/')[:3])
   log(f'referer {referer}')
   headers = { "User-Agent" : UA, "Referer": referer}
+  if entry:
+    headers.update(http_cache.conditional_headers(entry))
   resp = session.get(url, headers=headers)
   log(f'resp.status_code { resp.status_code }')
+  if entry and resp.status_code == 304:
+    content = http_cache.read(url, entry)
+    if content is not None:
+      http_cache.stats['revalidated'] += 1
+      http_cache.refresh(url, entry, resp.headers)
+      return bytes.decode(content, encoding='utf-8')
+    # 验证期间正文被淘汰, 不带条件重新抓取
+    resp = session.get(url, headers={"User-Agent" : UA, "Referer": referer})
   if resp.status_code != 200:
     raise requests.RequestException(f'can not get url {url}, resp.status_code={resp.status_code}')
 
+  if cache: http_cache.stats['miss'] += 1
   data = bytes.decode(resp.content, encoding='utf-8')
-  if cache: tools.text_save(data=data, path=cache_file)
+  if cache: http_cache.store(url, resp.content, resp.headers)
   return data
 
 
 
+ATTACHMENT_ROOT = 'temp/attachments'
+
+
+class AttachmentStore:
+  ''' 附件 (图片) 按内容存储, 各个页面目录中的附件是指向它的硬链接
+      root/objects/ab/abcdef....jpg  以内容的 sha1 加扩展名命名, 相同内容只存一份
+      root/index.json                {'urls': {md5(url): blob}, 'refs': {blob: [页面附件的绝对路径]}}
+      同一 url 再次出现时 (专栏题图, 回答的新版本, 其他 watcher) 直接链接, 不再下载
+      不支持硬链接时 (如跨分区) 退回复制
+      gc() 删除不再被任何页面引用的 blob
+  '''
+  def __init__(self, root=ATTACHMENT_ROOT):
+    self.root = root
+    self.lock = threading.RLock()
+    self.stats = Counter()
+    self._index = None
+    self.dirty = False
+
+  @property
+  def index_path(self):
+    return os.path.join(self.root, 'index.json')
+
+  @property
+  def index(self):
+    if self._index is None:
+      try:
+        self._index = tools.json_load(self.index_path)
+      except (FileNotFoundError, ValueError):
+        self._index = {'urls': {}, 'refs': {}}
+    return self._index
+
+  def flush(self):
+    ''' 保存 index, 在一批附件处理完后调用 '''
+    with self.lock:
+      if not self.dirty:
+        return
+      os.makedirs(self.root, exist_ok=True)
+      temp_path = self.index_path + '.tmp'
+      tools.json_save(self.index, temp_path)
+      os.replace(temp_path, self.index_path)
+      self.dirty = False
+
+  def blob_path(self, blob):
+    return os.path.join(self.root, 'objects', blob[:2], blob)
+
+  def url_blob(self, url):
+    ''' url 已下载过且 blob 仍存在时, 返回 blob '''
+    blob = self.index['urls'].get(tools.md5(url))
+    if blob and os.path.exists(self.blob_path(blob)):
+      return blob
+    return None
+
+  @staticmethod
+  def file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+      for chunk in iter(lambda: f.read(1024 * 1024), b''):
+        sha1.update(chunk)
+    return sha1.hexdigest()
+
+  def temp_path(self, url, ext):
+    ''' store 内的临时文件, 与 objects 在同一分区, 之后可以直接 os.replace '''
+    os.makedirs(os.path.join(self.root, 'tmp'), exist_ok=True)
+    return os.path.join(self.root, 'tmp', f'{tools.md5(url)}-{threading.get_ident()}{ext}.part')
+
+  def add_file(self, path):
+    ''' 把文件移入 store, 返回 blob, 已有相同内容时删除该文件
+        path 与 store 不在同一分区时 (os.replace 报 EXDEV), 复制到 store 内再替换 '''
+    blob = self.file_sha1(path) + os.path.splitext(path.replace('.part', ''))[1].lower()
+    blob_path = self.blob_path(blob)
+    with self.lock:
+      if os.path.exists(blob_path):
+        os.remove(path)
+        self.stats['deduplicated'] += 1
+        return blob
+      os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+      try:
+        os.replace(path, blob_path)
+      except OSError:
+        shutil.copyfile(path, blob_path + '.tmp')
+        os.replace(blob_path + '.tmp', blob_path)
+        os.remove(path)
+    return blob
+
+  def link(self, blob, path):
+    ''' 在 path 处建立 blob 的硬链接, 并记录引用 '''
+    blob_path = self.blob_path(blob)
+    with self.lock:
+      if not (os.path.exists(path) and os.path.samefile(path, blob_path)):
+        temp_path = path + '.link'
+        if os.path.exists(temp_path):
+          os.remove(temp_path)
+        try:
+          os.link(blob_path, temp_path)
+        except OSError:
+          shutil.copyfile(blob_path, temp_path)
+        os.replace(temp_path, path)
+      refs = self.index['refs'].setdefault(blob, [])
+      path = os.path.abspath(path)
+      if path not in refs:
+        refs.append(path)
+      self.dirty = True
+    return path
+
+  def link_url(self, url, path, fetch):
+    ''' 把 url 的附件放到 path, 返回 path
+        url 未下载过时调用 fetch(temp_path) 下载 '''
+    blob = self.url_blob(url)
+    if blob:
+      self.stats['reused'] += 1
+    elif os.path.exists(path):  # 以前直接下载到页面目录的附件, 复制到 store 内再移入
+      temp_path = self.temp_path(url, os.path.splitext(path)[1])
+      shutil.copyfile(path, temp_path)
+      blob = self.add_file(temp_path)
+      self.stats['imported'] += 1
+    else:
+      temp_path = self.temp_path(url, os.path.splitext(path)[1])
+      fetch(temp_path)
+      blob = self.add_file(temp_path)
+      self.stats['fetched'] += 1
+    with self.lock:
+      self.index['urls'][tools.md5(url)] = blob
+      self.dirty = True
+    return self.link(blob, path)
+
+  def is_referenced(self, blob, path):
+    ''' path 仍是 blob 的硬链接, 或复制得到的内容相同的文件 (blob 名即内容的 sha1) '''
+    try:
+      if os.path.samefile(path, self.blob_path(blob)):
+        return True
+      return self.file_sha1(path) == os.path.splitext(blob)[0]
+    except OSError:
+      return False
+
+  def gc(self):
+    ''' 清理失效的引用, 删除没有引用的 blob 及指向它的 url, 返回删除的 blob 数量
+        应在没有下载进行时调用 '''
+    with self.lock:
+      removed = set()
+      for blob, refs in list(self.index['refs'].items()):
+        refs[:] = [path for path in refs if self.is_referenced(blob, path)]
+        if not refs:
+          del self.index['refs'][blob]
+          removed.add(blob)
+      # 没有记录过引用的 blob (比如 link 之前中断) 也一并删除
+      objects_root = os.path.join(self.root, 'objects')
+      for folder, _, files in os.walk(objects_root):
+        for name in files:
+          if name not in self.index['refs']:
+            os.remove(os.path.join(folder, name))
+            removed.add(name)
+      self.index['urls'] = {key: blob for key, blob in self.index['urls'].items() if blob not in removed}
+      self.stats['collected'] += len(removed)
+      self.dirty = True
+      self.flush()
+      return len(removed)
+
+
+attachment_store = AttachmentStore()
+
+
+
+class AttachmentDownloader:
+  ''' 并发下载附件 (图片等), 与页面抓取分开
+      每个线程一个 requests.Session, 复用 keep-alive 连接
+      最多 workers 个下载同时进行, 失败时按 backoff * 2^n 秒退避重试 retries 次
+      响应以 chunk_size 分块写入 path + '.part', 完成后再改名为 path
+      指定 store (AttachmentStore) 时, 附件存入 store, path 为指向它的硬链接
+
+      downloader = AttachmentDownloader(workers=4)
+      futures = [downloader.submit(url, path) for url, path in items]
+      downloader.shutdown()
+  '''
+  def __init__(self, workers=4, retries=3, backoff=0.5, timeout=20, chunk_size=64 * 1024, limiter=None,
+               store=None):
+    from concurrent.futures import ThreadPoolExecutor
+    self.workers = workers
+    self.retries = retries
+    self.backoff = backoff
+    self.timeout = timeout
+    self.chunk_size = chunk_size
+    self.limiter = limiter    # 可选 tools.HostRateLimiter
+    self.store = store
+    self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='attachment')
+    self.local = threading.local()
+    self.stats = Counter()
+
+  def session(self):
+    if not hasattr(self.local, 'session'):
+      self.local.session = requests.Session()
+      self.local.session.headers['User-Agent'] = UA
+    return self.local.session
+
+  def download(self, url, path, referer=None):
+    ''' 下载 url 到 path, 已存在时跳过, 返回 path '''
+    if self.store:
+      return self.store.link_url(url, path, fetch=lambda temp_path: self.fetch(url, temp_path, referer))
+    if os.path.exists(path):
+      self.stats['existed'] += 1
+      return path
+    return self.fetch(url, path, referer)
+
+  def fetch(self, url, path, referer=None):
+    ''' 4xx 错误 (429 除外) 不重试, 重试用尽后抛出最后一次的异常 '''
+    headers = {'Referer': referer or '/'.join(url.split('/')[:3])}
+    for attempt in range(self.retries + 1):
+      try:
+        if self.limiter:
+          self.limiter.acquire(url)
+        with self.session().get(url, headers=headers, stream=True, timeout=self.timeout) as resp:
+          if resp.status_code != 200:
+            raise requests.HTTPError(f'can not get attachment {url}, resp.status_code={resp.status_code}',
+                                     response=resp)
+          temp_path = path + '.part'
+          with open(temp_path, 'wb') as f:
+            for chunk in resp.iter_content(chunk_size=self.chunk_size):
+              f.write(chunk)
+        os.replace(temp_path, path)
+        self.stats['downloaded'] += 1
+        return path
+      except requests.RequestException as e:
+        if os.path.exists(path + '.part'):
+          os.remove(path + '.part')
+        status = e.response.status_code if e.response is not None else None
+        if attempt == self.retries or (status and 400 <= status < 500 and status != 429):
+          self.stats['failed'] += 1
+          raise
+        self.stats['retried'] += 1
+        wait = self.backoff * 2 ** attempt
+        log(f'  retry attachment in {wait:.1f}s ({attempt + 1}/{self.retries}): {url} {e}')
+        time.sleep(wait)
+
+  def submit(self, url, path, referer=None):
+    ''' 返回 Future, 结果为 path '''
+    return self.executor.submit(self.download, url, path, referer)
+
+  def shutdown(self, wait=True):
+    self.executor.shutdown(wait=wait)
+
+
+
 
 
 
@@ -22,6 +22,8 @@ import re
 import requests
 
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import threading
 
 from tools import create_logger
 log = create_logger(__file__)
@@ -162,18 +164,38 @@ COMMENTS_TMPL = '''
 {% endif %}
 '''
 
+_comments_template = None
+
+def render_comments(conversations):
+  ''' COMMENTS_TMPL 只在首次使用时编译一次 '''
+  global _comments_template
+  if _comments_template is None:
+    _comments_template = Template(COMMENTS_TMPL)
+  return _comments_template.render(conversations=conversations)
+
 
 
 
 TOKEN_FILE = 'token.pkl'
-client = ZhihuClient()
-client.load_token(TOKEN_FILE)
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+  ''' ZhihuClient 在第一次用到时才创建并载入 token, 导入本模块不需要 token.pkl '''
+  global _client
+  if _client is None:
+    with _client_lock:
+      if _client is None:
+        client = ZhihuClient()
+        client.load_token(TOKEN_FILE)
+        _client = client
+  return _client
 
 # from zhihu_oauth import ZhihuClient
 # from zhihu_oauth import Article
 # from zhihu_oauth import Answer
-# article = client.article(123)
-# answer = client.answer(123)
+# article = get_client().article(123)
+# answer = get_client().answer(123)
 # answer.__class__ == Answer
 
 
@@ -193,7 +215,7 @@ def zhihu_detect(url):
 
 def zhihu_detect_with_client(url):
   '''带有登录后的 session'''
-  return client.test_api('GET', url)
+  return get_client().test_api('GET', url)
 
 
 
@@ -203,14 +225,14 @@ def zhihu_answer_url(answer):
   '''以 answer 对象拼接 url, 貌似答案被删也不报错'''
   # log('zhihu_answer_url answer' + str(answer))
   if isinstance(answer, int):
-    answer = client.answer(answer)
+    answer = get_client().answer(answer)
   return 'https://www.zhihu.com/question/{}/answer/{}'.format(answer.question.id, answer.id)
 
 
 
 def zhihu_answer_format(answer):
   if isinstance(answer, int):
-    answer = client.answer(answer)
+    answer = get_client().answer(answer)
   url = zhihu_answer_url(answer)
   title = answer.question.title
   author = answer.author.name
@@ -232,13 +254,13 @@ def parse_question(question):
   if isinstance(question, str):
     if '/answer' in question: question = question.split('/answer')[0]
     if 'api.zhihu.com' in question: # https://api.zhihu.com/question/12345
-      question = client.question(int(question.split('/')[-1]))
+      question = get_client().question(int(question.split('/')[-1]))
     elif question.isdigit():
-      question = client.question(int(question))
+      question = get_client().question(int(question))
     else:
-      question = client.from_url(question)
+      question = get_client().from_url(question)
   elif isinstance(question, int):
-    question = client.question(question)
+    question = get_client().question(question)
   return question
 
 
@@ -248,31 +270,31 @@ def parse_answer(answer):
   '''
   if isinstance(answer, str):
     if 'api.zhihu.com' in answer: # https://api.zhihu.com/answers/71917800
-      answer = client.answer(int(answer.split('/')[-1]))
+      answer = get_client().answer(int(answer.split('/')[-1]))
     elif answer.isdigit():
-      answer = client.answer(int(answer))
+      answer = get_client().answer(int(answer))
     else:
-      answer = client.from_url(answer)
+      answer = get_client().from_url(answer)
   elif isinstance(answer, int):
-    answer = client.answer(answer)
+    answer = get_client().answer(answer)
   return answer
 
 
 def parse_column(column):
-  column = client.from_url(column)
+  column = get_client().from_url(column)
   return column
 
 
 def parse_article(article):
   if isinstance(article, str):
     if 'api.zhihu.com' in article:
-      article = client.article(int(article.split('/')[-1]))
+      article = get_client().article(int(article.split('/')[-1]))
     elif article.isdigit():
-      article = client.article(int(article))
+      article = get_client().article(int(article))
     else:
-      article = client.from_url(article)
+      article = get_client().from_url(article)
   elif isinstance(article, int):
-    article = client.article(article)
+    article = get_client().article(article)
   return article
 
 def parse_topic(topic):
@@ -283,14 +305,14 @@ def parse_topic(topic):
 
   if isinstance(topic, str):
     if topic.isdigit():
-      topic = client.topic(int(topic))
+      topic = get_client().topic(int(topic))
     else:
       for part in topic.split('/'):
         if part.isdigit():
-          topic = client.topic(int(part))
+          topic = get_client().topic(int(part))
           break
   elif isinstance(topic, int):
-    topic = client.topic(topic)
+    topic = get_client().topic(topic)
   return topic
 
 
@@ -345,6 +367,9 @@ class FakeAuthor:
  ###### #####  ##   ## ##   ## ####### ##   ##    ##
 '''
 
+COMMENTS_CONCURRENCY = 4  # 并发请求评论分页的数量上限
+
+
 class CommentAuthor:
   """ 配合 CommentText 使用的 author """
   def __init__(self, aid, name, url_token, role):
@@ -413,7 +438,7 @@ class CommentBody:
 
 
 
-def get_comments_api_v4(answer_article_object, limit=2000):
+def get_comments_api_v4(answer_article_object, limit=2000, concurrency=COMMENTS_CONCURRENCY):
   ''' 获取评论, zhihu oauth 方式太慢, 换个直接拿到 api v4 json 的方式
       使用 (for root_comments)
       https://www.zhihu.com/api/v4/answers/<id>/root_comments?order=normal&limit=20&offset=20
@@ -421,6 +446,7 @@ def get_comments_api_v4(answer_article_object, limit=2000):
       和 (for child_comments)
       https://www.zhihu.com/api/v4/comments/<id>/child_comments?limit=20&offset=20
       取得评论对象, 速度比较快
+      第一页之后的分页以最多 concurrency 个并发请求抓取, 合并后的顺序不变
       
       结构是双层的, (root_comments 和 child_comments)
       即评论可以有子级评论, 子级评论可以相互回复,
@@ -469,28 +495,54 @@ def get_comments_api_v4(answer_article_object, limit=2000):
   else:
     raise ValueError(f'get_comments_api_v4 cannot parse page_klass for {answer_article_object} {page_id}')
 
-  comment_list = []
-
-  for offset in range(0, limit, 20):
+  def fetch_comment_page(offset):
     comment_link = tmpl.format(page_id=page_id, offset=offset)
-    if offset == 0:
-      # log(f'start fetching comment {comment_link} ...')
-      pass
-
-    comment_data = zhihu_detect_with_client(comment_link).json()
-    # comment_data = json.loads(text, encoding='utf-8')
+    return zhihu_detect_with_client(comment_link).json()
+
+  # 先取第一页, 由 paging.totals 得知总数后, 其余分页并发请求
+  comment_data = fetch_comment_page(0)
+  comment_list = list(comment_data['data'])
+  paging = comment_data.get('paging') or {}
+  if paging.get('is_end'):
+    return comment_list
+
+  next_offset = 20
+  if paging.get('totals') is not None and concurrency > 1:
+    offsets = range(20, min(limit, paging['totals']), 20)
+    for comment_data in fetch_pages_concurrently(fetch_comment_page, offsets, concurrency):
+      comment_list.extend(comment_data['data'])
+      paging = comment_data.get('paging') or {}
+      next_offset += 20
+    if paging.get('is_end'):
+      return comment_list
+
+  # 没有 totals, 或者 totals 偏少, 仍然逐页抓取直到 is_end
+  for offset in range(next_offset, limit, 20):
+    tools.time_random_sleep(0.2)
+    comment_data = fetch_comment_page(offset)
     comment_list.extend(comment_data['data'])
     if comment_data.get('paging'):
       if comment_data['paging']['is_end']:
         break
-    tools.time_random_sleep(0.2)
   # log(f'fetch {len(comment_list)} top level comments')
   return comment_list
 
 
 
-def get_child_comments_api_v4(root_comment_id, limit=2000):
-  '''从 root comment id 获取 child comment'''
+def fetch_pages_concurrently(fetch_page, offsets, concurrency=COMMENTS_CONCURRENCY):
+  ''' 以最多 concurrency 个并发请求抓取 offsets 对应的分页
+      按 offsets 的顺序返回结果 '''
+  offsets = list(offsets)
+  if not offsets:
+    return []
+  with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(offsets)))) as executor:
+    return list(executor.map(fetch_page, offsets))
+
+
+
+def get_child_comments_api_v4(root_comment_id, limit=2000, semaphore=None):
+  '''从 root comment id 获取 child comment
+     semaphore: 多个会话组同时展开时, 共用同一个 semaphore 限制同时在途的请求数'''
   tmpl = 'https://www.zhihu.com/api/v4/comments/{root_comment_id}/child_comments?limit=20&offset={offset}'
 
   child_comment_list = []
@@ -498,7 +550,11 @@ def get_child_comments_api_v4(root_comment_id, limit=2000):
   for offset in range(0, limit, 20):
     comment_link = tmpl.format(root_comment_id=root_comment_id, offset=offset)
     # log(f'start fetching child comments {comment_link} ...')
-    comment_data = zhihu_detect_with_client(comment_link).json()
+    if semaphore is None:
+      comment_data = zhihu_detect_with_client(comment_link).json()
+    else:
+      with semaphore:
+        comment_data = zhihu_detect_with_client(comment_link).json()
     # comment_data = json.loads(text, encoding='utf-8')
     child_comment_list.extend(comment_data['data'])
     if comment_data.get('paging'):
@@ -509,7 +565,8 @@ def get_child_comments_api_v4(root_comment_id, limit=2000):
   return child_comment_list
 
 
-def get_valuable_conversations_api_v4(comment_list, root_limit=10, child_limit=8):
+def get_valuable_conversations_api_v4(comment_list, root_limit=10, child_limit=8, 
+                                      child_scan_limit=200, concurrency=COMMENTS_CONCURRENCY):
   '''
   使用 url api v4
   conversation 会话组, 是父级评论和下属子级评论的对话集合
@@ -518,6 +575,8 @@ def get_valuable_conversations_api_v4(comment_list, root_limit=10, child_limit=8
 
   root_limit : 选取会话组的上限
   child_limit : 会话组中内部相互回复的上限
+  child_scan_limit : 每个会话组最多翻页取回的子级评论数
+  concurrency : 展开会话组时同时在途的请求数上限
 
   会话组选取规则是
     0 去掉 featured 属性的内容 (这些评论之后会重复一遍)
@@ -541,12 +600,23 @@ def get_valuable_conversations_api_v4(comment_list, root_limit=10, child_limit=8
     conversations.append(root_comment)
   conversations = sorted(conversations, key=lambda c: -c['score'])[:root_limit]
   # conversations = sorted(conversations, key=lambda c: -c['created_time']) # 不需要调整时间顺序
+  # 需要追踪的会话组同时展开, 所有请求共用一个 semaphore
+  # child comments 按时间顺序返回, 看不到后面的赞数, 因此只有全部取回才能确定前 child_limit 名
+  # 最多扫描 child_scan_limit 条, 超过部分不再翻页 (对于楼层很多的会话组, 这是近似结果)
+  truncated = [c for c in conversations if c['child_comment_count'] > len(c['child_comments'])]
+  expanded = {}
+  if truncated:
+    semaphore = threading.BoundedSemaphore(max(1, concurrency))
+    def expand(root_comment):
+      scan_limit = min(root_comment['child_comment_count'], max(child_scan_limit, child_limit))
+      return get_child_comments_api_v4(root_comment['id'], limit=scan_limit, semaphore=semaphore)
+    with ThreadPoolExecutor(max_workers=len(truncated)) as executor:
+      for root_comment, child_comments in zip(truncated, executor.map(expand, truncated)):
+        expanded[root_comment['id']] = child_comments
+
   result = []
   for root_comment in conversations:
-    if root_comment['child_comment_count'] > len(root_comment['child_comments']):
-      child_comments = get_child_comments_api_v4(root_comment['id'])
-    else:
-      child_comments = root_comment['child_comments']
+    child_comments = expanded.get(root_comment['id'], root_comment['child_comments'])
     child_comments = sorted(child_comments, key=lambda c: -c['vote_count'])[:child_limit]
     child_comments = sorted(child_comments, key=lambda c: c['created_time'])  # 调整为时间先后顺序
     child_comments = [CommentBody.create(c) for c in child_comments]
@@ -557,7 +627,6 @@ def get_valuable_conversations_api_v4(comment_list, root_limit=10, child_limit=8
 
 
 
-
   
 def preview_comment_data(comment_data):
   '''预览 comment 结构'''
@@ -825,7 +894,7 @@ def fetch_zhihu_answer(url):
 
 
 
-  comments = Template(COMMENTS_TMPL).render(conversations=conversations)
+  comments = render_comments(conversations)
 
   return { 'metadata': metadata,
            'question_detail': zhihu_fix_markdown(question_details).strip(),
@@ -879,7 +948,7 @@ def fetch_zhihu_answer(url):
 
 def zhihu_article_format(article):
   if isinstance(article, int):
-    article = client.article(article)
+    article = get_client().article(article)
   url = zhihu_article_url(article)
   title = article.title
   author_name = article.author.name # 应该没有专栏匿名作者 if article.author else FakeAuthor().name
@@ -965,7 +1034,7 @@ def fetch_zhihu_article(url):
   }
 
 
-  comments = Template(COMMENTS_TMPL).render(conversations=conversations)
+  comments = render_comments(conversations)
 
   return { 'metadata': metadata,
            'content': zhihu_fix_markdown(article_body).strip(),
@@ -1023,39 +1092,18 @@ def parse_json_date(n):
   return str(datetime.datetime.fromtimestamp(n))
 
 
-def fetch_image(url, ext, markdown_file, image_counter):
-  '''
-  需要区分 全路径 和 相对引用
-  需要转换每个 md 的附件名
-  需要附件名编号'''
-  if '.zhimg.com' not in url:
-    log_error('  exotic url: ', url)
-    return url
-  # name = url.split('/')[-1]
-  # nonlocal image_counter
-  image_counter.append(1)
-  image_index = str(len(image_counter))
-  if len(image_index) == 1:
-    image_index = '0' + image_index
-
-  folder = os.path.dirname(markdown_file)
+def image_local_name(markdown_file, index, ext):
+  ''' 附件名为 md 文件名加两位编号, 与 md 文件放在同一目录 '''
   basename = os.path.basename(markdown_file)[:-3]
-  image_fullname = folder + '/' + basename + image_index + ext
-  image_name = basename + image_index + ext
+  return basename + str(index).zfill(2) + ext
 
-  if os.path.exists(image_fullname):
-    log('  existed: ' + url)
-    return image_name
 
-  log('    fetching ' + url)
-  data = urllib.request.urlopen(url).read()
-  with open(image_fullname, "wb") as f:
-    f.write(data)
-  return image_name
-
-
-
-def fetch_images_for_markdown(markdown_file):
+def fetch_images_for_markdown(markdown_file, downloader=None):
+  ''' 下载 md 中的知乎图片, 并把图片链接改为本地文件名
+      全部图片交给 downloader (common.AttachmentDownloader) 并发下载, 下载失败的保留原链接
+      默认存入 common.attachment_store, 页面目录中的图片为硬链接
+      返回写入的文件列表 (图片和改写后的 md) '''
+  from crawler.common import AttachmentDownloader, attachment_store
   with open(markdown_file, 'r', encoding='utf-8') as f:
     text = f.read()
 
@@ -1063,22 +1111,46 @@ def fetch_images_for_markdown(markdown_file):
     print("'whitedot.jpg' in text")
     if not markdown_file.endswith('whitedot'):
       shutil.move(markdown_file, markdown_file + '.whitedot')
-    return False
-
-  # print('start parsing md file: ' + markdown_file.split('/')[-1])
-  image_counter = []
-  replacer = lambda m: fetch_image(url=m.group(0),
-                                   ext=m.group(2),
-                                   markdown_file=markdown_file,
-                                   image_counter=image_counter)
-
-  text2, n = re.subn(r'(https?://pic[^()]+(\.jpg|\.png|\.gif))', replacer, text)
-  if n > 0:
-    with open(markdown_file, 'w', encoding='utf-8') as f:
-      f.write(text2)
-    log('parsing md file done:  ' + markdown_file.split('/')[-1])
-  else:
+      return [markdown_file, markdown_file + '.whitedot']
+    return []
+
+  folder = os.path.dirname(markdown_file)
+  pattern = re.compile(r'(https?://pic[^()]+(\.jpg|\.png|\.gif))')
+  local_names = {}  # url => 本地文件名, 同一图片出现多次只下载一次
+  for match in pattern.finditer(text):
+    url, ext = match.group(0), match.group(2)
+    if '.zhimg.com' not in url:
+      log_error('  exotic url: ', url)
+    elif url not in local_names:
+      local_names[url] = image_local_name(markdown_file, len(local_names) + 1, ext)
+  if not local_names:
     log('no pictures downloaded: ' + markdown_file.split('/')[-1])
+    return []
+
+  own_downloader = downloader is None
+  if own_downloader:
+    downloader = AttachmentDownloader(store=attachment_store)
+  try:
+    futures = {url: downloader.submit(url, os.path.join(folder, name)) for url, name in local_names.items()}
+    written = []
+    for url, future in futures.items():
+      try:
+        written.append(future.result())
+      except Exception as e:
+        log_error(f'  fetch image failed: {url} {e}')
+        del local_names[url]
+  finally:
+    if own_downloader:
+      downloader.shutdown()
+    if downloader.store:
+      downloader.store.flush()
+
+  text2 = pattern.sub(lambda m: local_names.get(m.group(0), m.group(0)), text)
+  if text2 != text:
+    tools.text_save_atomic(markdown_file, text2)
+    written.append(markdown_file)
+  log(f'parsing md file done: {markdown_file.split("/")[-1]}, {len(local_names)} pictures')
+  return written
 
 
 
@@ -1197,19 +1269,40 @@ def test_zhihu_fix_mistake_headerline_splitter():
 ####### ###### ######     ##   ####### ##   ##
 '''
 
+def stop_at_known(items, to_url, known_urls=(), stop_after_known=0):
+  ''' 增量抓取列表时使用
+      known_urls: 已经记录过的页面 url
+      stop_after_known: 连续遇到 n 个已知页面后停止翻页, 0 表示不启用, 原样返回 items
+      启用时跳过已知页面, 只 yield 新页面 '''
+  if not stop_after_known or not known_urls:
+    yield from items
+    return
+  known_count = 0
+  for item in items:
+    if to_url(item) in known_urls:
+      known_count += 1
+      if known_count >= stop_after_known:
+        log(f'stop_at_known: met {known_count} known items in a row, stop paging')
+        return
+      continue
+    known_count = 0
+    yield item
+
+
 def yield_topic_best_answers(topic_id, limit=100, min_voteup=300, min_thanks=50, 
-                             banned_keywords=''):
+                             banned_keywords='', known_urls=(), stop_after_known=0):
   ''' banned_keywords: 忽略问题 topic 中具有该关键词的情况, 如 情感, 调查类问题
                        忽略问题 title 中具有该关键词的情况, 如 有哪些, 文艺表达, 文艺的表达, 前女友
+      known_urls, stop_after_known: 见 stop_at_known
   '''
-  topic = client.topic(topic_id)
+  topic = get_client().topic(topic_id)
   log(topic.name + str(topic_id))
   count = 0
   if banned_keywords.strip():
     banned_keywords = set(key.strip() for key in banned_keywords.split(','))
   else:
     banned_keywords = set()
-  for answer in topic.best_answers:
+  for answer in stop_at_known(topic.best_answers, zhihu_answer_url, known_urls, stop_after_known):
     # log('yield_topic_best {} {} {}'.format(answer.question.title, answer.author.name, answer.voteup_count))
     if answer.voteup_count >= min_voteup and answer.thanks_count >= min_thanks:
       if set(t.name for t in answer.question.topics) & banned_keywords: 
@@ -1238,7 +1331,7 @@ def yield_old_fashion_topic_answers(topic_id, mode=('all', 'best')[0],
     raise
   count = 0
   for old_answer in answers:
-    answer = client.answer(int(old_answer.id))
+    answer = get_client().answer(int(old_answer.id))
     # print(answer.question.title, answer.author.name, answer.id, answer.question.id)
     if answer.voteup_count >= min_voteup:
       count += 1
@@ -1246,11 +1339,12 @@ def yield_old_fashion_topic_answers(topic_id, mode=('all', 'best')[0],
     if count >= limit:
       break
 
-def yield_author_answers(author_id, limit=100, min_voteup=300, min_thanks=50):
+def yield_author_answers(author_id, limit=100, min_voteup=300, min_thanks=50, 
+                         known_urls=(), stop_after_known=0):
   # url = 'https://www.zhihu.com/people/shi-yidian-ban-98'
-  author = client.people(author_id)
+  author = get_client().people(author_id)
   count = 0
-  for answer in author.answers:
+  for answer in stop_at_known(author.answers, zhihu_answer_url, known_urls, stop_after_known):
     if answer.voteup_count >= min_voteup and answer.thanks_count >= min_thanks:
       count += 1
       yield answer
@@ -1258,11 +1352,12 @@ def yield_author_answers(author_id, limit=100, min_voteup=300, min_thanks=50):
       break
 
 
-def yield_question_answers(question_id, limit=100, min_voteup=300, min_thanks=50):
+def yield_question_answers(question_id, limit=100, min_voteup=300, min_thanks=50, 
+                           known_urls=(), stop_after_known=0):
   # url = 'https://www.zhihu.com/people/shi-yidian-ban-98'
-  question = client.question(question_id)
+  question = get_client().question(question_id)
   count = 0
-  for answer in question.answers:
+  for answer in stop_at_known(question.answers, zhihu_answer_url, known_urls, stop_after_known):
     if answer.voteup_count >= min_voteup and answer.thanks_count >= min_thanks:
       count += 1
       yield answer
@@ -1270,11 +1365,12 @@ def yield_question_answers(question_id, limit=100, min_voteup=300, min_thanks=50
       break
 
 
-def yield_column_articles(column_id, limit=100, min_voteup=20, text_contains=()):
+def yield_column_articles(column_id, limit=100, min_voteup=20, text_contains=(), 
+                          known_urls=(), stop_after_known=0):
   # TODO: 参数需要改成 pipeline
-  column = client.column(column_id)
+  column = get_client().column(column_id)
   count = 0
-  for article in column.articles:
+  for article in stop_at_known(column.articles, zhihu_article_url, known_urls, stop_after_known):
     # print(article.voteup_count)
     if article.voteup_count >= min_voteup:
       count += 1
@@ -1283,10 +1379,10 @@ def yield_column_articles(column_id, limit=100, min_voteup=20, text_contains=())
       break
 
 
-def yield_author_articles(author_id, limit=100, min_voteup=20):
-  author = client.people(author_id)
+def yield_author_articles(author_id, limit=100, min_voteup=20, known_urls=(), stop_after_known=0):
+  author = get_client().people(author_id)
   count = 0
-  for article in author.articles:
+  for article in stop_at_known(author.articles, zhihu_article_url, known_urls, stop_after_known):
     if article.voteup_count >= min_voteup :
       count += 1
       yield article
@@ -1297,18 +1393,19 @@ def yield_author_articles(author_id, limit=100, min_voteup=20):
 def test_yield_org_articles():
   # author_id = 'di-ping-xian-ji-qi-ren-ji-shu'
   url = 'https://www.zhihu.com/org/di-ping-xian-ji-qi-ren-ji-shu'
-  author = client.from_url(url)
+  author = get_client().from_url(url)
   print(author)
   print(author.name)
   ats = list(author.articles)
   print(ats)
 
 
-def yield_collection_answers(collection_id, limit=100, min_voteup=300, min_thanks=50):
+def yield_collection_answers(collection_id, limit=100, min_voteup=300, min_thanks=50, 
+                             known_urls=(), stop_after_known=0):
   # 'http://www.zhihu.com/collection/19845840' 我心中的知乎TOP100
-  collection = client.collection(collection_id)
+  collection = get_client().collection(collection_id)
   count = 0
-  for answer in collection.answers:
+  for answer in stop_at_known(collection.answers, zhihu_answer_url, known_urls, stop_after_known):
     if answer.voteup_count >= min_voteup and answer.thanks_count >= min_thanks:
       count += 1
       yield answer
@@ -179,8 +179,8 @@ def test_save_whitedot_bug():
 
 def test_yield_answers_by_author():
   url = 'https://www.zhihu.com/people/shi-yidian-ban-98'
-  author = client.from_url(url)
-  author = client.people('shi-yidian-ban-98')
+  author = get_client().from_url(url)
+  author = get_client().people('shi-yidian-ban-98')
 
   log(author.name)
   i = 0
@@ -197,7 +197,7 @@ def test_get_api_json():
   url = 'https://api.zhihu.com/answers/101244285'
   from pprint import pprint
   import json
-  r = client.test_api('GET', url)
+  r = get_client().test_api('GET', url)
   # s = str(r.content, encoding='utf-8')
   j = json.loads(str(r.content, encoding='utf-8'))
   pprint(j)
@@ -255,7 +255,7 @@ def test_fetch_articles_by_column():
   column_id = 'learningtheory'
   column_id = 'qbitai'
   column_id = 'leanreact'
-  column = client.column(column_id)
+  column = get_client().column(column_id)
   for a in column.articles:
     log(a.title + ' - ' + a.column.title)
     save_article(a)
@@ -269,7 +269,7 @@ def test_fetch_articles():
   author_id = 'liang-zi-wei-48'
   author_id = 'qbitai'
 
-  author = client.people(author_id)
+  author = get_client().people(author_id)
   log(author.name)
 
   for a in author.articles:
@@ -289,18 +289,18 @@ def test_fetch_articles():
 def test_fetch_one_article():
   # url = 'https://zhuanlan.zhihu.com/p/19598346'
   # https://zhuanlan.zhihu.com/p/22197924
-  # article = client.article(19598346) # 设计一只蘑菇 - 傅渥成 生命的设计原则
-  # article = client.article(19610634) # 穿过黑箱的数据
-  # article = client.article(19950456) # 警惕人工智能
-  # article = client.article(19837940) # 二十四条逻辑谬误
-  # article = client.article(20684541) # 俄罗斯 | 没人扎堆的博物馆
-  # article = client.article(21586417) # 不同的调有什么区别？
-  article = client.article(29435406) # 浅析 Hinton 最近提出的 Capsule 计划
-  article = client.article(31809930) # 浅述：从 Minimax 到 AlphaZero，完全信息博弈之路（1）
-  # article = client.article(20361844) # 对位法入门
-
-  # article = client.article(19950456)
-  # article = client.article(22197924) # 明天究竟有多远——怎么加总贴现率
+  # article = get_client().article(19598346) # 设计一只蘑菇 - 傅渥成 生命的设计原则
+  # article = get_client().article(19610634) # 穿过黑箱的数据
+  # article = get_client().article(19950456) # 警惕人工智能
+  # article = get_client().article(19837940) # 二十四条逻辑谬误
+  # article = get_client().article(20684541) # 俄罗斯 | 没人扎堆的博物馆
+  # article = get_client().article(21586417) # 不同的调有什么区别？
+  article = get_client().article(29435406) # 浅析 Hinton 最近提出的 Capsule 计划
+  article = get_client().article(31809930) # 浅述：从 Minimax 到 AlphaZero，完全信息博弈之路（1）
+  # article = get_client().article(20361844) # 对位法入门
+
+  # article = get_client().article(19950456)
+  # article = get_client().article(22197924) # 明天究竟有多远——怎么加总贴现率
   log(article.image_url)
   # print(zhihu_article_format(article))
 
@@ -321,16 +321,16 @@ def test_fetch_one_article():
 
 
 def test_article_howto_fetch_quick_comments():
-  # article = client.article(19598346) # 设计一只蘑菇 - 傅渥成 生命的设计原则
-  # article = client.article(19610634) # 穿过黑箱的数据
-  # article = client.article(19950456) # 警惕人工智能
+  # article = get_client().article(19598346) # 设计一只蘑菇 - 傅渥成 生命的设计原则
+  # article = get_client().article(19610634) # 穿过黑箱的数据
+  # article = get_client().article(19950456) # 警惕人工智能
 
   # print(zhihu_article_format(article))
   # DEBUG: "GET /articles/19950456/comments?limit=20&offset=120
   from pprint import pprint
   import json
   url = 'https://api.zhihu.com/articles/19950456/comments?limit=40'
-  r = client.test_api('GET', url)
+  r = get_client().test_api('GET', url)
   # s = str(r.content, encoding='utf-8')
   j = json.loads(str(r.content, encoding='utf-8'))
   pprint(j)
@@ -374,7 +374,7 @@ def test_fetch_articles():
   # author_id = 'liang-zi-wei-48'
   # author_id = 'qbitai'
 
-  author = client.people(author_id)
+  author = get_client().people(author_id)
   log(author.name)
 
   for a in author.articles:
@@ -0,0 +1,223 @@
+'''
+watcher 目录的 RSS 增量生成
+
+  FeedBuilder(watcher_path).build(limit, order, site)  生成 watcher_path/feed.xml
+
+缓存放在 FEED_CACHE_ROOT/<watcher_path 的 md5>/, 不会被 watcher 目录的 git 提交
+  index.pickle   每个 *.md 的 front matter, 以 mtime 和 size 判断是否需要重新读取
+  html/          每个页面 to_html() 的结果, 以 path, mtime, version 为 key
+  feed.sig       上次生成 feed.xml 时, 窗口内页面的签名
+  feed.etag      feed.xml 内容的 hash, 用作 HTTP ETag
+  feed.xml.gz    预先压缩的 feed.xml, 装有 brotli 时另有 feed.xml.br
+
+每次 build 只 stat 全部 *.md, 按 order 从索引中取最新的 limit 个页面,
+只有这些页面中 html 缓存失效的才会 Page.load 和 to_html
+窗口内页面和参数都没有变化时, 直接返回上次的 feed.xml
+压缩在生成 feed.xml 时完成, 响应请求时直接发送压缩好的文件
+'''
+
+import os
+import gzip
+import pickle
+import hashlib
+import threading
+from collections import Counter
+
+import tools
+from page import Page
+
+log = tools.create_logger(__file__)
+log_error = tools.create_logger(__file__ + '.error')
+
+
+FEED_CACHE_ROOT = 'temp/feed_cache'
+FEED_FILENAME = 'feed.xml'
+FEED_ENCODINGS = {'br': '.br', 'gzip': '.gz'}  # Content-Encoding: 扩展名, 按优先顺序
+
+
+def compress(data, encoding):
+  if encoding == 'gzip':
+    return gzip.compress(data, compresslevel=9, mtime=0)
+  if encoding == 'br':
+    import brotli
+    return brotli.compress(data, quality=11)
+  raise ValueError(f'unknown encoding `{encoding}`')
+
+def supported_encodings():
+  ''' brotli 是可选依赖, 未安装时只生成 gzip '''
+  try:
+    import brotli
+  except ImportError:
+    return ['gzip']
+  return list(FEED_ENCODINGS)
+
+
+def pickle_load(path, default=None):
+  try:
+    with open(path, 'rb') as f:
+      return pickle.load(f)
+  except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+    return default
+
+def pickle_save(path, data):
+  temp_path = path + '.tmp'
+  with open(temp_path, 'wb') as f:
+    pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+  os.replace(temp_path, path)
+
+
+
+class FeedBuilder:
+  ''' 一个 watcher 目录的 feed, 同一目录应共用一个 FeedBuilder (见 feed_builder())
+      index: {path: (mtime_ns, size, metadata)} '''
+  def __init__(self, watcher_path, cache_root=None):
+    self.watcher_path = watcher_path
+    self.cache_path = os.path.join(cache_root or FEED_CACHE_ROOT, tools.md5(os.path.abspath(watcher_path)))
+    os.makedirs(os.path.join(self.cache_path, 'html'), exist_ok=True)
+    self.index = pickle_load(self.index_path, default={})
+    self.stats = Counter()
+    self.lock = threading.Lock()
+
+  @property
+  def index_path(self): return os.path.join(self.cache_path, 'index.pickle')
+  @property
+  def sig_path(self): return os.path.join(self.cache_path, 'feed.sig')
+  @property
+  def feed_path(self): return os.path.join(self.watcher_path, FEED_FILENAME)
+
+  @property
+  def etag_path(self): return os.path.join(self.cache_path, 'feed.etag')
+
+  def variant_path(self, encoding):
+    ''' 预先压缩的 feed.xml '''
+    return os.path.join(self.cache_path, FEED_FILENAME + FEED_ENCODINGS[encoding])
+
+  @property
+  def etag(self):
+    return tools.text_load(self.etag_path) if os.path.exists(self.etag_path) else None
+
+  @property
+  def encodings(self):
+    ''' 已生成的压缩格式, 按优先顺序 '''
+    return [encoding for encoding in FEED_ENCODINGS if os.path.exists(self.variant_path(encoding))]
+
+  def html_path(self, path):
+    return os.path.join(self.cache_path, 'html', tools.md5(os.path.abspath(path)) + '.pickle')
+
+  def last_signature(self):
+    return tools.text_load(self.sig_path) if os.path.exists(self.sig_path) else None
+
+  def scan(self):
+    ''' 更新 metadata 索引, 只重新读取 mtime 或 size 变化了的文件的 front matter '''
+    index = {}
+    dirty = False
+    for path in tools.all_files(self.watcher_path, patterns='*.md'):
+      stat = os.stat(path)
+      entry = self.index.get(path)
+      if entry and entry[:2] == (stat.st_mtime_ns, stat.st_size):
+        index[path] = entry
+        continue
+      try:
+        metadata = Page.convert_dict(tools.front_matter_load(path).strip())
+      except ValueError as e:
+        log_error(f'skip {path}: {e}')
+        continue
+      index[path] = (stat.st_mtime_ns, stat.st_size, metadata)
+      self.stats['metadata_load'] += 1
+      dirty = True
+    if dirty or len(index) != len(self.index):
+      pickle_save(self.index_path, index)
+    self.index = index
+    return index
+
+  def window(self, limit=150, order='edit_date'):
+    ''' 按 order 倒序排列的最新 limit 个页面 [(path, mtime_ns, metadata)], limit=-1 时为全部 '''
+    def sort_key(item):
+      metadata = item[1][2]
+      return metadata.get(order) or metadata.get('edit_date') or metadata.get('create_date') or ''
+    items = sorted(self.index.items(), key=sort_key, reverse=True)
+    if limit >= 0:
+      items = items[:limit]
+    return [(path, mtime, metadata) for path, (mtime, _, metadata) in items]
+
+  def page_html(self, path, mtime, metadata):
+    ''' 页面的 html, path mtime version 都未变时使用缓存 '''
+    key = (os.path.abspath(path), mtime, metadata.get('version'))
+    cached = pickle_load(self.html_path(path))
+    if cached and cached['key'] == key:
+      self.stats['html_hit'] += 1
+      return cached['html']
+    html = tools.clean_xml(Page.load(path).to_html())
+    pickle_save(self.html_path(path), {'key': key, 'html': html})
+    self.stats['html_render'] += 1
+    return html
+
+  def build(self, limit=150, order='edit_date', site=''):
+    ''' 生成 feed.xml, 返回路径 '''
+    with self.lock:
+      self.scan()
+      window = self.window(limit, order)
+      signature = tools.md5(repr((site, limit, order, [(os.path.abspath(path), mtime, metadata.get('version'))
+                                                      for path, mtime, metadata in window])))
+      if os.path.exists(self.feed_path) and self.last_signature() == signature:
+        self.stats['xml_hit'] += 1
+        if not self.etag:  # 旧版本的缓存没有压缩文件
+          with open(self.feed_path, 'rb') as f:
+            self.save_variants(f.read())
+        return self.feed_path
+
+      from feedgen.feed import FeedGenerator
+      feed_name = os.path.basename(os.path.normpath(self.watcher_path))
+      fg = FeedGenerator()
+      fg.id(site + feed_name)
+      fg.title(feed_name)
+      fg.subtitle('generated by The North Remembers')
+      fg.link(href=site + feed_name + '/feed', rel='self')  # 订阅源网站
+      fg.language('zh-cn')
+      for path, mtime, metadata in reversed(window):  # add_entry 插入到最前, 所以从旧到新添加
+        fe = fg.add_entry()
+        fe.id(metadata['url'])
+        fe.title(tools.clean_xml(metadata['title']))
+        fe.link(href=metadata['url'])
+        edit_date = metadata.get('edit_date') or metadata.get('create_date')
+        fe.published(edit_date + '+08:00')
+        # fe.updated(edit_date + '+08:00')  # 在这种 RSS 似乎不起作用
+        fe.description(self.page_html(path, mtime, metadata))
+
+      data = fg.rss_str(pretty=True)
+      temp_path = self.feed_path + '.tmp'
+      with open(temp_path, 'wb') as f:
+        f.write(data)
+      os.replace(temp_path, self.feed_path)
+      self.save_variants(data)
+      tools.text_save_atomic(self.sig_path, signature)
+      self.stats['xml_build'] += 1
+      return self.feed_path
+
+
+  def save_variants(self, data):
+    ''' 写入压缩文件和 etag, etag 最后写入, 存在 etag 即表示压缩文件已齐全 '''
+    if os.path.exists(self.etag_path):
+      os.remove(self.etag_path)
+    for encoding in FEED_ENCODINGS:
+      path = self.variant_path(encoding)
+      if encoding in supported_encodings():
+        with open(path + '.tmp', 'wb') as f:
+          f.write(compress(data, encoding))
+        os.replace(path + '.tmp', path)
+      elif os.path.exists(path):
+        os.remove(path)
+    tools.text_save_atomic(self.etag_path, hashlib.sha1(data).hexdigest()[:20])
+
+
+
+_builders = {}
+_builders_lock = threading.Lock()
+
+def feed_builder(watcher_path):
+  ''' 每个 watcher 目录一个 FeedBuilder, 进程内共用 '''
+  key = os.path.abspath(watcher_path)
+  with _builders_lock:
+    if key not in _builders:
+      _builders[key] = FeedBuilder(watcher_path)
+    return _builders[key]
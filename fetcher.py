@@ -2,49 +2,12 @@
 
 import os
 import re
+import importlib
 from enum import Enum
-from pyquery import PyQuery
-import requests
-
-from crawler.zhihu import fetch_zhihu_article
-from crawler.zhihu import zhihu_article_url
-from crawler.zhihu import yield_column_articles
-
-
-
-from crawler.zhihu import fetch_zhihu_answer
-from crawler.zhihu import zhihu_answer_url
-from crawler.zhihu import yield_author_answers
-from crawler.zhihu import zhihu_answer_title
-
-
-from crawler.zhihu import yield_topic_best_answers
-from crawler.zhihu import yield_author_articles
-from crawler.zhihu import yield_collection_answers
-from crawler.zhihu import yield_question_answers
-
-
-from crawler.zhihu import parse_topic
-from crawler.zhihu import parse_author
-from crawler.zhihu import parse_column
-from crawler.zhihu import parse_answer
-from crawler.zhihu import parse_article
-
-# from crawler.weixin import fetch_weixin_article_lister
-from crawler.weixin import fetch_weixin_article_page
-from crawler.wemp import fetch_wemp_page
-from crawler.wemp import fetch_wemp_lister
-from crawler.bilibili_read import fetch_bilibili_read_page
-from crawler.v2ex import fetch_v2ex_page
-
-
-from crawler.zhihu import ZhihuFetchError
 
 import pydantic 
 
 
-from crawler.common import common_get
-
 
 
 
@@ -56,9 +19,30 @@ log_error = create_logger(__file__ + '.error')
 
 
 
+class CrawlerBackend:
+  ''' crawler 下的站点模块, 第一次访问其属性时才导入
+      只抓取微信或 V2EX 的 watcher 不会导入 crawler.zhihu '''
+  def __init__(self, name):
+    self.name = name
+    self.module = None
+
+  def __getattr__(self, attr):
+    if self.module is None:
+      self.module = importlib.import_module('crawler.' + self.name)
+    return getattr(self.module, attr)
+
+zhihu = CrawlerBackend('zhihu')
+weixin = CrawlerBackend('weixin')
+wemp = CrawlerBackend('wemp')
+bilibili = CrawlerBackend('bilibili_read')
+v2ex = CrawlerBackend('v2ex')
+common = CrawlerBackend('common')
+
+
+
 
 class FetcherOption(pydantic.BaseModel):
-  save_attachments = True
+  save_attachments = False
   limit = 300
   min_voteup = 0
   min_thanks = 0
@@ -66,6 +50,7 @@ class FetcherOption(pydantic.BaseModel):
   title_not_contain: str = None
   body_contain: str = None
   body_not_contain: str = None
+  stop_after_known = 0   # 增量抓取 lister, 连续遇到 n 个已记录的页面就停止翻页, 0 表示不启用
 
   def patch(self, data):
     for k, v in data.items():
@@ -83,6 +68,7 @@ def extract_items_from_feed(content):
   # <link>xxx</link>
   # <description>...</description>
   # <pubDate>xxx</pubDate>
+  from pyquery import PyQuery  # pyquery 依赖 lxml, 载入较慢, 只在解析 feed 时导入
   if 'xml version' in content.splitlines()[0]: 
     # 去掉第一行 xml 声明 <?xml version="1.0" encoding="UTF-8"?>
     content = '\n'.join(content.splitlines()[1:])
@@ -268,15 +254,21 @@ class FetcherFilter:
 
 class Fetcher:
 
-  def __init__(self, url, option):
+  def __init__(self, url, option, known_urls=None):
     self.url = url
     self.option = option
+    self.known_urls = known_urls or set()  # 已记录的页面 url, 用于 lister 增量抓取
 
   @classmethod
-  def create(cls, url, fetcher_option):
+  def create(cls, url, fetcher_option, known_urls=None):
     if isinstance(fetcher_option, dict):
       fetcher_option = FetcherOption(**fetcher_option)
-    return cls(url=url, option=fetcher_option)
+    return cls(url=url, option=fetcher_option, known_urls=known_urls)
+
+  @property
+  def incremental_option(self):
+    ''' 传给 yield_* 的增量抓取参数 '''
+    return {'known_urls': self.known_urls, 'stop_after_known': self.option.stop_after_known}
 
 
   @classmethod
@@ -284,13 +276,13 @@ class Fetcher:
     ''' 从 url 生成 tip '''
     if parse_type(url) == UrlType.ZhihuAnswerLister:
       if '/topic/' in url:
-        topic = parse_topic(url)
+        topic = zhihu.parse_topic(url)
         log(f'generate_tip get {topic.name}')
         return '知乎话题 - ' + topic.name
       else:
         raise NotImplementedError()
     elif parse_type(url) == UrlType.ZhihuColumnLister:
-      column = parse_column(url)
+      column = zhihu.parse_column(url)
       log(f'generate_tip get {column.title}')
       return '知乎专栏 - ' + column.title
     else:
@@ -307,7 +299,7 @@ class Fetcher:
       if '/topic/' in urls[0]:
         topic_names = []
         for url in urls:
-          topic = parse_topic(url)
+          topic = zhihu.parse_topic(url)
           # log(f'generate_tip get {topic.name}')
           topic_names.append(topic.name)
         
@@ -317,7 +309,7 @@ class Fetcher:
     elif parse_type(urls[0]) == UrlType.ZhihuColumnLister:
       column_names = []
       for url in urls:
-        column = parse_column(url)
+        column = zhihu.parse_column(url)
         # log(f'generate_tip get {column.title}')
         column_names.append(column.title)
       return '知乎专栏 - ' + ', '.join(column_names)
@@ -336,6 +328,16 @@ class Fetcher:
     result = method()
     return result
 
+  def request_iter(self):
+    ''' 同 request, 但 lister 逐个 yield task desc, 调用方不必等整个列表取回
+        没有 iter_ 方法的类型退回 request() '''
+    url_type = parse_type(self.url)
+    method = getattr(self, 'iter_' + str(url_type).split('.')[-1], None)
+    if method:
+      return method()
+    result = self.request()
+    return iter(result if isinstance(result, list) else [result])
+
   def detect(self):
     ''' 获取主要参数, 如页面标题, 点赞数等, 尽量不抓取详细页面 '''
     url_type = parse_type(self.url)
@@ -343,30 +345,31 @@ class Fetcher:
     return method()
 
   def request_ZhihuColumnLister(self):
+    return list(self.iter_ZhihuColumnLister())
+
+  def iter_ZhihuColumnLister(self):
     ''' 以Zhihu专栏ID获取所有文章
         option 继承自该 task 自身属性
         过滤属性
         limit: 最多返回 n 个 task
         min_voteup: 赞同数超过 n'''
-    tasks_desc = []
     column_id = self.url.split('/')[-1]
     log(f'self.option {self.option}')
     limit = self.option.limit
     min_voteup = self.option.min_voteup
     # 专栏没有感谢 min_thanks = self.option.get('min_thanks', 0)
     log('request_ZhihuColumnLister column_id', column_id)
-    for article in yield_column_articles(column_id, limit=limit, min_voteup=min_voteup):
-      desc = {'url': zhihu_article_url(article),
+    for article in zhihu.yield_column_articles(column_id, limit=limit, min_voteup=min_voteup, **self.incremental_option):
+      desc = {'url': zhihu.zhihu_article_url(article),
               'tip': article.title + ' - ' + article.author.name, 
               }
       log('detect {} {}'.format(desc['url'], desc['tip']))
-      tasks_desc.append(desc)
-    return tasks_desc
+      yield desc
 
 
 
   def detect_ZhihuColumnLister(self):
-    c = parse_column(self.url)
+    c = zhihu.parse_column(self.url)
     description = c.description.replace('\n', ' ').strip()
     # 这个不准确 updated_time = tools.time_to_humanize(tools.time_from_stamp(c.updated_time))
 
@@ -375,7 +378,7 @@ class Fetcher:
     a_month_ago = tools.time_now().shift(days=-30)
     a_year_ago = tools.time_now().shift(days=-365)
     articles = []
-    for article in yield_column_articles(column_id, limit=999, min_voteup=0):
+    for article in zhihu.yield_column_articles(column_id, limit=999, min_voteup=0):
       updated_time = tools.time_from_stamp(article.updated_time)
       articles.append({'title': article.title, 'date': updated_time, 'voteup_count': article.voteup_count})
       if updated_time < a_year_ago and len(articles) > 3: break
@@ -393,54 +396,58 @@ class Fetcher:
 
 
   def request_ZhihuColumnPage(self):
-    data = fetch_zhihu_article(self.url)
+    data = zhihu.fetch_zhihu_article(self.url)
     return data
 
 
   def detect_ZhihuColumnPage(self):
-    article = parse_article(self.url)
+    article = zhihu.parse_article(self.url)
     return f'''知乎专栏文章 {article.title} {article.author.name} {article.column.title} {article.voteup_count}'''
 
 
 
   def request_ZhihuAnswerLister(self):
+    return list(self.iter_ZhihuAnswerLister())
+
+  def iter_ZhihuAnswerLister(self):
     ''' 从 question author topic collection 获取回答列表
         过滤属性包括
           limit: 最多返回 n 个 task
           min_voteup: 赞同数超过 n
     '''
-    tasks_desc = []
-    limit = self.option['limit']
-    min_voteup = self.option.get('min_voteup', 0)
-    min_thanks = self.option.get('min_thanks', 0)
-    banned_keywords = self.option.get('banned_keywords', '')
+    limit = self.option.limit
+    min_voteup = self.option.min_voteup
+    min_thanks = self.option.min_thanks
+    banned_keywords = getattr(self.option, 'banned_keywords', '')
+    incremental = self.incremental_option
     if '/question/' in self.url:
       question_id = int(self.url.split('/')[-1])
       log('request_ZhihuAnswerLister question_id', question_id)
-      iter_answers = yield_question_answers(question_id, limit=limit, min_voteup=min_voteup, min_thanks=min_thanks)
+      iter_answers = zhihu.yield_question_answers(question_id, limit=limit, min_voteup=min_voteup, min_thanks=min_thanks, 
+                                            **incremental)
     elif '/people/' in self.url:
       author_id = self.url.split('/')[-2]
       log('request_ZhihuAnswerLister author_id', author_id)
-      iter_answers = yield_author_answers(author_id, limit=limit, min_voteup=min_voteup, min_thanks=min_thanks)
+      iter_answers = zhihu.yield_author_answers(author_id, limit=limit, min_voteup=min_voteup, min_thanks=min_thanks, 
+                                          **incremental)
     elif '/topic/' in self.url:
       topic_id = int(self.url.split('/')[-2])
       log('request_ZhihuAnswerLister topic_id', topic_id)
-      iter_answers = yield_topic_best_answers(topic_id, limit=limit, min_voteup=min_voteup, min_thanks=min_thanks, 
-                                              banned_keywords=banned_keywords)
+      iter_answers = zhihu.yield_topic_best_answers(topic_id, limit=limit, min_voteup=min_voteup, min_thanks=min_thanks, 
+                                              banned_keywords=banned_keywords, **incremental)
     elif '/collection/' in self.url:
       collection_id = int(self.url.split('/')[-1])
       log('request_ZhihuAnswerLister collection_id', collection_id)
-      iter_answers = yield_collection_answers(collection_id, limit=limit, min_voteup=min_voteup, min_thanks=min_thanks)
+      iter_answers = zhihu.yield_collection_answers(collection_id, limit=limit, min_voteup=min_voteup, min_thanks=min_thanks, 
+                                              **incremental)
     else:
       raise NotImplementedError
 
     for answer in iter_answers:
-      desc = {'url': zhihu_answer_url(answer),
-              'tip': zhihu_answer_title(answer), }
+      desc = {'url': zhihu.zhihu_answer_url(answer),
+              'tip': zhihu.zhihu_answer_title(answer), }
       log('detect {} {}'.format(desc['url'], desc['tip']))
-      tasks_desc.append(desc)
-
-    return tasks_desc
+      yield desc
 
 
   def detect_ZhihuAnswerLister(self):
@@ -456,14 +463,14 @@ class Fetcher:
 
   def request_ZhihuAnswerPage(self):
     try:
-      data = fetch_zhihu_answer(self.url)
-    except ZhihuFetchError as e:
+      data = zhihu.fetch_zhihu_answer(self.url)
+    except zhihu.ZhihuFetchError as e:
       data = e.fake_data
     return data
 
 
   def detect_ZhihuAnswerPage(self):
-    answer = parse_answer(self.url)
+    answer = zhihu.parse_answer(self.url)
     topics = ', '.join(t.name for t in answer.question.topics)
     return f'''知乎回答 {answer.question.title} {topics}
     by {answer.author.name} {answer.voteup_count}赞 {answer.thanks_count}谢
@@ -474,7 +481,7 @@ class Fetcher:
     # self.url 为任何 RSSHub 微信公众号 feed 来源
     # feed 中 每个 item 的 link 为微信公众号页面永久链接
 
-    content = common_get(self.url)
+    content = common.common_get(self.url)
     result = list(extract_items_from_feed(content))
     for item in result:
       item['url'] = format_weixin_url(item['url'])
@@ -482,39 +489,42 @@ class Fetcher:
 
   def request_WeixinArticlePage(self):
     url = format_weixin_url(self.url)
-    data = fetch_weixin_article_page(url)
+    data = weixin.fetch_weixin_article_page(url)
     return data
 
 
   def request_WempPage(self):
-    html = common_get(self.url)
-    data = fetch_wemp_page(html)
+    html = common.common_get(self.url)
+    data = wemp.fetch_wemp_page(html)
     return data
 
   def request_WempLister(self):
-    def gen_wemp_item(url):
-      cur_page = 1
-      while True:
-        html = common_get(url + f'?page={cur_page}')
-        items = fetch_wemp_lister(html)
-        for item in items:
-          yield item
-        if len(items) < 10:
+    return list(self.iter_WempLister())
+
+  def iter_WempLister(self):
+    ''' 逐页读取, 取满 limit 个即停止, 不再请求下一页 '''
+    if self.option.limit <= 0:
+      return
+    count = 0
+    cur_page = 1
+    while True:
+      html = common.common_get(self.url + f'?page={cur_page}')
+      items = wemp.fetch_wemp_lister(html)
+      for item in items:
+        yield item
+        count += 1
+        if count >= self.option.limit:
           return
-        cur_page += 1
-
-    data = []
-    url = self.url
-    for item, _ in zip(gen_wemp_item(url), range(self.option.limit)):
-      data.append(item)
-    return data
+      if len(items) < 10:
+        return
+      cur_page += 1
 
 
 
   def request_BilibiliArticleLister(self):
     user_id = self.url.split('/')[3]
     api_url = f'https://api.bilibili.com/x/space/article?mid={user_id}&jsonp=jsonp&callback=__jp13'
-    result = common_get(api_url)
+    result = common.common_get(api_url)
     result = tools.json_loads(result[7:-1])
     return result['data']['articles']
 
@@ -522,13 +532,13 @@ class Fetcher:
   def request_BilibiliArticlePage(self):
     page_id = self.url.split('read/cv')[1]
     stats_url = f'https://api.bilibili.com/x/article/viewinfo?id={page_id}&mobi_app=pc&jsonp=jsonp'
-    html = common_get(self.url)
-    stats = tools.json_loads(common_get(stats_url))
-    data = fetch_bilibili_read_page(html, stats)
+    html = common.common_get(self.url)
+    stats = tools.json_loads(common.common_get(stats_url))
+    data = bilibili.fetch_bilibili_read_page(html, stats)
 
     return data
 
 
   def request_V2exPage(self):
-    data = fetch_v2ex_page(self.url)
+    data = v2ex.fetch_v2ex_page(self.url)
     return data
\ No newline at end of file
@@ -0,0 +1,198 @@
+'''
+后台任务队列, 用于 collector 的 Flask app 中耗时的抓取
+
+  queue = JobQueue(workers=4)
+  job = queue.submit('zhihu_answer', zhihu.fetch_zhihu_answer, url)   返回 job 状态 dict
+  queue.wait(job['id'], timeout=10)                                   最多等待 timeout 秒
+  queue.get(job['id'])                                                轮询
+
+submit 时给出 key (如 url), 同一 key 已有未完成的 job 时不再重复执行, 直接返回该 job (single-flight)
+只在进程内合并, 多进程部署时每个进程各自合并
+
+ResultCache 是进程内的 LRU 缓存, 条目超过 ttl 秒后失效, 用于缓存 job 结果
+
+job 状态 {'id', 'name', 'status', 'result', 'error', 'submit_time', 'finish_time'}
+  status 为 pending -> running -> done | failed
+每次状态变化都写入 JOB_ROOT/<id>.json, 以便多进程部署 (如 gunicorn -w 4) 时
+任意进程都能查询, result 需要能转为 json
+超过 ttl 秒的已完成 job 在 submit 时清理
+'''
+
+import os
+import json
+import time
+import uuid
+import threading
+from collections import Counter
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait as futures_wait
+
+import tools
+
+log = tools.create_logger(__file__)
+log_error = tools.create_logger(__file__ + '.error')
+
+
+JOB_ROOT = 'temp/jobs'
+JOB_TTL = 3600
+
+
+
+class JobQueue:
+  def __init__(self, workers=4, root=None, ttl=JOB_TTL):
+    self.root = root or JOB_ROOT
+    self.ttl = ttl
+    os.makedirs(self.root, exist_ok=True)
+    self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+    self.jobs = {}     # id => 状态 dict, 仅本进程提交的 job
+    self.futures = {}  # id => Future
+    self.inflight = {}  # key => 未完成的 job id
+    self.stats = Counter()
+    self.lock = threading.Lock()
+
+  def job_path(self, job_id):
+    return os.path.join(self.root, job_id + '.json')
+
+  def save(self, job):
+    tools.text_save_atomic(self.job_path(job['id']), json.dumps(job, ensure_ascii=False))
+
+  def update(self, job_id, **changes):
+    with self.lock:
+      job = self.jobs[job_id]
+      job.update(changes)
+      snapshot = dict(job)
+    self.save(snapshot)
+
+  def submit(self, name, func, *args, key=None, **kwargs):
+    ''' 返回 job 状态, 与已有 job 合并时带有 'coalesced': True '''
+    self.expire()
+    with self.lock:
+      if key is not None and key in self.inflight:
+        self.stats['coalesced'] += 1
+        return dict(self.jobs[self.inflight[key]], coalesced=True)
+      job_id = uuid.uuid4().hex
+      job = {'id': job_id, 'name': name, 'status': 'pending', 'result': None, 'error': None,
+             'submit_time': time.time(), 'finish_time': None}
+      self.jobs[job_id] = job
+      if key is not None:
+        self.inflight[key] = job_id
+      self.stats['submitted'] += 1
+      snapshot = dict(job)
+      self.save(snapshot)
+      # 在锁内创建 Future, 合并到这个 job 的 submit 之后 wait 总能找到它
+      self.futures[job_id] = self.executor.submit(self.run, job_id, func, args, kwargs, key)
+    return snapshot
+
+  def run(self, job_id, func, args, kwargs, key=None):
+    try:
+      self.update(job_id, status='running')
+      result = func(*args, **kwargs)
+    except Exception as e:
+      log_error(f'job {job_id} failed: {e!r}')
+      self.finish(job_id, key, status='failed', error=repr(e))
+    else:
+      self.finish(job_id, key, status='done', result=result)
+
+  def finish(self, job_id, key, **changes):
+    ''' 先记录结果再移出 inflight, 之后同一 key 的 submit 会重新执行
+        result 无法转为 json 时记为 failed, 记录出错也一定移出 inflight '''
+    try:
+      try:
+        self.update(job_id, finish_time=time.time(), **changes)
+      except (TypeError, ValueError) as e:
+        log_error(f'job {job_id} result is not json serializable: {e!r}')
+        self.update(job_id, status='failed', result=None, error=f'result is not json serializable: {e!r}')
+    finally:
+      with self.lock:
+        if key is not None and self.inflight.get(key) == job_id:
+          del self.inflight[key]
+
+  def get(self, job_id):
+    ''' 本进程的 job 直接返回, 否则读取 JOB_ROOT 中的记录, 不存在时返回 None '''
+    with self.lock:
+      if job_id in self.jobs:
+        return dict(self.jobs[job_id])
+    path = self.job_path(job_id)
+    if not os.path.exists(path):
+      return None
+    try:
+      return json.loads(tools.text_load(path))
+    except ValueError:  # 其他进程正在写入
+      return None
+
+  def wait(self, job_id, timeout=None):
+    ''' 等待 job 结束, 超时后返回当前状态 '''
+    future = self.futures.get(job_id)
+    if future:
+      futures_wait([future], timeout=timeout)
+    return self.get(job_id)
+
+  def expire(self):
+    ''' 清理超过 ttl 的已完成 job, 以及 JOB_ROOT 中超过 ttl 未更新的记录 (可能来自其他进程) '''
+    deadline = time.time() - self.ttl
+    with self.lock:
+      expired = [job_id for job_id, job in self.jobs.items()
+                 if job['finish_time'] and job['finish_time'] < deadline]
+      for job_id in expired:
+        del self.jobs[job_id]
+        self.futures.pop(job_id, None)
+      kept = set(self.jobs)
+    for entry in os.scandir(self.root):
+      job_id = entry.name[:-len('.json')]
+      if entry.name.endswith('.json') and job_id not in kept and entry.stat().st_mtime < deadline:
+        try:
+          os.remove(entry.path)
+        except FileNotFoundError:  # 其他进程已清理
+          pass
+
+  def shutdown(self, wait=True):
+    self.executor.shutdown(wait=wait)
+
+
+
+class ResultCache:
+  ''' 进程内的 LRU 缓存, 最多 max_items 条, 条目写入 ttl 秒后失效
+      stats 记录 hit miss 次数 '''
+  def __init__(self, max_items=256, ttl=600):
+    self.max_items = max_items
+    self.ttl = ttl
+    self.items = OrderedDict()  # key => (写入时间, value)
+    self.stats = Counter()
+    self.lock = threading.Lock()
+
+  def get(self, key, default=None):
+    with self.lock:
+      item = self.items.get(key)
+      if item is None or time.time() - item[0] >= self.ttl:
+        if item is not None:
+          del self.items[key]
+        self.stats['miss'] += 1
+        return default
+      self.items.move_to_end(key)
+      self.stats['hit'] += 1
+      return item[1]
+
+  def peek(self, key):
+    ''' 同 get, 但不计入 stats, 也不改变 LRU 顺序 '''
+    with self.lock:
+      item = self.items.get(key)
+    return item[1] if item and time.time() - item[0] < self.ttl else None
+
+  def age(self, key):
+    ''' 条目已缓存的秒数, 不存在时返回 None '''
+    with self.lock:
+      item = self.items.get(key)
+    return time.time() - item[0] if item else None
+
+  def put(self, key, value):
+    with self.lock:
+      self.items[key] = (time.time(), value)
+      self.items.move_to_end(key)
+      while len(self.items) > self.max_items:
+        self.items.popitem(last=False)
+    return value
+
+  def clear(self):
+    with self.lock:
+      self.items.clear()
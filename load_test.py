@@ -0,0 +1,87 @@
+'''
+本地压测 collector 的 Flask app, 统计每秒请求数和延迟分布
+
+  python load_test.py http://127.0.0.1:5000/<folder>/feed -n 500 -c 20
+  python load_test.py http://127.0.0.1:5000/api/zhihu/p/123?wait=0 -n 100 -c 10 -H 'Accept-Encoding: gzip'
+
+先用 gunicorn 或 python collector.py 启动服务
+'''
+
+import sys
+import time
+import argparse
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+
+def percentile(values, p):
+  if not values:
+    return 0.0
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run_load_test(url, total=200, concurrency=10, headers=None, timeout=60):
+  ''' 以 concurrency 个线程共发出 total 个 GET 请求, 返回统计 dict
+      每个线程使用自己的 Session, 复用连接 '''
+  local = threading.local()
+  latencies = []
+  statuses = Counter()
+  lock = threading.Lock()
+
+  def request_once(_):
+    if not hasattr(local, 'session'):
+      local.session = requests.Session()
+    start = time.perf_counter()
+    try:
+      status = local.session.get(url, headers=headers, timeout=timeout).status_code
+    except requests.RequestException as e:
+      status = type(e).__name__
+    elapsed = time.perf_counter() - start
+    with lock:
+      latencies.append(elapsed)
+      statuses[status] += 1
+
+  start = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=concurrency) as executor:
+    list(executor.map(request_once, range(total)))
+  duration = time.perf_counter() - start
+  return {'requests': total,
+          'concurrency': concurrency,
+          'duration': duration,
+          'rps': total / duration if duration else 0.0,
+          'p50': percentile(latencies, 50),
+          'p90': percentile(latencies, 90),
+          'p99': percentile(latencies, 99),
+          'max': max(latencies) if latencies else 0.0,
+          'statuses': dict(statuses)}
+
+
+def format_report(stats):
+  return (f"{stats['requests']} requests, concurrency {stats['concurrency']}, {stats['duration']:.2f}s\n"
+          f"  {stats['rps']:.1f} req/s\n"
+          f"  latency p50 {stats['p50'] * 1000:.1f}ms  p90 {stats['p90'] * 1000:.1f}ms  "
+          f"p99 {stats['p99'] * 1000:.1f}ms  max {stats['max'] * 1000:.1f}ms\n"
+          f"  status {stats['statuses']}")
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='collector 压测')
+  parser.add_argument('url')
+  parser.add_argument('-n', '--requests', type=int, default=200, help='请求总数')
+  parser.add_argument('-c', '--concurrency', type=int, default=10, help='并发数')
+  parser.add_argument('-H', '--header', action='append', default=[], help="如 'Accept-Encoding: gzip'")
+  args = parser.parse_args(argv)
+  headers = dict(h.split(':', 1) for h in args.header)
+  headers = {k.strip(): v.strip() for k, v in headers.items()}
+  stats = run_load_test(args.url, total=args.requests, concurrency=args.concurrency, headers=headers)
+  print(format_report(stats))
+  return 0 if all(isinstance(s, int) and s < 500 for s in stats['statuses']) else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -7,7 +7,6 @@ import shutil
 
 from urllib.parse import unquote
 
-from jinja2 import Template
 import re
 
 from tools import fix_md_title
@@ -23,9 +22,34 @@ from tools import create_logger
 log = create_logger(__file__)
 log_error = create_logger(__file__ + '.error')
 
-from markdown import markdown
-from mdx_gfm import GithubFlavoredMarkdownExtension
-import pygments
+# markdown, mdx_gfm, pygments, jinja2 只在渲染时用到, 在函数内导入, 只做调度的命令不必载入
+
+
+# 所有页面模板共用一个 jinja2 Environment, 每个模板在进程内只编译一次
+# 编译结果另存为字节码缓存, 下次启动也不必重新解析模板
+TEMPLATE_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'crawler')
+TEMPLATE_CACHE_ROOT = 'temp/jinja2_cache'
+_template_env = None
+
+def template_env():
+  global _template_env
+  if _template_env is None:
+    from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+    os.makedirs(TEMPLATE_CACHE_ROOT, exist_ok=True)
+    _template_env = Environment(loader=FileSystemLoader(TEMPLATE_ROOT),
+                                bytecode_cache=FileSystemBytecodeCache(TEMPLATE_CACHE_ROOT),
+                                auto_reload=False)
+  return _template_env
+
+def get_template(name):
+  ''' name 为 crawler/ 下的模板文件名 '''
+  return template_env().get_template(name)
+
+
+def content_hash(text):
+  ''' 忽略行尾空格和空行的差别后计算 hash '''
+  lines = [line.rstrip() for line in text.strip().splitlines() if line.strip()]
+  return tools.md5('\n'.join(lines), limit=16)
 
 
 class Page:
@@ -90,8 +114,9 @@ class Page:
   '''
   def __init__(self, data):
     self.metadata = data['metadata']
-    self.tmpl = ''  # should override
+    self.tmpl = ''  # should override, crawler/ 下的模板文件名
     self.data = {}  # should override
+    self._sections = None
 
   def __str__(self):
     title = self.metadata['title']
@@ -103,14 +128,22 @@ class Page:
   @property
   def full_text(self):
     ''' 完整的 md 文本, 
-        从本地文件 load 回来的 Page 的 data 里面自带 full_text
+        从本地文件 load 回来的 Page 首次访问时才读取全文
         新生成的 Page 对象需要 render 得到 full_text'''
+    if 'full_text' not in self.data and self.data.get('path'):
+      self.data['full_text'] = tools.text_load(self.data['path'])
     return self.data.get('full_text') or self.render(type='localfile')
   
   @property
   def sections(self):
-    ''' 截取页面中如 ## 评论: ## 正文: 的内容 '''
-    return tools.sections(self.full_text, is_title=lambda line: line.startswith('##'))
+    ''' 截取页面中如 ## 评论: ## 正文: 的内容
+        读盘的页面内容不会再变, 只切分一次 '''
+    if self._sections is not None:
+      return self._sections
+    result = tools.sections(self.full_text, is_title=lambda line: line.startswith('##'))
+    if self.data.get('from_disk'):
+      self._sections = result
+    return result
 
   @property    # 一些常用属性的快捷方式
   def version(self): return self.metadata['version']
@@ -178,15 +211,15 @@ class Page:
   def load(cls, path):
     ''' 从磁盘加载 Page
         用于比对页面是否有变化, 以及生成 RSS 等
-        比对页面是否有变化时, 只需要加载 title content 等少数内容, 评论等可以不加载 '''
+        比对页面是否有变化时, 只需要加载 title content 等少数内容, 评论等可以不加载
+        这里只读取开头的 metadata, 正文等到访问 full_text 时再读取 '''
     if not os.path.exists(path):
       raise ValueError('{} not found'.format(path))
-    txt = tools.text_load(path)
 
-    metadata = Page.convert_dict(txt.split('---')[1].strip())
+    metadata = Page.convert_dict(tools.front_matter_load(path).strip())
     data = {'folder': os.path.dirname(path), 
             'metadata': metadata, 
-            'full_text': txt,
+            'path': path,
             'from_disk': True,  # 从磁盘加载 Page 增加这个 key
             } 
     return cls.create(data)
@@ -196,6 +229,33 @@ class Page:
     ''' 比对一个page对象是否有变化 '''
     raise NotImplementedError # return self.metadata['title'] == other.metadata['title'] and self.data['content'] == other.data['content']
 
+  hash_fields = {'body': 'content'}  # 参与变化检测的内容, {名称: data 中的 key}
+
+  def hash_content(self, data):
+    ''' 计算 title 和正文等内容的 hash, 在 postprocess 最后调用
+        存入 task 后, 下次只需比对 hash, 不必读取上次的页面 '''
+    hashes = {'title': content_hash(data['metadata']['title'])}
+    for name, key in self.hash_fields.items():
+      hashes[name] = content_hash(data.get(key) or '')
+    return hashes
+
+  @property
+  def content_hashes(self):
+    ''' 读盘的页面没有 content_hashes, 返回 None '''
+    return self.data.get('content_hashes')
+
+  def changed_parts(self, old_hashes):
+    ''' 与 task 中记录的 hash 比对, 返回有变化的部分名称 '''
+    new_hashes = self.content_hashes or {}
+    return [name for name in new_hashes if new_hashes[name] != old_hashes.get(name)]
+
+  def diff(self, other=None):
+    ''' 按需生成与上次存档的 unified diff, other 缺省时读取 last_page_version '''
+    other = other or self.last_page_version
+    if not other:
+      return []
+    return tools.compare_text(other.full_text, self.full_text)
+
   @property
   def last_page_version(self):
     ''' 寻找上一次的页面存档 '''
@@ -206,7 +266,7 @@ class Page:
       return None
 
   def write(self):
-    '''存盘'''
+    '''存盘, 返回写入的路径'''
     if not os.path.exists(self.folder):
       raise FileNotFoundError('can not open folder {}'.format(self.folder))
     save_path = os.path.join(self.folder, self.filename)
@@ -219,13 +279,11 @@ class Page:
     # if fetch_images:
     #   # 本地存储, 需要抓取所有附图 TODO
     #   fetch_images_for_markdown(save_path)
-    # return save_path
+    return save_path
 
   def render(self, type='localfile'):
     if type == 'localfile':
-      tmpl = tools.text_load(self.tmpl)
-      rendered = Template(tmpl).render(data=self.data)
-      return rendered
+      return get_template(self.tmpl).render(data=self.data)
     else:
       raise NotImplementedError
 
@@ -246,6 +304,13 @@ class Page:
       with_style = convert_code_highlighting_style(code_block, lexer_name)
       return f"\n\n{with_style}\n\n"
 
+    import pygments
+    import pygments.lexers
+    import pygments.formatters
+    import pygments.util
+    from markdown import markdown
+    from mdx_gfm import GithubFlavoredMarkdownExtension
+
     def convert_code_highlighting_style(code_block, lexer_name):
       try:
         lexer = pygments.lexers.get_lexer_by_name(lexer_name)
@@ -325,7 +390,7 @@ class ZhihuColumnPage(Page):
   def __init__(self, data):
 
     super().__init__(data)
-    self.tmpl = 'crawler/zhihu_column_page.jinja2'
+    self.tmpl = 'zhihu_column_page.jinja2'
     if data.get('from_disk'):
       self.data = data
     else:
@@ -356,6 +421,7 @@ class ZhihuColumnPage(Page):
     content = fix_image_alt(content)
     content = fix_code_lang(content)
     data['content'] = content
+    data['content_hashes'] = self.hash_content(data)
     return data
 
 
@@ -376,9 +442,11 @@ class ZhihuAnswerPage(Page):
 
   '''
 
+  hash_fields = {'question': 'question_detail', 'body': 'answer'}
+
   def __init__(self, data):
     super().__init__(data)
-    self.tmpl = 'crawler/zhihu_answer_page.jinja2'
+    self.tmpl = 'zhihu_answer_page.jinja2'
 
     if data.get('from_disk'):  # from local load text
       self.data = data
@@ -415,6 +483,7 @@ class ZhihuAnswerPage(Page):
     answer = fix_image_alt(answer)
     answer = fix_code_lang(answer)
     data['answer'] = answer
+    data['content_hashes'] = self.hash_content(data)
     return data
 
 
@@ -427,7 +496,7 @@ class WeixinArticlePage(Page):
   '''抓取微信公众号页面'''
   def __init__(self, data):
     super().__init__(data)
-    self.tmpl = 'crawler/weixin_article_page.jinja2'
+    self.tmpl = 'weixin_article_page.jinja2'
     if data.get('from_disk'):
       self.data = data
     else:
@@ -458,12 +527,13 @@ class WeixinArticlePage(Page):
     # content = fix_image_alt(content)
     # content = fix_code_lang(content)
     # data['content'] = content
+    data['content_hashes'] = self.hash_content(data)
     return data
 
 class V2exPage(Page):
   def __init__(self, data):
     super().__init__(data)
-    self.tmpl = 'crawler/v2ex_page.jinja2'
+    self.tmpl = 'v2ex_page.jinja2'
     if data.get('from_disk'):
       self.data = data
     else:
@@ -477,4 +547,5 @@ class V2exPage(Page):
     # content = fix_image_alt(content)
     # content = fix_code_lang(content)
     # data['content'] = content
-    return data
\ No newline at end of file
+    data['content_hashes'] = self.hash_content(data)
+    return data
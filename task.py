@@ -33,6 +33,8 @@ from fetcher import Fetcher
 from fetcher import FetcherOption
 from datetime import date, datetime
 import pydantic 
+import heapq
+import itertools
 
 
 
@@ -88,6 +90,7 @@ class Task(pydantic.BaseModel):
   weight = 0.5               # 权重参数, 用于计算优先级
   enabled = True             # 启用/禁用 Task
   lazy_ratio = 1
+  content_hash : dict = None # 上次抓取内容的 hash, 如 {title: .., body: ..}, 用于检测变化
 
 
   min_cycle : str = None       # 由继承类处理
@@ -99,6 +102,13 @@ class Task(pydantic.BaseModel):
 
   # 来自Fetcher参数
   fetcher_option : FetcherOption
+  _scheduler = pydantic.PrivateAttr(default=None)  # 加入 TaskScheduler 后, 调度时间变化需通知它
+
+  def __setattr__(self, name, value):
+    super().__setattr__(name, value)
+    if name in ('next_watch_time', 'enabled') and self._scheduler is not None:
+      self._scheduler.update(self)
+
   @pydantic.validator('url')
   def url_should_valid(cls, v):
     v = v.strip()
@@ -170,6 +180,23 @@ class Task(pydantic.BaseModel):
         setattr(self, k, v)
 
 
+  def to_desc(self):
+    ''' 与 .tasks.yaml 中的一项等价的 dict, 可以再交给 Task.create, 用于 task journal '''
+    desc = {
+      'url': self.url,
+      'tip': self.tip,
+      'timestamp': {
+        'task_add': time_to_str(self.task_add_time),
+        'last_watch': time_to_str(self.last_watch_time) if self.last_watch_time else None,
+        'last_change': time_to_str(self.last_change_time) if self.last_change_time else None,
+        'next_watch': time_to_str(self.next_watch_time),
+      },
+      'version': self.version,
+    }
+    if self.content_hash:
+      desc['content_hash'] = dict(self.content_hash)
+    return desc
+
   def to_yaml_text(self):
     ''' 将 task 存为 yaml 文本片段
         需要缩减行数, 因此自定义格式化方案, 把timestamp放在同一行
@@ -189,6 +216,9 @@ class Task(pydantic.BaseModel):
         time_to_str(self.next_watch_time))
     result.append(timestamp)
     result.append('  version: ' + str(getattr(self, 'version')))
+    if self.content_hash:
+      hashes = ', '.join(f'{k}: "{v}"' for k, v in self.content_hash.items())
+      result.append('  content_hash: { ' + hashes + ' }')
     return '\n'.join(result)
 
   @property
@@ -273,6 +303,72 @@ class Task(pydantic.BaseModel):
 
 
 
+class TaskScheduler:
+  ''' 按 next_watch_time 排列的小顶堆, lister 和 page 各一个
+      task 的 next_watch_time 或 enabled 改变时, 由 Task.__setattr__ 通知更新
+      更新时只压入新的堆项, 旧堆项不删除, 出堆时发现已失效再丢弃
+      due() 只弹出已到时间的 k 个 task, 复杂度 O(k log n), 不必扫描全部 task '''
+  def __init__(self):
+    self.heaps = {'lister': [], 'page': []}
+    self.tasks = {}    # url => task
+    self.kinds = {}    # url => 'lister' | 'page'
+    self.entries = {}  # url => (stamp, seq), 当前有效的堆项
+    self.counter = itertools.count()
+
+  def __len__(self):
+    return len(self.tasks)
+
+  def add(self, task):
+    self.tasks[task.url] = task
+    self.kinds[task.url] = 'lister' if task.is_lister_type else 'page'
+    task._scheduler = self
+    self.update(task)
+
+  def remove(self, task):
+    self.tasks.pop(task.url, None)
+    self.entries.pop(task.url, None)
+    task._scheduler = None
+
+  def update(self, task):
+    url = task.url
+    if url not in self.tasks:
+      return
+    stamp = tools.time_to_stamp(task.next_watch_time)
+    seq = next(self.counter)
+    self.entries[url] = (stamp, seq)
+    heap = self.heaps[self.kinds[url]]
+    heapq.heappush(heap, (stamp, seq, url))
+    if len(heap) > 2 * len(self.entries) + 64:  # 失效的堆项太多时重建
+      self.rebuild()
+
+  def rebuild(self):
+    for kind in self.heaps:
+      self.heaps[kind] = [(stamp, seq, url) for url, (stamp, seq) in self.entries.items()
+                          if self.kinds[url] == kind]
+      heapq.heapify(self.heaps[kind])
+
+  def due(self, kind, now=None):
+    ''' 返回已到抓取时间且启用的 task, 按 priority 从高到低排列
+        task 仍留在堆中, 直到 schedule() 更新了 next_watch_time '''
+    deadline = tools.time_to_stamp(now or time_now()) + 1  # 同 should_fetch, 允许 1 秒误差
+    heap = self.heaps[kind]
+    popped = []
+    result = []
+    while heap and heap[0][0] <= deadline:
+      stamp, seq, url = heapq.heappop(heap)
+      if self.entries.get(url) != (stamp, seq):
+        continue  # 已失效的堆项
+      popped.append((stamp, seq, url))
+      task = self.tasks[url]
+      if task.enabled:
+        result.append(task)
+    for item in popped:
+      heapq.heappush(heap, item)
+    result.sort(key=lambda task: -task.priority)
+    return result
+
+
+
 # =========================================================
 # =================== end of class Task ===================
 # =========================================================
@@ -301,14 +397,21 @@ class ListerTask(Task):
     values['max_cycle'] = max_cycle 
     return values
 
-  def run(self):
-    '''执行一次抓取'''
+  def run(self, known_urls=None):
+    '''执行一次抓取, 返回全部 task desc 的列表
+       known_urls: 已记录的页面, fetcher_option.stop_after_known > 0 时用于增量抓取'''
+    return list(self.iter_run(known_urls))
+
+  def iter_run(self, known_urls=None):
+    '''同 run, 逐个 yield 探测到的 task desc, Watcher 可以边抓取边添加'''
     # 探测新的页面
     # log('Task.run lister request: {}'.format(str(self)))
-    fetcher = Fetcher.create(url=self.url, fetcher_option=self.fetcher_option.dict())
-    tasks_json = fetcher.request()
-    log('Task.run detect new tasks done: {} tasks'.format(len(tasks_json)))
-    return tasks_json
+    fetcher = Fetcher.create(url=self.url, fetcher_option=self.fetcher_option.dict(), known_urls=known_urls)
+    count = 0
+    for desc in fetcher.request_iter():
+      count += 1
+      yield desc
+    log('Task.run detect new tasks done: {} tasks'.format(count))
 
 
 
@@ -0,0 +1,288 @@
+'''
+Watcher 的 task 存储
+
+  YamlTaskStore    .tasks.yaml + .tasks.journal, 启动时载入并创建全部 Task (默认)
+  SqliteTaskStore  .tasks.sqlite, 以 url, next_watch_time, enabled 建索引,
+                   只有用到的 task (如已到抓取时间的) 才创建 Task 对象
+
+两者都提供以 url 为 key 的类似 dict 的只读接口, 以及
+  add(task)          加入新 task
+  save(task, op)     记录 task 的变化, op 为 add / schedule / patch
+  due(kind, now)     已到抓取时间的 lister 或 page task, 按 priority 排列
+  flush() close()    定期调用 / 每轮抓取结束时调用
+  import_yaml(path) export_yaml(path)  与 .tasks.yaml 格式互相转换
+'''
+
+import os
+import json
+import sqlite3
+
+import tools
+from tools import time_now
+from task import Task
+from task import TaskScheduler
+
+log = tools.create_logger(__file__)
+log_error = tools.create_logger(__file__ + '.error')
+
+
+
+def tasks_to_yaml_text(tasks):
+  ''' 按照添加顺序生成 .tasks.yaml 文本 '''
+  tasks = sorted(tasks, key=lambda t: t.task_add_time)
+  return ''.join(task.to_yaml_text() + '\n' for task in tasks)
+
+
+class TaskStore:
+  ''' task 存储的接口, Task 对象由 create_task 创建,
+      env_option 和 fetcher_option 来自 .config.yaml, 不存储 '''
+  def __init__(self, watcher_path, env_option=None, fetcher_option=None):
+    self.watcher_path = watcher_path
+    self.env_option = env_option or {}
+    self.fetcher_option = fetcher_option or {}
+
+  def create_task(self, desc):
+    return Task.create(desc, env_option=self.env_option, fetcher_option=self.fetcher_option)
+
+  @property
+  def yaml_path(self): return os.path.join(self.watcher_path, '.tasks.yaml')
+
+  def __len__(self): raise NotImplementedError
+  def __iter__(self): raise NotImplementedError   # 迭代 url
+  def get(self, url, default=None): raise NotImplementedError
+  def values(self): raise NotImplementedError     # 迭代全部 Task
+
+  def __contains__(self, url):
+    return self.get(url) is not None
+
+  def __getitem__(self, url):
+    task = self.get(url)
+    if task is None:
+      raise KeyError(url)
+    return task
+
+  def keys(self): return iter(self)
+
+  def listers(self):
+    return [task for task in self.values() if task.is_lister_type]
+
+  def add(self, task): raise NotImplementedError
+  def save(self, task, op): raise NotImplementedError
+  def due(self, kind, now=None): raise NotImplementedError
+  def flush(self): pass
+  def close(self): pass
+
+  @property
+  def paths(self): raise NotImplementedError   # 存储用到的文件, 用于 git 提交
+
+  def import_yaml(self, path=None):
+    ''' 从 .tasks.yaml 格式的文件导入, 已存在的 url 被覆盖, 返回导入数量 '''
+    path = path or self.yaml_path
+    items = tools.yaml_load(path) or []
+    for item in items:
+      self.save(self.create_task(item), 'add')
+    self.flush()
+    return len(items)
+
+  def export_yaml(self, path=None):
+    ''' 导出为 .tasks.yaml 格式 '''
+    path = path or self.yaml_path
+    tools.text_save_atomic(path=path, data=tasks_to_yaml_text(self.values()))
+    return path
+
+
+
+class YamlTaskStore(TaskStore):
+  ''' 全部 task 保存在 .tasks.yaml, 启动时一次载入, 由 TaskScheduler 索引
+      两次覆写 .tasks.yaml 之间, task 的变化逐条追加到 .tasks.journal
+      每条记录是 task 变化后的完整 desc, 重放时后者覆盖前者 '''
+  def __init__(self, watcher_path, env_option=None, fetcher_option=None, compact_size=200):
+    super().__init__(watcher_path, env_option, fetcher_option)
+    self.compact_size = compact_size  # journal 累积多少条记录后合并回 .tasks.yaml
+    self.tasks = {}
+    self.scheduler = TaskScheduler()
+    self.journal_size = 0
+    if os.path.exists(self.yaml_path):
+      for item in tools.yaml_load_snapshot(self.yaml_path) or []:
+        self.add(self.create_task(item))
+    if self.replay_journal():  # 上次运行没有合并 journal (比如中途退出), 这里合并
+      self.compact()
+
+  @property
+  def journal_path(self): return os.path.join(self.watcher_path, '.tasks.journal')
+
+  @property
+  def paths(self): return [self.yaml_path, self.journal_path]
+
+  def __len__(self): return len(self.tasks)
+  def __iter__(self): return iter(self.tasks)
+  def get(self, url, default=None): return self.tasks.get(url, default)
+  def values(self): return self.tasks.values()
+
+  def add(self, task):
+    old_task = self.tasks.get(task.url)
+    if old_task:
+      self.scheduler.remove(old_task)
+    self.tasks[task.url] = task
+    self.scheduler.add(task)
+
+  def save(self, task, op):
+    ''' patch 只改动来自 .config.yaml 的设置, 不需要记录 '''
+    if self.tasks.get(task.url) is not task:
+      self.add(task)
+    if op == 'patch':
+      return
+    record = json.dumps({'op': op, 'task': task.to_desc()}, ensure_ascii=False)
+    with open(self.journal_path, 'a', encoding='utf-8') as f:
+      f.write(record + '\n')
+    self.journal_size += 1
+
+  def replay_journal(self):
+    ''' 将 .tasks.journal 中的记录应用到已载入的 tasks, 返回记录条数
+        最后一行可能因为中途退出而不完整, 跳过 '''
+    if not os.path.exists(self.journal_path):
+      return 0
+    count = 0
+    for line in tools.text_load(self.journal_path).splitlines():
+      try:
+        desc = json.loads(line)['task']
+      except (ValueError, KeyError, TypeError):
+        log_error(f'skip broken journal record: {line[:80]}')
+        continue
+      self.add(self.create_task(desc))
+      count += 1
+    return count
+
+  def due(self, kind, now=None):
+    return self.scheduler.due(kind, now)
+
+  def flush(self):
+    if self.journal_size >= self.compact_size:
+      self.compact()
+
+  def close(self):
+    self.compact()
+
+  def compact(self):
+    ''' 覆写 .tasks.yaml, 先写临时文件再替换, 完成后清空 .tasks.journal
+        同时写入快照, 下次启动不必再解析 .tasks.yaml '''
+    self.export_yaml(self.yaml_path)
+    tools.yaml_snapshot_save(self.yaml_path, [task.to_desc() for task in self.values()])
+    if os.path.exists(self.journal_path):
+      os.remove(self.journal_path)
+    self.journal_size = 0
+
+
+
+class SqliteTaskStore(TaskStore):
+  ''' task 保存在 .tasks.sqlite, 每个 task 一行, desc 列为 Task.to_desc() 的 json
+      kind, enabled, next_watch_time 单独成列并建立索引, due() 直接查询已到时间的行
+      Task 对象在第一次用到时才创建, 之后缓存在 self.cache, 对同一 url 总是返回同一对象
+      首次打开时, 如果目录下已有 .tasks.yaml, 自动导入 '''
+  SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS tasks (
+      url TEXT PRIMARY KEY,
+      kind TEXT NOT NULL,
+      enabled INTEGER NOT NULL DEFAULT 1,
+      next_watch_time REAL NOT NULL,
+      task_add_time REAL NOT NULL,
+      desc TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS tasks_due ON tasks (kind, enabled, next_watch_time);
+    CREATE INDEX IF NOT EXISTS tasks_add_time ON tasks (task_add_time);
+  '''
+
+  def __init__(self, watcher_path, env_option=None, fetcher_option=None):
+    super().__init__(watcher_path, env_option, fetcher_option)
+    self.cache = {}  # url => Task
+    is_new = not os.path.exists(self.db_path)
+    self.db = sqlite3.connect(self.db_path)
+    self.db.execute('PRAGMA journal_mode=WAL')
+    self.db.execute('PRAGMA synchronous=NORMAL')
+    self.db.executescript(self.SCHEMA)
+    if is_new and os.path.exists(self.yaml_path):
+      count = self.import_yaml(self.yaml_path)
+      log(f'import {count} tasks from {self.yaml_path}')
+
+  @property
+  def db_path(self): return os.path.join(self.watcher_path, '.tasks.sqlite')
+
+  @property
+  def paths(self): return [self.db_path]  # -wal 是临时文件, flush 时合并回 db_path, 不提交
+
+  def __len__(self):
+    return self.db.execute('SELECT COUNT(*) FROM tasks').fetchone()[0]
+
+  def __iter__(self):
+    return (url for url, in self.db.execute('SELECT url FROM tasks ORDER BY task_add_time'))
+
+  def __contains__(self, url):
+    if url in self.cache:
+      return True
+    return self.db.execute('SELECT 1 FROM tasks WHERE url = ?', (url, )).fetchone() is not None
+
+  def materialize(self, url, desc):
+    task = self.cache.get(url)
+    if task is None:
+      task = self.cache[url] = self.create_task(json.loads(desc))
+    return task
+
+  def get(self, url, default=None):
+    if url in self.cache:
+      return self.cache[url]
+    row = self.db.execute('SELECT desc FROM tasks WHERE url = ?', (url, )).fetchone()
+    return self.materialize(url, row[0]) if row else default
+
+  def values(self):
+    rows = self.db.execute('SELECT url, desc FROM tasks ORDER BY task_add_time').fetchall()
+    return [self.materialize(url, desc) for url, desc in rows]
+
+  def listers(self):
+    rows = self.db.execute("SELECT url, desc FROM tasks WHERE kind = 'lister' ORDER BY task_add_time")
+    return [self.materialize(url, desc) for url, desc in rows.fetchall()]
+
+  @staticmethod
+  def to_row(task):
+    return (task.url,
+            'lister' if task.is_lister_type else 'page',
+            int(bool(task.enabled)),
+            tools.time_to_stamp(task.next_watch_time),
+            tools.time_to_stamp(task.task_add_time),
+            json.dumps(task.to_desc(), ensure_ascii=False))
+
+  def add(self, task):
+    self.save(task, 'add')
+
+  def save(self, task, op):
+    self.cache[task.url] = task
+    self.db.execute('INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?)', self.to_row(task))
+    if op != 'add':  # 批量 add 时在 flush() 统一提交
+      self.db.commit()
+
+  def import_yaml(self, path=None):
+    ''' 导入时不缓存 Task 对象, 全部行在一个事务中写入 '''
+    path = path or self.yaml_path
+    items = tools.yaml_load(path) or []
+    self.cache = {}
+    rows = (self.to_row(self.create_task(item)) for item in items)
+    with self.db:
+      self.db.executemany('INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?)', rows)
+    return len(items)
+
+  def due(self, kind, now=None):
+    deadline = tools.time_to_stamp(now or time_now()) + 1  # 同 should_fetch, 允许 1 秒误差
+    rows = self.db.execute('SELECT url, desc FROM tasks WHERE kind = ? AND enabled = 1 '
+                           'AND next_watch_time <= ?', (kind, deadline)).fetchall()
+    tasks = [self.materialize(url, desc) for url, desc in rows]
+    tasks = [task for task in tasks if task.enabled]
+    tasks.sort(key=lambda task: -task.priority)
+    return tasks
+
+  def flush(self):
+    ''' 提交后把 WAL 合并回 .tasks.sqlite 并清空, git 提交的 .tasks.sqlite 总是完整的 '''
+    self.db.commit()
+    self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+  def close(self):
+    self.flush()
+
@@ -0,0 +1,218 @@
+import os, sys
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parentdir)
+
+import time
+import threading
+import tools
+from pyshould import should
+import pytest
+import requests
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from crawler.common import AttachmentDownloader
+
+
+'''
+本地 http 服务作为图片服务器
+  /img/<name>     正常返回, 每次响应延迟 LATENCY 秒
+  /flaky/<name>   前两次返回 503
+  /missing/<name> 返回 404
+'''
+
+LATENCY = 0.1
+
+
+@pytest.fixture()
+def image_server():
+  state = {'requests': [], 'active': 0, 'max_active': 0, 'flaky': 0}
+  lock = threading.Lock()
+
+  class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    def log_message(self, *args): pass
+
+    def do_GET(self):
+      with lock:
+        state['requests'].append(self.path)
+        state['active'] += 1
+        state['max_active'] = max(state['max_active'], state['active'])
+      try:
+        time.sleep(LATENCY)
+        status = 200
+        if self.path.startswith('/missing/'):
+          status = 404
+        elif self.path.startswith('/flaky/'):
+          with lock:
+            state['flaky'] += 1
+            status = 503 if state['flaky'] <= 2 else 200
+        body = (f'image {self.path}' * 1000).encode() if status == 200 else b'error'
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+      finally:
+        with lock:
+          state['active'] -= 1
+
+  server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  state['root'] = f'http://127.0.0.1:{server.server_address[1]}'
+  yield state
+  server.shutdown()
+
+
+def test_1_download_retry(image_server, tmp_path):
+  downloader = AttachmentDownloader(workers=2, backoff=0.01)
+  path = str(tmp_path / 'a.jpg')
+  downloader.download(image_server['root'] + '/flaky/a.jpg', path) | should.equal(path)
+  tools.text_load(path).startswith('image /flaky/a.jpg') | should.be_true
+  dict(downloader.stats)                 | should.equal({'retried': 2, 'downloaded': 1})
+  downloader.download(image_server['root'] + '/flaky/a.jpg', path)  # 已存在, 不再下载
+  len(image_server['requests'])          | should.equal(3)
+  downloader.shutdown()
+
+
+def test_2_download_not_found(image_server, tmp_path):
+  downloader = AttachmentDownloader(workers=2, backoff=0.01)
+  with pytest.raises(requests.HTTPError):
+    downloader.download(image_server['root'] + '/missing/b.jpg', str(tmp_path / 'b.jpg'))
+  len(image_server['requests'])          | should.equal(1)  # 404 不重试
+  os.listdir(str(tmp_path))              | should.equal([])
+  downloader.shutdown()
+
+
+def test_3_download_concurrent(image_server, tmp_path):
+  downloader = AttachmentDownloader(workers=8)
+  start = time.monotonic()
+  futures = [downloader.submit(image_server['root'] + f'/img/{i}.jpg', str(tmp_path / f'{i}.jpg'))
+             for i in range(32)]
+  [f.result() for f in futures]
+  elapsed = time.monotonic() - start
+  downloader.shutdown()
+  print(f'32 images: {elapsed:.2f}s, serial {32 * LATENCY:.2f}s')
+  len(os.listdir(str(tmp_path)))         | should.equal(32)
+  (image_server['max_active'] <= 8)      | should.be_true
+  assert elapsed < 32 * LATENCY / 3
+
+
+def test_4_fetch_images_for_markdown(image_server, tmp_path):
+  from crawler import zhihu
+  class LocalDownloader(AttachmentDownloader):
+    ''' 把知乎图片地址映射到本地服务, pic1 的图片映射为 404 '''
+    def download(self, url, path, referer=None):
+      folder = 'missing' if '//pic1.' in url else 'img'
+      return super().download(f"{image_server['root']}/{folder}/{url.split('/')[-1]}", path, referer)
+
+  md_path = str(tmp_path / 'answer.md')
+  tools.text_save(md_path, '\n'.join([
+    '![](https://pic2.zhimg.com/v2-aaa.jpg)',
+    '![](https://pic3.zhimg.com/v2-bbb.png)',
+    '![](https://pic2.zhimg.com/v2-aaa.jpg)',
+    '![](https://pic1.zhimg.com/v2-ccc.jpg)',
+    '![](https://picx.example.com/v2-ddd.jpg)',
+  ]))
+  downloader = LocalDownloader(workers=4, backoff=0.01)
+  written = zhihu.fetch_images_for_markdown(md_path, downloader=downloader)
+  downloader.shutdown()
+  sorted(os.path.basename(p) for p in written) | should.equal(['answer.md', 'answer01.jpg', 'answer02.png'])
+  tools.text_load(md_path).splitlines()  | should.equal([
+    '![](answer01.jpg)',
+    '![](answer02.png)',
+    '![](answer01.jpg)',
+    '![](https://pic1.zhimg.com/v2-ccc.jpg)',   # 下载失败, 保留原链接
+    '![](https://picx.example.com/v2-ddd.jpg)',
+  ])
+
+
+def test_5_attachment_store(image_server, tmp_path):
+  from crawler import zhihu
+  from crawler.common import AttachmentStore
+  class LocalDownloader(AttachmentDownloader):
+    ''' v2-aaa 与 v2-bbb 映射为同一内容的图片 '''
+    def fetch(self, url, path, referer=None):
+      name = 'same.jpg' if url.split('/')[-1] in ('v2-aaa.jpg', 'v2-bbb.jpg') else url.split('/')[-1]
+      return super().fetch(f"{image_server['root']}/img/{name}", path, referer)
+
+  store = AttachmentStore(root=str(tmp_path / 'store'))
+  downloader = LocalDownloader(workers=4, store=store)
+  md_paths = []
+  for folder, urls in [('w1', ['v2-aaa.jpg', 'v2-bbb.jpg', 'v2-ccc.jpg']), ('w2', ['v2-aaa.jpg'])]:
+    os.makedirs(str(tmp_path / folder))
+    md_path = str(tmp_path / folder / 'page.md')
+    tools.text_save(md_path, '\n'.join(f'![](https://pic2.zhimg.com/{url})' for url in urls))
+    zhihu.fetch_images_for_markdown(md_path, downloader=downloader)
+    md_paths.append(md_path)
+  downloader.shutdown()
+
+  len(image_server['requests'])          | should.equal(3)  # w2 的 v2-aaa 不再下载
+  dict(store.stats)                      | should.equal({'fetched': 3, 'deduplicated': 1, 'reused': 1})
+  len(store.index['refs'])               | should.equal(2)  # v2-aaa 与 v2-bbb 内容相同, 只存一份
+  os.path.samefile(str(tmp_path / 'w1' / 'page01.jpg'), str(tmp_path / 'w2' / 'page01.jpg')) | should.be_true
+  os.path.samefile(str(tmp_path / 'w1' / 'page01.jpg'), str(tmp_path / 'w1' / 'page02.jpg')) | should.be_true
+  tools.json_load(store.index_path)      | should.equal(store.index)
+
+  os.remove(str(tmp_path / 'w1' / 'page03.jpg'))
+  store.gc()                             | should.equal(1)
+  len(store.index['refs'])               | should.equal(1)
+  len(store.index['urls'])               | should.equal(2)
+  for name in ['w1/page01.jpg', 'w1/page02.jpg', 'w2/page01.jpg']:
+    os.remove(str(tmp_path / name))
+  store.gc()                             | should.equal(1)
+  store.index                            | should.equal({'urls': {}, 'refs': {}})
+
+
+def test_6_attachment_store_cross_device(tmp_path, monkeypatch):
+  ''' 页面目录与 store 不在同一分区: os.replace 和 os.link 跨越 store 目录时报 EXDEV '''
+  import errno
+  from crawler.common import AttachmentStore
+  store_root = str(tmp_path / 'store')
+  inside = lambda path: os.path.abspath(path).startswith(store_root)
+  real_replace = os.replace
+  def replace(src, dst):
+    if inside(src) != inside(dst):
+      raise OSError(errno.EXDEV, 'Invalid cross-device link')
+    return real_replace(src, dst)
+  def link(src, dst):
+    raise OSError(errno.EXDEV, 'Invalid cross-device link')
+  monkeypatch.setattr(os, 'replace', replace)
+  monkeypatch.setattr(os, 'link', link)
+
+  store = AttachmentStore(root=store_root)
+  page_folder = tmp_path / 'w1'
+  page_folder.mkdir()
+  image = str(page_folder / 'page01.jpg')
+  with open(image, 'wb') as f:
+    f.write(b'old image')
+  store.link_url('https://pic2.zhimg.com/v2-old.jpg', image, fetch=None)  # 导入已有文件
+  def fetch(path):
+    with open(path, 'wb') as f:
+      f.write(b'new image')
+  store.link_url('https://pic2.zhimg.com/v2-new.jpg', str(page_folder / 'page02.jpg'), fetch)
+
+  sorted(os.listdir(str(page_folder)))   | should.equal(['page01.jpg', 'page02.jpg'])  # 没有残留的 .part
+  dict(store.stats)                      | should.equal({'imported': 1, 'fetched': 1})
+  len(store.index['refs'])               | should.equal(2)
+
+  # 复制得到的附件被改动 (大小不变) 后不再算作引用
+  with open(image, 'wb') as f:
+    f.write(b'edited!!!')
+  store.gc()                             | should.equal(1)
+  len(store.index['refs'])               | should.equal(1)
+
+
+def test_7_watcher_attachments_only_for_zhihu(tmp_path):
+  ''' save_attachments 默认关闭, 非知乎页面不提交下载, 也不载入 crawler.zhihu '''
+  import subprocess
+  from fetcher import FetcherOption
+  FetcherOption().save_attachments | should.be_false
+  code = ('import sys, os, tools; from watcher import Watcher; from test_watcher import CONFIGDATA\n'
+          f'path = {str(tmp_path / "w")!r}; os.makedirs(path)\n'
+          'tools.text_save(path + "/.config.yaml", CONFIGDATA)\n'
+          'w = Watcher.open(path)\n'
+          'print(w.save_attachments(path + "/a.md", "https://wemp.app/posts/abc"), '
+          'w._attachment_executor, "crawler.zhihu" in sys.modules)\n')
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join([parentdir, os.path.dirname(__file__)]))
+  out = subprocess.run([sys.executable, '-c', code], cwd=parentdir, env=env,
+                       capture_output=True, text=True, check=True).stdout
+  out.split() | should.equal(['None', 'None', 'False'])
@@ -3,6 +3,7 @@ import os, sys
 parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) 
 sys.path.insert(0, parentdir)
 
+import time
 import tools
 from pyshould import should
 import pytest
@@ -600,4 +601,92 @@ def test_5_detect_pythons_trim_leading_spaces():
 
 
 # 总结:
-# guess_lang (with tersorflow) 加上除去行首空格, 效果最好, 但还是有误判
\ No newline at end of file
+# guess_lang (with tersorflow) 加上除去行首空格, 效果最好, 但还是有误判
+
+
+
+class FakeDetector:
+  ''' 代替 guesslang.Guess, 记录被调用的次数 '''
+  def __init__(self):
+    self.calls = []
+  def language_name(self, code):
+    self.calls.append(code)
+    return 'Python' if 'def ' in code else 'JavaScript'
+
+
+@pytest.fixture()
+def fake_detector(monkeypatch):
+  detector = FakeDetector()
+  monkeypatch.setattr(tools, '_guesslang_detector', detector)
+  monkeypatch.setattr(tools, '_guess_lang_memo', tools.OrderedDict())
+  monkeypatch.setattr(tools, 'GUESS_LANG_HEURISTIC', False)
+  return detector
+
+
+def test_6_guess_langs_memo(fake_detector):
+  codes = ['def f(): pass', 'var a = 1;', 'def f(): pass']
+  tools.guess_langs(codes)            | should.equal(['python', 'javascript', 'python'])
+  len(fake_detector.calls)            | should.equal(2)   # 同一批中相同代码只检测一次
+  tools.guess_lang('var a = 1;')      | should.equal('javascript')
+  len(fake_detector.calls)            | should.equal(2)   # 已记忆, 不再调用模型
+  tools.guess_lang('   ')             | should.equal('text')
+
+
+def test_7_fix_code_lang_batch(fake_detector):
+  mdtxt = 'text\n\n    def f():\n        pass\n\ntext2\n\n    var a = 1;\n'
+  result = tools.fix_code_lang(mdtxt)
+  result | should.equal('text\n\n```python\n    def f():\n        pass\n```\n\ntext2\n\n```js\n    var a = 1;\n```')
+
+
+
+# 以 `# 注释` 开头的代码, 不应被认作 markdown 标题
+commented_codes = [
+  ('# comment\nx = compute(y)\n', 'python'),
+  ('# config\nport: 8080\nhost: localhost', 'yaml'),
+  ('# 安装依赖\npip install requests\npip install lxml', 'shell'),
+  ('# comment\nimport os\nimport sys', 'python'),
+]
+
+def labeled_corpus():
+  corpus = [(code, 'markdown') for code in mds]
+  corpus += [(code, 'javascript') for code in javascripts]
+  corpus += [(code, 'python') for code in pythons]
+  corpus += commented_codes
+  return corpus + [(trim_leading_spaces(code), lang) for code, lang in corpus]
+
+
+def test_8_heuristic_accuracy():
+  corpus = labeled_corpus()
+  answers = [(tools.guess_lang_heuristic(code), lang) for code, lang in corpus]
+  confident = [(guess, lang) for guess, lang in answers if guess]
+  wrong = [(guess, lang) for guess, lang in confident if guess != lang]
+  # 规则给出的结果都应正确, 只有提示符一行的 `❯ pip install ...` (标记为 python) 交给模型
+  wrong                                          | should.equal([])
+  tools.guess_lang_heuristic('    ❯ pip install "celery[redis]"') | should.be_none
+  tools.guess_lang_heuristic('$ cd proj\n$ ls -al')               | should.equal('shell')
+  (len(confident) / len(corpus) >= 0.75)         | should.be_true
+  tools.guess_lang_heuristic('elm.textContent = vnode.text;') | should.be_none  # 不确定的交给模型
+  tools.guess_lang_heuristic('{"a": [1, 2]}')    | should.equal('json')
+  [tools.guess_lang_heuristic(code) for code, _ in commented_codes] | should.equal([None, None, 'shell', 'python'])
+  tools.guess_lang_heuristic('# 标题\n\n- 第一条\n- 第二条') | should.equal('markdown')
+
+
+def test_9_heuristic_speed():
+  codes = [code for code, lang in labeled_corpus()]
+  start = time.perf_counter()
+  for code in codes * 20:
+    tools.guess_lang_heuristic(code)
+  per_code = (time.perf_counter() - start) / (len(codes) * 20)
+  print(f'guess_lang_heuristic: {per_code * 1000:.3f} ms per code')
+  (per_code < 0.01)                              | should.be_true  # 模型调用通常在几十毫秒以上
+
+
+def test_10_guess_langs_tiers(fake_detector, monkeypatch):
+  monkeypatch.setattr(tools, 'GUESS_LANG_HEURISTIC', True)
+  codes = ['function f() {\n  return 1;\n}', '>>> 1 + 1\n2', 'x']
+  tools.guess_langs(codes)                       | should.equal(['javascript', 'python', 'javascript'])
+  fake_detector.calls                            | should.equal(['x'])  # 规则确定的不再调用模型
+
+  monkeypatch.setattr(tools, '_guesslang_detector', False)  # 未安装 guesslang
+  monkeypatch.setattr(tools, 'guess_lang_pygments', lambda code: 'text')
+  tools.guess_langs(['y', 'def f():\n  pass'])  | should.equal(['text', 'python'])
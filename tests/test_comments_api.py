@@ -0,0 +1,165 @@
+import os, sys 
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) 
+sys.path.insert(0, parentdir)
+
+import re
+import time
+import tools
+from pyshould import should
+import pytest
+
+from crawler import zhihu
+
+
+'''
+以 api v4 格式的评论分页作为 fixture, 替换掉 zhihu_detect_with_client,
+每次请求模拟 LATENCY 秒的网络延迟, 比较逐页抓取和并发抓取的耗时
+'''
+
+LATENCY = 0.05
+
+
+def make_root_comment(cid):
+  return {'id': cid, 'vote_count': cid % 7, 'child_comment_count': 0, 'child_comments': [],
+          'featured': False, 'created_time': 1437720487 + cid, 'content': f'comment {cid}'}
+
+
+def make_comment_pages(totals, with_totals=True):
+  ''' 返回 {offset: page_json}, 与 root_comments?limit=20&offset=xx 的返回结构一致 '''
+  pages = {}
+  for offset in range(0, max(totals, 1), 20):
+    data = [make_root_comment(cid) for cid in range(offset, min(offset + 20, totals))]
+    paging = {'is_start': offset == 0, 'is_end': offset + 20 >= totals}
+    if with_totals:
+      paging['totals'] = totals
+    pages[offset] = {'data': data, 'paging': paging}
+  return pages
+
+
+class FakeResponse:
+  def __init__(self, data):
+    self.data = data
+  def json(self):
+    return self.data
+
+
+class FakeAnswer:
+  ''' get_comments_api_v4 以 __class__.__name__ 区分回答和文章 '''
+  def __init__(self, id):
+    self.id = id
+FakeAnswer.__name__ = 'Answer'
+
+
+@pytest.fixture()
+def comment_server(monkeypatch):
+  requested = []
+  def install(pages):
+    def fake_detect(url):
+      offset = int(re.search(r'offset=(\d+)', url).group(1))
+      requested.append(offset)
+      time.sleep(LATENCY)
+      return FakeResponse(pages.get(offset, {'data': [], 'paging': {'is_end': True}}))
+    monkeypatch.setattr(zhihu, 'zhihu_detect_with_client', fake_detect)
+    monkeypatch.setattr(tools, 'time_random_sleep', lambda *args: None)
+    return requested
+  return install
+
+
+def test_1_comments_keep_order(comment_server):
+  comment_server(make_comment_pages(205))
+  comments = zhihu.get_comments_api_v4(FakeAnswer(1), concurrency=8)
+  [c['id'] for c in comments] | should.equal(list(range(205)))
+
+
+def test_2_comments_without_totals(comment_server):
+  requested = comment_server(make_comment_pages(65, with_totals=False))
+  comments = zhihu.get_comments_api_v4(FakeAnswer(1), concurrency=8)
+  [c['id'] for c in comments] | should.equal(list(range(65)))
+  requested | should.equal([0, 20, 40, 60])
+
+
+def test_3_comments_respect_limit(comment_server):
+  requested = comment_server(make_comment_pages(500))
+  comments = zhihu.get_comments_api_v4(FakeAnswer(1), limit=100, concurrency=8)
+  len(comments) | should.equal(100)
+  sorted(requested) | should.equal([0, 20, 40, 60, 80])
+
+
+def test_4_benchmark_comments(comment_server):
+  comment_server(make_comment_pages(2000))
+  start = time.monotonic()
+  serial = zhihu.get_comments_api_v4(FakeAnswer(1), concurrency=1)
+  serial_time = time.monotonic() - start
+  start = time.monotonic()
+  concurrent = zhihu.get_comments_api_v4(FakeAnswer(1), concurrency=8)
+  concurrent_time = time.monotonic() - start
+  print(f'2000 comments: serial {serial_time:.2f}s, concurrency=8 {concurrent_time:.2f}s')
+  concurrent | should.equal(serial)
+  assert concurrent_time < serial_time / 3
+
+
+
+
+def make_child_comment(root_id, cid, vote_count):
+  author = {'member': {'id': f'a{cid}', 'name': f'user{cid}', 'url_token': f'user-{cid}'}, 'role': 'normal'}
+  return {'id': root_id * 10000 + cid, 'vote_count': vote_count, 'created_time': 1437720487 + cid,
+          'content': f'child {cid}', 'author': author}
+
+
+def make_conversation(root_id, child_count):
+  root = make_root_comment(root_id)
+  root['author'] = {'member': {'id': f'r{root_id}', 'name': f'root{root_id}', 'url_token': 'r'}, 'role': 'normal'}
+  root['vote_count'] = 100 + root_id
+  root['child_comment_count'] = child_count
+  children = [make_child_comment(root_id, cid, vote_count=cid % 13) for cid in range(child_count)]
+  root['child_comments'] = children[:2]
+  return root, children
+
+
+@pytest.fixture()
+def child_comment_server(monkeypatch):
+  state = {'in_flight': 0, 'max_in_flight': 0, 'requested': []}
+  import threading
+  lock = threading.Lock()
+  def install(children_by_root):
+    def fake_detect(url):
+      root_id = int(re.search(r'comments/(\d+)/child_comments', url).group(1))
+      offset = int(re.search(r'offset=(\d+)', url).group(1))
+      with lock:
+        state['in_flight'] += 1
+        state['max_in_flight'] = max(state['max_in_flight'], state['in_flight'])
+        state['requested'].append((root_id, offset))
+      time.sleep(LATENCY)
+      with lock:
+        state['in_flight'] -= 1
+      children = children_by_root[root_id]
+      return FakeResponse({'data': children[offset:offset + 20],
+                           'paging': {'is_end': offset + 20 >= len(children), 'totals': len(children)}})
+    monkeypatch.setattr(zhihu, 'zhihu_detect_with_client', fake_detect)
+    monkeypatch.setattr(tools, 'time_random_sleep', lambda *args: None)
+    return state
+  return install
+
+
+def test_5_child_comments_expand_concurrently(child_comment_server):
+  comment_list, children_by_root = [], {}
+  for root_id, count in [(1, 2), (2, 45), (3, 60), (4, 30)]:
+    root, children = make_conversation(root_id, count)
+    comment_list.append(root)
+    children_by_root[root_id] = children
+  state = child_comment_server(children_by_root)
+  result = zhihu.get_valuable_conversations_api_v4(comment_list, root_limit=10, child_limit=8, concurrency=2)
+  len(result) | should.equal(4)
+  assert state['max_in_flight'] <= 2
+  assert all(root_id != 1 for root_id, _ in state['requested'])  # 没被截断的会话组不需要追踪
+  # 选出的是赞数最高的 8 条, 按时间排序
+  conversation = [c for c in result if c.cid == 3][0]
+  top8 = sorted(children_by_root[3], key=lambda c: -c['vote_count'])[:8]
+  [c.cid for c in conversation.child_comments] | should.equal([c['id'] for c in sorted(top8, key=lambda c: c['created_time'])])
+
+
+def test_6_child_comments_scan_limit(child_comment_server):
+  root, children = make_conversation(1, 2000)
+  state = child_comment_server({1: children})
+  zhihu.get_valuable_conversations_api_v4([root], child_limit=8, child_scan_limit=100)
+  sorted(offset for _, offset in state['requested']) | should.equal([0, 20, 40, 60, 80])
@@ -0,0 +1,146 @@
+import os, sys 
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) 
+sys.path.insert(0, parentdir)
+
+import time
+import tools
+from pyshould import should
+import pytest
+
+from feed import FeedBuilder
+
+
+
+def write_page(folder, index, edit_date, version=1, body='正文'):
+  path = os.path.join(str(folder), f'answer {index}.md')
+  text = ('---\n'
+          f'title: 问题 {index}\n'
+          f'url: https://www.zhihu.com/question/{index}/answer/{index}\n'
+          f'version: {version}\n'
+          f'edit_date: {edit_date}\n'
+          '---\n\n'
+          f'## 回答:\n\n{body} {index}\n')
+  tools.text_save(path, text)
+  return path
+
+
+@pytest.fixture()
+def watcher_folder(tmp_path):
+  folder = tmp_path / 'watcher'
+  folder.mkdir()
+  for i in range(10):
+    write_page(folder, i, f'2020-01-{i + 1:02d} 10:00:00')
+  return folder
+
+
+def test_1_window_newest_pages(watcher_folder, tmp_path):
+  builder = FeedBuilder(str(watcher_folder), cache_root=str(tmp_path / 'cache'))
+  feed_path = builder.build(limit=3)
+  xml = tools.text_load(feed_path)
+  for i in (7, 8, 9):
+    (f'问题 {i}' in xml) | should.be_true
+  ('问题 6' in xml) | should.be_false
+  (xml.index('问题 9') < xml.index('问题 7')) | should.be_true  # 新的在前
+  builder.stats['html_render'] | should.equal(3)
+  builder.stats['metadata_load'] | should.equal(10)
+
+
+def test_2_reuse_xml_and_html(watcher_folder, tmp_path):
+  builder = FeedBuilder(str(watcher_folder), cache_root=str(tmp_path / 'cache'))
+  feed_path = builder.build(limit=3)
+  mtime = os.stat(feed_path).st_mtime_ns
+  builder.build(limit=3) | should.equal(feed_path)
+  builder.stats['xml_hit'] | should.equal(1)
+  os.stat(feed_path).st_mtime_ns | should.equal(mtime)
+
+  # 窗口外的页面变化, 不重新生成
+  time.sleep(0.01)
+  write_page(watcher_folder, 0, '2020-01-01 10:00:00', version=2, body='改动')
+  builder.build(limit=3)
+  builder.stats['xml_hit'] | should.equal(2)
+
+  # 窗口内的页面变化, 只重新渲染这一页
+  write_page(watcher_folder, 8, '2020-01-09 10:00:00', version=2, body='改动')
+  builder.build(limit=3)
+  builder.stats['xml_build'] | should.equal(2)
+  builder.stats['html_render'] | should.equal(4)
+  builder.stats['html_hit'] | should.equal(2)
+  ('改动 8' in tools.text_load(feed_path)) | should.be_true
+
+
+def test_3_cache_survives_restart(watcher_folder, tmp_path):
+  cache_root = str(tmp_path / 'cache')
+  FeedBuilder(str(watcher_folder), cache_root=cache_root).build(limit=5)
+  write_page(watcher_folder, 10, '2020-02-01 10:00:00')
+  builder = FeedBuilder(str(watcher_folder), cache_root=cache_root)
+  builder.build(limit=5)
+  builder.stats['metadata_load'] | should.equal(1)
+  builder.stats['html_render'] | should.equal(1)
+  builder.stats['html_hit'] | should.equal(4)
+  ('问题 10' in tools.text_load(builder.feed_path)) | should.be_true
+
+
+def test_4_precompressed_variants(watcher_folder, tmp_path):
+  import gzip
+  builder = FeedBuilder(str(watcher_folder), cache_root=str(tmp_path / 'cache'))
+  feed_path = builder.build(limit=3)
+  etag = builder.etag
+  ('gzip' in builder.encodings) | should.be_true
+  with open(feed_path, 'rb') as f, open(builder.variant_path('gzip'), 'rb') as g:
+    gzip.decompress(g.read()) | should.equal(f.read())
+
+  builder.build(limit=3)
+  builder.etag | should.equal(etag)
+  write_page(watcher_folder, 9, '2020-01-10 10:00:00', version=2, body='改动')
+  builder.build(limit=3)
+  builder.etag | should.not_equal(etag)
+
+
+@pytest.fixture()
+def feed_client(watcher_folder, tmp_path, monkeypatch):
+  ''' 用临时目录替换 feed 缓存, 以 FeedBuilder 代替 Collector '''
+  import feed
+  import collector
+  class FakeCollector:
+    def to_rss_feed(self, folder, limit=150, order='edit_date', site=''):
+      return feed.feed_builder(str(watcher_folder)).build(limit=limit, order=order, site=site)
+  monkeypatch.setattr(feed, 'FEED_CACHE_ROOT', str(tmp_path / 'cache'))
+  monkeypatch.setattr(feed, '_builders', {})
+  monkeypatch.setattr(collector, 'col', FakeCollector(), raising=False)
+  return collector.app.test_client()
+
+
+def test_5_feed_route_conditional_get(feed_client):
+  import gzip
+  response = feed_client.get('/watcher/feed?limit=3', headers={'Accept-Encoding': 'gzip'})
+  response.status_code | should.equal(200)
+  response.headers['Content-Encoding'] | should.equal('gzip')
+  response.headers['Vary'] | should.equal('Accept-Encoding')
+  ('问题 9' in gzip.decompress(response.data).decode('utf-8')) | should.be_true
+  etag = response.headers['ETag']
+
+  response = feed_client.get('/watcher/feed?limit=3', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+  response.status_code | should.equal(304)
+  response.data | should.equal(b'')
+
+  # 不接受压缩时发送原文, ETag 不同
+  response = feed_client.get('/watcher/feed?limit=3', headers={'Accept-Encoding': 'identity', 'If-None-Match': etag})
+  response.status_code | should.equal(200)
+  response.headers.get('Content-Encoding') | should.be_none
+  ('问题 9' in response.data.decode('utf-8')) | should.be_true
+  response.headers['ETag'] | should.not_equal(etag)
+
+
+def test_6_feed_route_bad_limit(feed_client, monkeypatch):
+  import collector
+  limits = []
+  real_col = collector.col
+  class RecordingCollector:
+    def to_rss_feed(self, folder, limit=150, **kwargs):
+      limits.append(limit)
+      return real_col.to_rss_feed(folder, limit=limit, **kwargs)
+  monkeypatch.setattr(collector, 'col', RecordingCollector())
+  monkeypatch.setattr(collector, 'FEED_LIMIT_MAX', 5)
+  [feed_client.get(f'/watcher/feed?limit={limit}').status_code
+   for limit in ['abc', '100000', '-1', '3']] | should.equal([200] * 4)
+  limits | should.equal([5, 5, 1, 3])
@@ -191,4 +191,13 @@ def test_6_fetch_bilibili_article_page():
 
 
 # def test_8_task_run():
-#   pass
\ No newline at end of file
+#   pass
+
+def test_9_fetcher_lazy_backends(tmp_path):
+  ''' 导入 watcher 不应导入 crawler.zhihu, 导入 crawler.zhihu 不应读取 token.pkl '''
+  import subprocess
+  code = ('import sys, watcher; print("crawler.zhihu" in sys.modules); '
+          'from crawler import zhihu; print(zhihu._client is None)')
+  output = subprocess.check_output([sys.executable, '-c', code], cwd=str(tmp_path),
+                                   env=dict(os.environ, PYTHONPATH=parentdir), text=True)
+  output.split() | should.equal(['False', 'True'])
@@ -0,0 +1,118 @@
+import os, sys 
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) 
+sys.path.insert(0, parentdir)
+
+import time
+import tools
+from pyshould import should
+import pytest
+
+from crawler import common
+from crawler.common import HttpCache
+
+
+
+class FakeResponse:
+  def __init__(self, status_code, content=b'', headers=None):
+    self.status_code = status_code
+    self.content = content
+    self.headers = headers or {}
+
+
+@pytest.fixture()
+def fake_session(monkeypatch, tmp_path):
+  ''' 用临时目录的 HttpCache 替换 common.http_cache, 记录发出的请求 headers '''
+  requests_sent = []
+  responses = []
+  def fake_get(url, headers=None):
+    requests_sent.append(headers or {})
+    return responses.pop(0)
+  monkeypatch.setattr(common, 'http_cache', HttpCache(root=str(tmp_path / 'cache')))
+  monkeypatch.setattr(common.session, 'get', fake_get)
+  return requests_sent, responses
+
+
+def test_1_cache_hit(fake_session):
+  requests_sent, responses = fake_session
+  responses.append(FakeResponse(200, '页面'.encode('utf-8')))
+  common.common_get('https://wemp.app/posts/1') | should.equal('页面')
+  common.common_get('https://wemp.app/posts/1') | should.equal('页面')
+  len(requests_sent) | should.equal(1)
+  dict(common.http_cache.stats) | should.equal({'miss': 1, 'hit': 1})
+
+
+def test_2_cache_revalidate_with_etag(fake_session):
+  requests_sent, responses = fake_session
+  url = 'https://www.v2ex.com/t/123'
+  responses.append(FakeResponse(200, b'v1', {'ETag': '"abc"', 'Last-Modified': 'Wed, 01 Jan 2020 00:00:00 GMT'}))
+  common.common_get(url)
+  common.http_cache.index[url]['fetch_time'] -= 3600  # 使缓存过期
+  responses.append(FakeResponse(304))
+  common.common_get(url) | should.equal('v1')
+  requests_sent[1]['If-None-Match']     | should.equal('"abc"')
+  requests_sent[1]['If-Modified-Since'] | should.equal('Wed, 01 Jan 2020 00:00:00 GMT')
+  common.http_cache.stats['revalidated'] | should.equal(1)
+  assert common.http_cache.is_fresh(url, common.http_cache.index[url])
+
+
+def test_3_cache_disabled(fake_session):
+  requests_sent, responses = fake_session
+  responses.extend([FakeResponse(200, b'a'), FakeResponse(200, b'b')])
+  common.common_get('https://wemp.app/posts/2', cache=False) | should.equal('a')
+  common.common_get('https://wemp.app/posts/2', cache=False) | should.equal('b')
+  common.http_cache.index | should.equal({})
+  dict(common.http_cache.stats) | should.equal({})  # 不使用缓存的请求不计为 miss
+
+
+def test_4_ttl_by_url_type(tmp_path):
+  cache = HttpCache(root=str(tmp_path))
+  cache.ttl('https://wemp.app/posts/abc')                  | should.equal(7 * 24 * 3600)
+  cache.ttl('https://rsshub.app/wechat/ershicimi/123')     | should.equal(1800)
+  cache.ttl('https://api.bilibili.com/x/article/viewinfo?id=1') | should.equal(600)
+  cache.ttl('https://example.com/')                        | should.equal(3600)
+
+
+def test_5_content_addressed_and_lru_eviction(tmp_path):
+  cache = HttpCache(root=str(tmp_path), max_bytes=25)
+  cache.store('https://a.com/1', b'0123456789')
+  cache.store('https://a.com/2', b'0123456789')  # 内容相同, 共用一个正文文件
+  len(os.listdir(tmp_path / 'objects')) | should.equal(1)
+  cache.total_bytes | should.equal(10)
+
+  cache.store('https://a.com/3', b'abcdefghij')
+  cache.read('https://a.com/1', cache.lookup('https://a.com/1'))  # a.com/2 成为最久未使用
+  time.sleep(0.01)
+  cache.store('https://a.com/4', b'ABCDEFGHIJ')  # 超出 25 bytes, 淘汰 a.com/2 与 a.com/3
+  sorted(cache.index) | should.equal(['https://a.com/1', 'https://a.com/4'])
+  assert cache.total_bytes <= 25
+
+  # 重新载入 index
+  HttpCache(root=str(tmp_path)).lookup('https://a.com/4')['size'] | should.equal(10)
+
+
+def test_6_blob_removed_before_read(fake_session):
+  ''' lookup 之后正文被其他线程 evict 删除, 当作没有缓存重新抓取 '''
+  requests_sent, responses = fake_session
+  url = 'https://wemp.app/posts/3'
+  responses.extend([FakeResponse(200, b'v1'), FakeResponse(200, b'v2')])
+  common.common_get(url)
+  cache = common.http_cache
+  entry = cache.lookup(url)
+  os.remove(cache.blob_path(entry['blob']))
+  cache.read(url, entry)                | should.be_none
+  (url in cache.index)                  | should.be_false
+  common.common_get(url)                | should.equal('v2')
+  dict(cache.stats)                     | should.equal({'miss': 2})
+
+
+def test_7_access_time_persisted(tmp_path):
+  cache = HttpCache(root=str(tmp_path), max_bytes=25)
+  cache.store('https://a.com/1', b'0123456789')
+  cache.store('https://a.com/2', b'abcdefghij')
+  time.sleep(0.01)
+  cache.read('https://a.com/1', cache.lookup('https://a.com/1'))  # 刚保存过 index, 只改动内存
+  cache.flush()                                                   # 如进程退出时
+
+  cache2 = HttpCache(root=str(tmp_path), max_bytes=25)            # 重启后仍按 access_time 淘汰
+  cache2.store('https://a.com/3', b'ABCDEFGHIJ')
+  sorted(cache2.index)                  | should.equal(['https://a.com/1', 'https://a.com/3'])
@@ -0,0 +1,41 @@
+import os, sys
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parentdir)
+import subprocess
+from pyshould import should
+import pytest
+
+'''
+用 python -X importtime 检查启动耗时
+只做调度的命令 (如 Watcher.report) 不应载入渲染和解析页面用的模块
+'''
+
+IMPORT_TIME_BUDGET = 1.0   # 秒, 留足余量, 避免在较慢的机器上误报
+LAZY_MODULES = ['markdown', 'mdx_gfm', 'pygments', 'html2text', 'pyquery', 'jinja2', 'feedgen', 'crawler.zhihu']
+
+
+def import_time(module, cwd):
+  ''' 在新进程中导入 module, 返回 {模块名: 累计耗时 (秒)} '''
+  result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          cwd=cwd, env=dict(os.environ, PYTHONPATH=parentdir),
+                          stderr=subprocess.PIPE, text=True, check=True)
+  times = {}
+  for line in result.stderr.splitlines():
+    if not line.startswith('import time:') or 'cumulative' in line:
+      continue
+    _, cumulative, name = line[len('import time:'):].split('|')
+    times[name.strip()] = int(cumulative) / 1e6
+  return times
+
+
+@pytest.mark.parametrize('module', ['tools', 'task', 'watcher'])
+def test_1_import_skip_heavy_modules(module, tmp_path):
+  times = import_time(module, cwd=str(tmp_path))
+  [name for name in LAZY_MODULES if name in times] | should.equal([])
+
+
+def test_2_import_time_budget(tmp_path):
+  import_time('watcher', cwd=str(tmp_path))  # 第一次运行生成 .pyc, 不计入
+  times = import_time('watcher', cwd=str(tmp_path))
+  print(f"import watcher {times['watcher']:.3f}s")
+  (times['watcher'] < IMPORT_TIME_BUDGET) | should.be_true
@@ -0,0 +1,233 @@
+import os, sys
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parentdir)
+
+import time
+import threading
+import tools
+from pyshould import should
+import pytest
+
+from jobs import JobQueue
+from jobs import ResultCache
+
+
+
+def slow_echo(value, delay=0.2):
+  time.sleep(delay)
+  return value
+
+def broken():
+  raise ValueError('broken')
+
+
+def test_1_job_done_and_failed(tmp_path):
+  queue = JobQueue(workers=2, root=str(tmp_path))
+  job = queue.submit('echo', slow_echo, {'a': 1})
+  job['status'] | should.equal('pending')
+  queue.wait(job['id'], timeout=5)['result'] | should.equal({'a': 1})
+  queue.get(job['id'])['status'] | should.equal('done')
+
+  job = queue.submit('broken', broken)
+  job = queue.wait(job['id'], timeout=5)
+  job['status'] | should.equal('failed')
+  ('broken' in job['error']) | should.be_true
+  queue.shutdown()
+
+
+def test_2_wait_timeout_and_poll_from_other_queue(tmp_path):
+  queue = JobQueue(workers=1, root=str(tmp_path))
+  job = queue.submit('echo', slow_echo, 'x', delay=0.5)
+  queue.wait(job['id'], timeout=0.05)['status'] | should.equal('running')
+
+  other = JobQueue(workers=1, root=str(tmp_path))  # 如另一个 gunicorn worker 进程
+  other.get(job['id'])['status'] | should.equal('running')
+  queue.wait(job['id'])
+  other.get(job['id'])['result'] | should.equal('x')
+  other.get('not-exists') | should.be_none
+  queue.shutdown()
+  other.shutdown()
+
+
+def test_3_expire(tmp_path):
+  queue = JobQueue(workers=1, root=str(tmp_path), ttl=0)
+  job = queue.wait(queue.submit('echo', slow_echo, 1, delay=0)['id'])
+  time.sleep(0.01)
+  queue.expire()
+  queue.get(job['id']) | should.be_none
+  os.listdir(str(tmp_path)) | should.equal([])
+  queue.shutdown()
+
+
+@pytest.fixture()
+def slow_collector(tmp_path, monkeypatch):
+  ''' 以延迟返回的函数代替知乎抓取 '''
+  import collector
+  def fake_fetch(url):
+    collector.fetched.append(url)
+    time.sleep(float(url.rsplit('/', 1)[-1]) / 1000)
+    return {'url': url}
+  monkeypatch.setattr(collector.zhihu, 'fetch_zhihu_answer', fake_fetch)
+  monkeypatch.setattr(collector, 'job_queue', JobQueue(workers=4, root=str(tmp_path)))
+  monkeypatch.setattr(collector, 'result_cache', ResultCache())
+  monkeypatch.setattr(collector, 'fetched', [], raising=False)
+  yield collector
+  collector.job_queue.shutdown()
+
+
+def test_4_crawl_route_returns_job_id(slow_collector):
+  client = slow_collector.app.test_client()
+  resp = client.get('/api/zhihu/question/1/answer/10?wait=5')
+  resp.status_code | should.equal(200)
+  resp.get_json()['data'] | should.equal({'url': 'https://www.zhihu.com/question/1/answer/10'})
+
+  start = time.time()
+  resp = client.get('/api/zhihu/question/1/answer/500?wait=0')
+  (time.time() - start < 0.3) | should.be_true  # 慢的抓取不阻塞请求
+  resp.status_code | should.equal(202)
+  poll_url = resp.headers['Location']
+  poll_url | should.equal(resp.get_json()['poll'])
+
+  for _ in range(50):
+    job = client.get(poll_url).get_json()['data']
+    if job['status'] == 'done':
+      break
+    time.sleep(0.05)
+  job['result'] | should.equal({'url': 'https://www.zhihu.com/question/1/answer/500'})
+  client.get('/api/jobs/not-exists').status_code | should.equal(404)
+
+
+def test_5_load_test_script(slow_collector):
+  from werkzeug.serving import make_server
+  from load_test import run_load_test, format_report
+  server = make_server('127.0.0.1', 0, slow_collector.app, threaded=True)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  try:
+    url = f'http://127.0.0.1:{server.server_port}/api/zhihu/question/1/answer/20'
+    stats = run_load_test(url, total=40, concurrency=8)
+  finally:
+    server.shutdown()
+  stats['statuses'] | should.equal({200: 40})
+  (stats['rps'] > 0) | should.be_true
+  (stats['p50'] <= stats['p99']) | should.be_true
+  ('req/s' in format_report(stats)) | should.be_true
+
+
+
+def test_6_coalesce_same_key(tmp_path):
+  calls = []
+  def crawl(url):
+    calls.append(url)
+    time.sleep(0.2)
+    return url
+  queue = JobQueue(workers=4, root=str(tmp_path))
+  jobs = [queue.submit('crawl', crawl, 'a', key='a') for _ in range(5)]
+  len(set(job['id'] for job in jobs)) | should.equal(1)
+  jobs[1]['coalesced'] | should.be_true
+  queue.submit('crawl', crawl, 'b', key='b')['id'] | should.not_equal(jobs[0]['id'])
+  queue.wait(jobs[0]['id'])['result'] | should.equal('a')
+  calls.count('a') | should.equal(1)
+  # 完成后再提交, 重新执行
+  queue.wait(queue.submit('crawl', crawl, 'a', key='a')['id'])
+  calls.count('a') | should.equal(2)
+  queue.shutdown()
+
+
+def test_7_result_cache_lru_ttl():
+  cache = ResultCache(max_items=2, ttl=0.2)
+  cache.put('a', 1)
+  cache.put('b', 2)
+  cache.get('a') | should.equal(1)   # a 变为最近使用
+  cache.put('c', 3)
+  cache.get('b') | should.be_none    # 淘汰最久未使用的 b
+  cache.get('a') | should.equal(1)
+  time.sleep(0.25)
+  cache.get('a') | should.be_none
+  cache.stats['hit'] | should.equal(2)
+
+
+def test_8_crawl_route_coalesce_and_cache(slow_collector):
+  url = 'https://www.zhihu.com/question/1/answer/300'
+  statuses = []
+  def request_once():
+    resp = slow_collector.app.test_client().get('/api/zhihu/question/1/answer/300?wait=5')
+    statuses.append((resp.status_code, resp.headers['X-Cache']))
+  threads = [threading.Thread(target=request_once) for _ in range(10)]
+  for t in threads: t.start()
+  for t in threads: t.join()
+  slow_collector.fetched | should.equal([url])
+  sorted(statuses) | should.equal([(200, 'COALESCED')] * 9 + [(200, 'MISS')])
+
+  client = slow_collector.app.test_client()
+  resp = client.get('/api/zhihu/question/1/answer/300')
+  resp.headers['X-Cache'] | should.equal('HIT')
+  resp.get_json()['data'] | should.equal({'url': url})
+  client.get('/api/zhihu/question/1/answer/300?refresh=1').headers['X-Cache'] | should.equal('MISS')
+  len(slow_collector.fetched) | should.equal(2)
+
+
+def test_9_routes_share_cache_by_url(slow_collector, monkeypatch):
+  ''' 同一 url 的 json / html / markdown route 共用一次抓取, 生成的 html markdown 也被缓存 '''
+  rendered = []
+  class FakePage:
+    def __init__(self, data): self.data = data
+    @classmethod
+    def create(cls, data): return cls(data)
+    def to_html(self):
+      rendered.append('html')
+      return f"<p>{self.data['url']}</p>"
+    def render(self):
+      rendered.append('markdown')
+      return f"{self.data['url']} in {self.data['metadata']['folder']}"
+  monkeypatch.setattr(slow_collector, 'Page', FakePage)
+  url = 'https://www.zhihu.com/question/1/answer/50'
+  monkeypatch.setattr(slow_collector.zhihu, 'fetch_zhihu_answer',
+                      lambda url: slow_collector.fetched.append(url) or {'url': url, 'metadata': {}})
+  client = slow_collector.app.test_client()
+  resp = client.get('/api/zhihu/question/1/answer/50?wait=5')
+  resp.headers['X-Cache'] | should.equal('MISS')
+  resp = client.get('/' + url, follow_redirects=True)
+  resp.headers['X-Cache'] | should.equal('HIT')
+  resp.get_data(as_text=True) | should.equal(f'<p>{url}</p>')
+  resp = client.get('/url/' + url)
+  resp.headers['X-Cache'] | should.equal('HIT')
+  resp.get_json()['data'] | should.equal({'mdtxt': f'{url} in ./'})
+  slow_collector.result_cache.get(url)['raw'] | should.equal({'url': url, 'metadata': {}})  # 缓存的原始数据未被改动
+  slow_collector.fetched | should.equal([url])
+
+  client.get('/' + url, follow_redirects=True).get_data(as_text=True) | should.equal(f'<p>{url}</p>')
+  client.get('/url/' + url).get_json()['data'] | should.equal({'mdtxt': f'{url} in ./'})
+  rendered | should.equal(['html', 'markdown'])  # 命中时不再生成
+
+
+def test_10_result_not_serializable(tmp_path):
+  queue = JobQueue(workers=1, root=str(tmp_path))
+  job = queue.submit('obj', lambda: object(), key='obj')
+  job = queue.wait(job['id'], timeout=5)
+  job['status'] | should.equal('failed')
+  ('not json serializable' in job['error']) | should.be_true
+  JobQueue(workers=1, root=str(tmp_path)).get(job['id'])['status'] | should.equal('failed')  # 磁盘上的记录
+  queue.inflight | should.equal({})
+  queue.wait(queue.submit('obj', lambda: 1, key='obj')['id'])['result'] | should.equal(1)  # 同一 key 可以重新执行
+  queue.shutdown()
+
+
+def test_11_crawl_route_bad_wait(slow_collector, monkeypatch):
+  monkeypatch.setattr(slow_collector, 'JOB_WAIT_MAX', 0.05)
+  client = slow_collector.app.test_client()
+  client.get('/api/zhihu/question/1/answer/10?wait=abc').status_code | should.equal(200)  # 按默认值等待
+  client.get('/api/zhihu/question/1/answer/11?wait=-1').status_code  | should.equal(202)
+  client.get('/api/zhihu/question/1/answer/300?wait=nan').status_code | should.equal(202)
+  start = time.time()
+  client.get('/api/zhihu/question/1/answer/400?wait=1e9').status_code | should.equal(202)
+  (time.time() - start < 0.3) | should.be_true  # 不超过 JOB_WAIT_MAX
+
+
+
+def test_12_crawl_route_not_cache_unserializable(slow_collector, monkeypatch):
+  monkeypatch.setattr(slow_collector.zhihu, 'fetch_zhihu_answer', lambda url: {'url': url, 'obj': object()})
+  client = slow_collector.app.test_client()
+  client.get('/api/zhihu/question/1/answer/1?wait=5').status_code | should.equal(500)
+  slow_collector.result_cache.items     | should.equal({})
+  resp = client.get('/api/zhihu/question/1/answer/1?wait=5')
+  (resp.status_code, resp.headers['X-Cache']) | should.equal((500, 'MISS'))  # 不会命中失败的结果
@@ -68,3 +68,23 @@ def test_1_lister_filter():
   f = FetcherFilter(iter(feed), option)
   result = f.title_before('title3 a', include=True)
   list(result) | should.eq([item1, item2, item3])
+
+
+
+def test_2_stop_at_known():
+  from crawler.zhihu import stop_at_known
+  items = ['u9', 'u8', 'u7', 'u6', 'u5', 'u4', 'u3', 'u2', 'u1']
+  known = {'u6', 'u4', 'u3', 'u2', 'u1'}
+  to_url = lambda item: item
+  list(stop_at_known(iter(items), to_url, known, stop_after_known=0)) | should.eq(items)
+  list(stop_at_known(iter(items), to_url, set(), stop_after_known=2)) | should.eq(items)
+  # u6 只是单个已知页面, 跳过它但继续翻页; 连续 2 个已知 (u4 u3) 后停止
+  list(stop_at_known(iter(items), to_url, known, stop_after_known=2)) | should.eq(['u9', 'u8', 'u7', 'u5'])
+
+  consumed = []
+  def gen():
+    for item in items:
+      consumed.append(item)
+      yield item
+  list(stop_at_known(gen(), to_url, known, stop_after_known=3))
+  consumed | should.eq(['u9', 'u8', 'u7', 'u6', 'u5', 'u4', 'u3', 'u2'])  # 不会继续翻到 u1
@@ -0,0 +1,117 @@
+import os, sys
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parentdir)
+
+import json
+import time
+import tools
+from types import SimpleNamespace
+from pyshould import should
+import pytest
+
+from crawler import zhihu
+from fetcher import Fetcher
+from test_watcher import CONFIGDATA
+
+
+
+def fake_article(i):
+  return SimpleNamespace(id=i, title=f'文章 {i}', author=SimpleNamespace(name='作者'))
+
+def fake_answer(i):
+  return SimpleNamespace(id=i, question=SimpleNamespace(id=100, title=f'问题 {i}'),
+                         author=SimpleNamespace(name='作者'), voteup_count=i,
+                         created_time=1577836800, updated_time=1577836800)
+
+
+@pytest.fixture()
+def fake_column(monkeypatch):
+  ''' 每篇文章 yield 前记录一次, 用于检查是否逐个消费 '''
+  produced = []
+  def yield_column_articles(column_id, limit=100, min_voteup=20, **kwargs):
+    for i in range(limit):
+      produced.append(i)
+      yield fake_article(i)
+  monkeypatch.setattr(zhihu, 'yield_column_articles', yield_column_articles)
+  return produced
+
+
+def test_1_fetcher_request_iter_is_lazy(fake_column):
+  items = Fetcher.create('https://zhuanlan.zhihu.com/frontEndInDepth', {'limit': 50}).request_iter()
+  first = next(items)
+  first['url'] | should.equal('https://zhuanlan.zhihu.com/p/0')
+  fake_column | should.equal([0])
+  len(list(items)) | should.equal(49)
+  Fetcher.create('https://zhuanlan.zhihu.com/frontEndInDepth', {'limit': 3}).request() | should.equal(
+    [{'url': f'https://zhuanlan.zhihu.com/p/{i}', 'tip': f'文章 {i} - 作者'} for i in range(3)])
+
+
+def test_2_watcher_add_tasks_incrementally(fake_column, tmp_path):
+  from watcher import Watcher
+  path = str(tmp_path / 'stream')
+  os.makedirs(path)
+  tools.text_save(path + '/.config.yaml', CONFIGDATA)
+  w = Watcher.open(path)
+  task = w.tasks['https://zhuanlan.zhihu.com/frontEndInDepth']
+  task_count = len(w.tasks)
+  seen_sizes = []
+  def tracked():
+    for desc in task.iter_run(known_urls=set(w.tasks)):
+      seen_sizes.append(len(w.tasks))
+      yield desc
+  counter = w.add_tasks(tracked())
+  counter['new tasks'] | should.equal(4)
+  seen_sizes | should.equal([task_count + i for i in range(4)])  # 每取到一个就已加入
+  len(task.run()) | should.equal(4)
+
+
+def test_3_author_route_ndjson(monkeypatch):
+  import collector
+  def yield_author_answers(author_id, limit=100, min_voteup=300, **kwargs):
+    for i in range(limit):
+      time.sleep(0.1)
+      yield fake_answer(i)
+  monkeypatch.setattr(zhihu, 'yield_author_answers', yield_author_answers)
+  client = collector.app.test_client()
+
+  start = time.time()
+  resp = client.get('/author/someone?limit=5&format=ndjson', buffered=False)
+  resp.mimetype | should.equal('application/x-ndjson')
+  chunks = iter(resp.response)
+  first = json.loads(next(chunks))
+  (time.time() - start < 0.4) | should.be_true   # 第一条不必等全部取回
+  first['url'] | should.equal('https://www.zhihu.com/question/100/answer/0')
+  rest = [json.loads(line) for line in b''.join(chunks).decode('utf-8').splitlines()]
+  [item['title'] for item in rest] | should.equal([f'问题 {i}' for i in range(1, 5)])
+  resp.close()
+
+  # 不要求 ndjson 时仍返回 json 列表
+  data = client.get('/author/someone?limit=2').get_json()
+  [item['voteup_count'] for item in data] | should.equal([0, 1])
+
+
+def test_4_ndjson_error_line(monkeypatch):
+  import collector
+  def yield_author_answers(author_id, **kwargs):
+    yield fake_answer(1)
+    raise RuntimeError('rate limited')
+  monkeypatch.setattr(zhihu, 'yield_author_answers', yield_author_answers)
+  resp = collector.app.test_client().get('/author/someone', headers={'Accept': 'application/x-ndjson'})
+  lines = [json.loads(line) for line in resp.data.decode('utf-8').splitlines()]
+  len(lines) | should.equal(2)
+  ('rate limited' in lines[-1]['error']) | should.be_true
+
+
+def test_5_lister_route_bad_limit(monkeypatch):
+  import collector
+  calls = []
+  def yield_author_answers(author_id, limit=100, min_voteup=300, **kwargs):
+    calls.append((limit, min_voteup))
+    return iter([])
+  monkeypatch.setattr(zhihu, 'yield_author_answers', yield_author_answers)
+  monkeypatch.setattr(collector, 'LISTER_LIMIT_MAX', 50)
+  client = collector.app.test_client()
+  client.get('/author/someone?limit=abc&min_voteup=x').status_code | should.equal(200)
+  client.get('/author/someone?limit=100000').status_code | should.equal(200)
+  client.get('/author/someone?limit=-3').status_code | should.equal(200)
+  calls | should.equal([(10, 300), (50, 300), (0, 300)])
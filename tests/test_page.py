@@ -96,8 +96,56 @@ def test_3_page_write():
   pass
 
 def test_4_page_render():
-  pass
+  import page
+  from jinja2 import Template
+  tmpl = page.get_template('v2ex_page.jinja2')
+  page.get_template('v2ex_page.jinja2')            | should.be(tmpl)  # 只编译一次
+  data = {'metadata': {'title': 't1', 'url': 'https://www.v2ex.com/t/1', 'tags': ['a', 'b']},
+          'content': 'content1',
+          'comments': [{'author': 'u1', 'no': 1, 'date': 'd1', 'likes': 2, 'text': 'c1'}]}
+  source = tools.text_load(os.path.join(page.TEMPLATE_ROOT, 'v2ex_page.jinja2'))
+  tmpl.render(data=data)                            | should.equal(Template(source).render(data=data))
 
 
 def test_5_page_to_html():
-  pass
\ No newline at end of file
+  pass
+
+def test_6_page_load_metadata_only(tmp_path):
+  import page
+  data = {'metadata': {'title': 't1', 'url': 'https://www.v2ex.com/t/1', 'tags': ['a'],
+                       'version': 1, 'fetch_date': '2020-01-01 00:00:00'},
+          'content': 'content1',
+          'comments': []}
+  path = str(tmp_path / 't1.md')
+  tools.text_save(path, page.get_template('v2ex_page.jinja2').render(data=data))
+
+  page1 = page.Page.load(path)
+  page1.metadata['title']                | should.equal('t1')
+  page1.version                          | should.equal('1')
+  ('full_text' in page1.data)            | should.be_false  # 只读取了开头的 metadata
+  page1.full_text                        | should.equal(tools.text_load(path))
+  page1.sections                         | should.be(page1.sections)
+
+
+def test_7_page_content_hashes():
+  import page
+  def create(title, answer, question='q1'):
+    data = {'metadata': {'title': title, 'url': 'https://www.zhihu.com/question/1/answer/2'},
+            'question_detail': question, 'answer': answer}
+    return page.Page.create(data)
+  page1 = create('t1', 'answer1\n\nline2')
+  set(page1.content_hashes)                                   | should.equal({'title', 'question', 'body'})
+  page1.changed_parts(create('t1', 'answer1  \nline2\n').content_hashes) | should.equal([])  # 忽略空行和行尾空格
+  page1.changed_parts(create('t1', 'answer2').content_hashes) | should.equal(['body'])
+  page1.changed_parts(create('t2', 'answer1', 'q2').content_hashes) | should.equal(['title', 'question', 'body'])
+
+
+def test_8_page_load_with_bom(tmp_path):
+  import page
+  data = {'metadata': {'title': 't1', 'url': 'https://www.v2ex.com/t/1', 'tags': ['a'],
+                       'version': 1, 'fetch_date': '2020-01-01 00:00:00'},
+          'content': 'content1',
+          'comments': []}
+  path = str(tmp_path / 't1.md')
+  tools.text_save(path, '\ufeff' + page.get_template('v2ex_page.jinja2').render(data=data))  # 如 Windows 记事本保存的文件
+  page.Page.load(path).metadata['title'] | should.equal('t1')
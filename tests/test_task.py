@@ -75,6 +75,7 @@ def test_1_task_create_usage():
     'lazy_ratio': 1,
     'weight': 0.8,
     'enabled': True,
+    'content_hash': None,
     'fetcher_option': {
       'text_include': None, 
       'text_exclude': None, 
@@ -216,4 +217,44 @@ def test_7_task_dispatch():
 
 
 def test_8_task_run():
-  pass
\ No newline at end of file
+  pass
+
+
+
+def test_9_task_content_hash_yaml():
+  import yaml
+  desc = {'url': 'https://zhuanlan.zhihu.com/p/67815990'}
+  task = Task.create(desc, env_option=ENV_OPTION, fetcher_option=FETCHER_OPTION)
+  task.content_hash = {'title': '0123456789abcdef', 'body': '00000000000000e1'}
+  text = task.to_yaml_text()
+  text.splitlines()[-1] | should.equal('  content_hash: { title: "0123456789abcdef", body: "00000000000000e1" }')
+  task2 = Task.create(yaml.safe_load(text)[0], env_option=ENV_OPTION, fetcher_option=FETCHER_OPTION)
+  task2.content_hash | should.equal(task.content_hash)
+
+
+def test_10_task_scheduler():
+  from task import TaskScheduler
+  scheduler = TaskScheduler()
+  now = tools.time_now()
+  descs = [{'url': f'https://zhuanlan.zhihu.com/p/{i}', 'weight': 0.1 * i,
+            'next_watch_time': tools.time_to_str(now.shift(days=i - 2))} for i in range(1, 6)]
+  tasks = [Task.create(desc, env_option={}, fetcher_option={}) for desc in descs]
+  lister = Task.create({'url': 'https://zhuanlan.zhihu.com/frontEndInDepth'}, env_option={}, fetcher_option={})
+  for task in tasks + [lister]:
+    scheduler.add(task)
+
+  [t.url for t in scheduler.due('page', now)]  | should.equal([tasks[1].url, tasks[0].url])  # 按 priority 排列
+  [t.url for t in scheduler.due('lister', now)] | should.equal([lister.url])
+  tasks[1].schedule(is_modified=True)           # 更新 next_watch_time 后自动调整堆
+  tasks[4].next_watch_time = now.shift(days=-1)
+  tasks[0].enabled = False
+  [t.url for t in scheduler.due('page', now)]  | should.equal([tasks[4].url])
+  [t.url for t in scheduler.due('page', now.shift(days=2))] | should.equal([tasks[4].url, tasks[3].url, tasks[2].url])
+
+
+def test_11_task_save_attachments_default():
+  ''' 未设置时不下载附件, 与 .config.yaml 模板中的 save_attachments: false 一致 '''
+  desc = { 'url': 'https://zhuanlan.zhihu.com/p/67815990', }
+  Task.create(desc, env_option={}, fetcher_option={}).fetcher_option.save_attachments | should.be_false
+  task = Task.create(desc, env_option={}, fetcher_option={'save_attachments': True})
+  task.fetcher_option.save_attachments | should.be_true
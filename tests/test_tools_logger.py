@@ -0,0 +1,59 @@
+import os, sys
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parentdir)
+import tools
+from pyshould import should
+
+
+
+def test_1_logger_persistent_handle(tmp_path):
+  log = tools.create_logger(str(tmp_path / 'a.py'))
+  log('hello', 1)
+  handle = tools.LogFile.get(log.filepath).handle
+  {'x': 1} | log
+  tools.LogFile.get(log.filepath).handle | should.be(handle)  # 不再每次打开文件
+  tools.log_flush()
+  lines = tools.text_load(log.filepath).splitlines()
+  len(lines)                            | should.equal(2)
+  lines[0].endswith('] hello, 1')       | should.be_true
+  lines[1].endswith("] {'x': 1}")       | should.be_true
+
+
+def test_2_logger_level(tmp_path, monkeypatch):
+  monkeypatch.setattr(tools, 'LOG_LEVEL', 'warning')
+  log = tools.create_logger(str(tmp_path / 'b.py'))
+  log_error = tools.create_logger(str(tmp_path / 'b.py') + '.error')
+  log('skip')
+  'skip' | log
+  log('keep', level='warning')
+  log_error('error')
+  tools.log_flush()
+  tools.text_load(log.filepath).count('] ')       | should.equal(1)
+  tools.text_load(log_error.filepath).count('] ') | should.equal(1)
+
+
+def test_3_logger_rotate(tmp_path, monkeypatch):
+  monkeypatch.setattr(tools, 'LOG_MAX_BYTES', 1000)
+  monkeypatch.setattr(tools, 'LOG_BACKUP_COUNT', 2)
+  log = tools.create_logger(str(tmp_path / 'c.py'))
+  for i in range(100):
+    log('x' * 50)
+  tools.log_flush()
+  os.path.exists(log.filepath + '.1')   | should.be_true
+  os.path.exists(log.filepath + '.2')   | should.be_true
+  os.path.exists(log.filepath + '.3')   | should.be_false
+  (os.path.getsize(log.filepath + '.1') < 1100) | should.be_true
+
+
+def test_4_logger_queue_writer(tmp_path):
+  log = tools.create_logger(str(tmp_path / 'd.py'))
+  tools.enable_log_queue()
+  try:
+    for i in range(200):
+      log(f'line {i}')
+    tools.log_flush()
+  finally:
+    tools.enable_log_queue(False)
+  lines = tools.text_load(log.filepath).splitlines()
+  len(lines)                            | should.equal(200)
+  lines[-1].endswith('] line 199')      | should.be_true
@@ -0,0 +1,51 @@
+import os, sys 
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) 
+sys.path.insert(0, parentdir)
+
+import time
+import threading
+import tools
+from pyshould import should
+import pytest
+
+
+
+def test_1_token_bucket_burst():
+  bucket = tools.TokenBucket(rate=10, burst=3)
+  start = time.monotonic()
+  for _ in range(3):
+    bucket.acquire()
+  assert time.monotonic() - start < 0.05   # burst 之内不等待
+  bucket.acquire()
+  assert time.monotonic() - start >= 0.08  # 第 4 个需要等待约 0.1 秒
+
+
+def test_2_token_bucket_invalid_rate():
+  with pytest.raises(ValueError):
+    tools.TokenBucket(rate=0)
+
+
+def test_3_host_key():
+  limiter = tools.HostRateLimiter(rates={'zhihu.com': 1, 'mp.weixin.qq.com': 1})
+  limiter.host_key('https://www.zhihu.com/question/1/answer/2') | should.equal('zhihu.com')
+  limiter.host_key('https://zhuanlan.zhihu.com/p/67815990')     | should.equal('zhihu.com')
+  limiter.host_key('http://mp.weixin.qq.com/s?__biz=xxx')        | should.equal('mp.weixin.qq.com')
+  limiter.host_key('https://www.v2ex.com/t/123')                 | should.equal('www.v2ex.com')
+  assert limiter.bucket('https://www.zhihu.com/') is limiter.bucket('https://zhuanlan.zhihu.com/')
+
+
+def test_4_host_rate_limiter_threads():
+  ''' 同一 host 的请求被限速, 不同 host 互不影响 '''
+  limiter = tools.HostRateLimiter(rates={'slow.com': 20, 'fast.com': 1000})
+  finished = {}
+  def worker(url, n):
+    for _ in range(n):
+      limiter.acquire(url)
+    finished[url] = time.monotonic()
+  start = time.monotonic()
+  threads = [threading.Thread(target=worker, args=('https://slow.com/a', 5)),
+             threading.Thread(target=worker, args=('https://fast.com/b', 5))]
+  for t in threads: t.start()
+  for t in threads: t.join()
+  assert finished['https://slow.com/a'] - start >= 0.15
+  assert finished['https://fast.com/b'] - start < 0.1
@@ -0,0 +1,51 @@
+import os, sys
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parentdir)
+import tools
+from pyshould import should
+from watcher import Watcher
+from test_watcher import CONFIGDATA
+
+
+
+def test_1_yaml_load_include(tmp_path):
+  tools.text_save(str(tmp_path / 'sub.yaml'), 'limit: 4\ntags: [a, b]\n')
+  tools.text_save(str(tmp_path / 'main.yaml'), 'name: x\noption: !include sub.yaml\nz: 1\na: 2\n')
+  data = tools.yaml_load(str(tmp_path / 'main.yaml'))
+  data                                  | should.equal({'name': 'x', 'option': {'limit': 4, 'tags': ['a', 'b']}, 'z': 1, 'a': 2})
+  list(data)                            | should.equal(['name', 'option', 'z', 'a'])  # 保持原有顺序
+  data | should.equal(tools.yaml_load(str(tmp_path / 'main.yaml'), loader=tools.IncludeOrderedLoader))
+
+
+def test_2_yaml_load_snapshot(tmp_path, monkeypatch):
+  path = str(tmp_path / 'data.yaml')
+  tools.text_save(path, '- url: a\n- url: b\n')
+  tools.yaml_load_snapshot(path)        | should.equal([{'url': 'a'}, {'url': 'b'}])
+  sorted(os.listdir(str(tmp_path)))     | should.equal(['data.yaml', 'data.yaml.pickle'])  # 快照在源文件旁
+
+  calls = []
+  monkeypatch.setattr(tools, 'yaml_load', lambda *args, **kwargs: calls.append(args))
+  tools.yaml_load_snapshot(path)        | should.equal([{'url': 'a'}, {'url': 'b'}])
+  calls                                 | should.equal([])  # 命中快照, 不再解析
+  monkeypatch.undo()
+
+  tools.text_save(path, '- url: a\n- url: b\n- url: c\n')  # size 变化, 快照失效
+  len(tools.yaml_load_snapshot(path))   | should.equal(3)
+
+
+def test_3_task_store_snapshot(tmp_path):
+  path = str(tmp_path / 'watcher')
+  os.makedirs(path)
+  tools.text_save(path + '/.config.yaml', CONFIGDATA)
+  w = Watcher.open(path)
+  w.add_tasks([{'url': f'https://zhuanlan.zhihu.com/p/{i}'} for i in range(3)])
+  w.save_tasks_yaml()
+  yaml_path = path + '/.tasks.yaml'
+  # compact 写入的快照与重新解析 .tasks.yaml 得到的 Task 一致
+  snapshot_tasks = [w.tasks.create_task(item).to_desc() for item in tools.yaml_load_snapshot(yaml_path)]
+  parsed_tasks = [w.tasks.create_task(item).to_desc() for item in tools.yaml_load(yaml_path)]
+  snapshot_tasks                        | should.equal(parsed_tasks)
+  os.path.exists(yaml_path + '.pickle') | should.be_true
+  w2 = Watcher.open(path)
+  w2.tasks_count                        | should.equal(5)
+  [t.to_desc() for t in w2.tasks.values()] | should.equal([t.to_desc() for t in w.tasks.values()])
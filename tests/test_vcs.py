@@ -0,0 +1,129 @@
+import os, sys
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parentdir)
+import time
+import tools
+import vcs
+from pyshould import should
+from watcher import Watcher
+from test_watcher import CONFIGDATA
+
+
+def init_repo(path, files=0, ignore=True):
+  os.makedirs(path, exist_ok=True)
+  for i in range(files):
+    tools.text_save(os.path.join(path, f'page {i}.md'), f'# page {i}\n' + 'text\n' * 50)
+  if ignore:
+    tools.text_save(os.path.join(path, '.gitignore'), '**/*.yaml.pickle')  # 同 Collector.create
+  vcs.git(path, 'init', '-q')
+  vcs.git(path, 'config', 'user.name', 'TNR')
+  vcs.git(path, 'config', 'user.email', 'tnr@email.com')
+  vcs.git(path, 'add', '.')
+  vcs.git(path, 'commit', '-q', '--allow-empty', '-m', 'init TNR project')
+  return path
+
+def git_log(path):
+  return vcs.git(path, 'log', '--format=%s').splitlines()
+
+def git_status(path):
+  return vcs.git(path, 'status', '--porcelain').splitlines()
+
+
+
+def test_1_fast_import_commit_paths(tmp_path):
+  path = init_repo(str(tmp_path / 'repo'), files=3)
+  g = vcs.open_git(path, batch_size=2)
+  tools.text_save(path + '/page 0.md', 'changed')
+  tools.text_save(path + '/新页面.md', '中文')
+  tools.text_save(path + '/untouched.md', 'not committed')
+  g.commit('save 2 pages', [path + '/page 0.md', path + '/新页面.md', path + '/.tasks.journal'])
+  git_log(path)                         | should.equal(['init TNR project'])  # 未到 batch_size
+  os.remove(path + '/page 1.md')
+  g.commit('remove page 1', [path + '/page 1.md'])
+  git_log(path)                         | should.equal(['remove page 1', 'save 2 pages', 'init TNR project'])
+  git_status(path)                      | should.equal(['?? untouched.md'])  # index 与提交一致
+  vcs.git(path, 'commit', '-q', '--allow-empty', '-m', 'manual')  # 外部提交
+  tools.text_save(path + '/page 2.md', 'changed')
+  g.commit('save page 2', [path + '/page 2.md'])
+  g.close()
+  git_log(path)[:2]                     | should.equal(['save page 2', 'manual'])
+  vcs.git(path, 'show', 'HEAD:page 2.md') | should.equal('changed')
+  git_status(path)                      | should.equal(['?? untouched.md'])
+
+
+def test_2_shell_commit_batch(tmp_path):
+  path = init_repo(str(tmp_path / 'repo'), files=3)
+  g = vcs.open_git(path, backend='shell', batch_size=2)
+  tools.text_save(path + '/page 0.md', 'changed')
+  tools.text_save(path + '/untouched.md', 'not committed')
+  g.commit('save page 0', [path + '/page 0.md'])
+  g.commit('nothing changed', [path + '/page 1.md'])
+  g.close()
+  len(git_log(path))                    | should.equal(2)  # 两个提交合并为一个
+  vcs.git(path, 'log', '-1', '--format=%B').strip() | should.equal('save page 0\nnothing changed')
+  git_status(path)                      | should.equal(['?? untouched.md'])
+
+
+def test_3_watcher_remember(tmp_path):
+  path = init_repo(str(tmp_path / 'watcher'))
+  tools.text_save(path + '/.config.yaml', CONFIGDATA.replace("git_commit_path: ''", "git_commit_path: '.'"))
+  w = Watcher.open(path)
+  w.add_tasks([{'url': 'https://zhuanlan.zhihu.com/p/1'}])
+  w.save_tasks_yaml()
+  w.remember({'commit_log': 'save tasks', 'paths': w.tasks.paths})
+  w.git.close()
+  git_log(path)                         | should.equal(['save tasks', 'init TNR project'])
+  vcs.git(path, 'show', '--name-only', '--format=', 'HEAD').split() | should.equal(['.tasks.yaml'])
+  git_status(path)                      | should.equal(['?? .config.yaml'])
+
+
+def test_4_benchmark_git_backends(tmp_path):
+  ''' 在有 2000 个文件的仓库中提交 10 次, 每次 3 个文件
+      比较原有的 git add . && git commit 与 fast-import (逐个写入 / 每 10 个提交写入一次) '''
+  results = {}
+  for backend, batch_size in [('shell', 1), ('fast-import', 1), ('fast-import', 10)]:
+    path = init_repo(str(tmp_path / f'{backend}-{batch_size}'), files=2000)
+    g = vcs.open_git(path, backend=backend, batch_size=batch_size)
+    start = time.monotonic()
+    for i in range(10):
+      paths = [os.path.join(path, f'page {i * 3 + j}.md') for j in range(3)]
+      for p in paths:
+        tools.text_save(p, f'changed {i}')
+      g.commit(f'save 3 pages {i}', paths if backend == 'fast-import' else None)
+    g.close()
+    results[(backend, batch_size)] = time.monotonic() - start
+    len(git_log(path))                  | should.equal(11)
+    git_status(path)                    | should.equal([])
+  print('10 commits in 2000 files: ' + ', '.join(f'{b} batch={n} {t:.2f}s' for (b, n), t in results.items()))
+  assert results[('fast-import', 10)] < results[('shell', 1)] / 2
+
+
+def test_5_skip_yaml_snapshot(tmp_path):
+  ''' 没有 .gitignore 的旧项目, 提交整个工作区时也不提交 .tasks.yaml 的快照 '''
+  for backend in ['shell', 'fast-import']:
+    path = init_repo(str(tmp_path / backend), files=1, ignore=False)
+    tools.text_save(path + '/page 0.md', 'changed')
+    tools.text_save(path + '/.tasks.yaml', '[]')
+    tools.yaml_load_snapshot(path + '/.tasks.yaml')
+    g = vcs.open_git(path, backend=backend)
+    g.commit('save all', None)
+    g.close()
+    vcs.git(path, 'show', '--name-only', '--format=', 'HEAD').splitlines() | should.equal(['.tasks.yaml', 'page 0.md'])
+    git_status(path)                    | should.equal(['?? .tasks.yaml.pickle'])
+
+
+def test_6_shell_commit_missing_paths(tmp_path):
+  ''' compact 之后 .tasks.journal 已删除: 未跟踪的直接跳过, 已跟踪的提交删除 '''
+  path = init_repo(str(tmp_path / 'repo'), files=1)
+  g = vcs.open_git(path, backend='shell')
+  tools.text_save(path + '/.tasks.yaml', '[]')
+  g.commit('save tasks', [path + '/.tasks.yaml', path + '/.tasks.journal'])
+  git_log(path)                         | should.equal(['save tasks', 'init TNR project'])
+
+  tools.text_save(path + '/.tasks.journal', '{}')
+  g.commit('save journal', [path + '/.tasks.yaml', path + '/.tasks.journal'])
+  os.remove(path + '/.tasks.journal')
+  g.commit('compact', [path + '/.tasks.yaml', path + '/.tasks.journal'])
+  g.close()
+  vcs.git(path, 'show', '--name-status', '--format=', 'HEAD').split() | should.equal(['D', '.tasks.journal'])
+  git_status(path)                      | should.equal([])
@@ -129,3 +129,71 @@ def test_5_watcher_add_lister():
 def test_6_watcher_generate_feed():
   col.generate_feed('旗舰评论——战略航空军元帅的旗舰', 
                     limit=150, site='http://tnr-feed.netlify.com/')
+
+
+def test_7_watcher_tasks_journal(tmp_path):
+  path = str(tmp_path / 'journal')
+  os.makedirs(path)
+  tools.text_save(path + '/.config.yaml', CONFIGDATA)
+  w = Watcher.open(path)
+  w.save_tasks_yaml()
+  w.add_tasks([{'url': 'https://zhuanlan.zhihu.com/p/1'}, {'url': 'https://zhuanlan.zhihu.com/p/2'}])
+  task = w.tasks['https://zhuanlan.zhihu.com/p/1']
+  task.schedule(is_modified=True)
+  w.tasks.save(task, 'schedule')
+  with open(w.tasks.journal_path, 'a', encoding='utf-8') as f:
+    f.write('{"op": "schedule", "task": {"url": "https://zhu')  # 模拟写到一半中断
+  len(tools.yaml_load(path + '/.tasks.yaml'))      | should.equal(2)  # .tasks.yaml 尚未覆写
+
+  w2 = Watcher.open(path)                            # 重放 journal 并合并回 .tasks.yaml
+  w2.tasks_count                                     | should.equal(4)
+  w2.tasks[task.url].version                         | should.equal(1)
+  os.path.exists(w2.tasks.journal_path)              | should.be_false
+  len(tools.yaml_load(path + '/.tasks.yaml'))      | should.equal(4)
+  Watcher.open(path).tasks[task.url].to_desc()       | should.equal(task.to_desc())
+
+
+def test_8_watcher_sqlite_task_store(tmp_path):
+  path = str(tmp_path / 'sqlite')
+  os.makedirs(path)
+  tools.text_save(path + '/.config.yaml', CONFIGDATA)
+  w = Watcher.open(path)
+  w.add_tasks([{'url': f'https://zhuanlan.zhihu.com/p/{i}'} for i in range(5)])
+  w.save_tasks_yaml()
+  yaml_text = tools.text_load(path + '/.tasks.yaml')
+
+  tools.text_save(path + '/.config.yaml', CONFIGDATA + '\ntask_store: sqlite\n')
+  w2 = Watcher.open(path)                                   # 首次打开时从 .tasks.yaml 导入
+  os.path.exists(path + '/.tasks.sqlite')                   | should.be_true
+  w2.tasks_count                                            | should.equal(7)
+  lister_urls = [item['url'] for item in tools.yaml_load(path + '/.config.yaml')['urls']]
+  sorted(w2.tasks.cache)                                    | should.equal(sorted(lister_urls))  # page task 尚未创建 Task 对象
+  [t.url for t in w2.get_lister_tasks()]                    | should.equal(lister_urls)
+  w2.tasks['https://zhuanlan.zhihu.com/frontEndInDepth'].fetcher_option.limit | should.equal(4)  # 保留 .config.yaml 的 option
+
+  due = w2.get_page_tasks_should_fetch()
+  len(due)                                                  | should.equal(5)
+  due[0].schedule(is_modified=True)
+  w2.tasks.save(due[0], 'schedule')
+  len(Watcher.open(path).get_page_tasks_should_fetch())     | should.equal(4)
+  w2.tasks.export_yaml(str(tmp_path / 'export.yaml'))
+  len(tools.yaml_load(str(tmp_path / 'export.yaml')))       | should.equal(7)
+  len(yaml_text.splitlines())                               | should.equal(7 * 4)
+
+
+def test_9_sqlite_task_store_checkpoint(tmp_path):
+  ''' flush 后 WAL 已合并回 .tasks.sqlite, 提交的只有 .tasks.sqlite '''
+  import shutil
+  import sqlite3
+  path = str(tmp_path / 'sqlite')
+  os.makedirs(path)
+  tools.text_save(path + '/.config.yaml', CONFIGDATA + '\ntask_store: sqlite\n')
+  w = Watcher.open(path)
+  w.add_tasks([{'url': f'https://zhuanlan.zhihu.com/p/{i}'} for i in range(5)])
+  w.tasks.paths                                             | should.equal([path + '/.tasks.sqlite'])
+  w.tasks.flush()
+  os.path.getsize(path + '/.tasks.sqlite-wal')              | should.equal(0)
+  shutil.copy(path + '/.tasks.sqlite', str(tmp_path / 'copy.sqlite'))  # 只复制 .tasks.sqlite 也包含全部 task
+  db = sqlite3.connect(str(tmp_path / 'copy.sqlite'))
+  db.execute('SELECT COUNT(*) FROM tasks').fetchone()[0]    | should.equal(7)
+  db.close()
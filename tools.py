@@ -7,8 +7,8 @@ from datetime import datetime
 import time
 import arrow
 import json
+import pickle
 import random
-import html2text
 
 import sys
 
@@ -86,6 +86,71 @@ def time_random_sleep(min, max=None):
 
 
 
+import threading
+class TokenBucket:
+  ''' 令牌桶, 每秒补充 rate 个令牌, 最多积攒 burst 个
+      acquire() 取一个令牌, 不足时阻塞等待, 线程安全 '''
+  def __init__(self, rate, burst=1):
+    if rate <= 0:
+      raise ValueError(f'TokenBucket rate should > 0, got {rate}')
+    self.rate = float(rate)
+    self.burst = max(float(burst), 1.0)
+    self.tokens = self.burst
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def _refill(self):
+    now = time.monotonic()
+    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+
+  def acquire(self):
+    ''' 返回本次等待的秒数 '''
+    waited = 0.0
+    while True:
+      with self.lock:
+        self._refill()
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return waited
+        wait = (1 - self.tokens) / self.rate
+      time.sleep(wait)
+      waited += wait
+
+
+class HostRateLimiter:
+  ''' 按 host 分别限速, 每个 host 一个 TokenBucket
+      rates 形如 {'zhihu.com': 0.5, 'mp.weixin.qq.com': 0.2}, 单位为每秒请求数
+      以后缀匹配 host, www.zhihu.com 和 zhuanlan.zhihu.com 共用 'zhihu.com' 的令牌桶
+      未指定的 host 使用 default_rate '''
+  def __init__(self, rates=None, default_rate=0.5, burst=1):
+    self.rates = dict(rates or {})
+    self.default_rate = default_rate
+    self.burst = burst
+    self.buckets = {}
+    self.lock = threading.Lock()
+
+  def host_key(self, url):
+    from urllib.parse import urlsplit
+    host = urlsplit(url).netloc.lower() or url
+    for key in sorted(self.rates, key=len, reverse=True):
+      if host == key or host.endswith('.' + key):
+        return key
+    return host
+
+  def bucket(self, url):
+    key = self.host_key(url)
+    with self.lock:
+      if key not in self.buckets:
+        rate = self.rates.get(key, self.default_rate)
+        self.buckets[key] = TokenBucket(rate, burst=self.burst)
+      return self.buckets[key]
+
+  def acquire(self, url):
+    return self.bucket(url).acquire()
+
+
+
 def convert_time(d, humanize=False):
   if not d:
     return None
@@ -201,13 +266,65 @@ class IncludeOrderedLoader(yaml.Loader):
     return OrderedDict(loader.construct_pairs(node))
 
 
-def yaml_load(path, loader=IncludeOrderedLoader):
-  ''' 按照有序字典载入yaml 支持 !include'''
+# libyaml 可用时用 C 实现的 CSafeLoader, 比纯 Python 的 yaml.Loader 快一个数量级
+# python 3.7 起 dict 已经保持插入顺序, 这里不再构造 OrderedDict
+_FastBaseLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+class IncludeLoader(_FastBaseLoader):
+  ''' yaml loader, 基于 CSafeLoader
+      值为 !include 开头时, 嵌套另一个 yaml, 相对路径以当前 yaml 所在目录为准
+  '''
+  def __init__(self, stream):
+    super().__init__(stream)
+    self._root = os.path.split(getattr(stream, 'name', ''))[0]
+
+  def _include(self, node):
+    filename = os.path.join(self._root, self.construct_scalar(node))
+    with encode_open(filename) as f:
+      return yaml.load(f, IncludeLoader)
+
+IncludeLoader.add_constructor('!include', IncludeLoader._include)
+
+
+def yaml_load(path, loader=IncludeLoader):
+  ''' 载入yaml 支持 !include'''
   with open(path, encoding='utf-8') as f:
     result = yaml.load(f, loader)
   return result
 
 
+def yaml_snapshot_path(path):
+  ''' 快照放在源文件旁, 如 .tasks.yaml => .tasks.yaml.pickle '''
+  return path + '.pickle'
+
+def yaml_snapshot_save(path, data):
+  ''' 保存 yaml 解析结果的 pickle 快照, 记录源文件当前的 mtime 和 size '''
+  stat = os.stat(path)
+  snapshot = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'data': data}
+  temp_path = yaml_snapshot_path(path) + '.tmp'
+  with open(temp_path, 'wb') as f:
+    pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+  os.replace(temp_path, yaml_snapshot_path(path))
+
+def yaml_load_snapshot(path, loader=IncludeLoader):
+  ''' 同 yaml_load, 源文件 mtime 和 size 未变时直接读取快照, 否则重新解析并更新快照
+      快照不属于 TaskStore.paths, 不会随 watcher 的提交写入 git '''
+  stat = os.stat(path)
+  try:
+    with open(yaml_snapshot_path(path), 'rb') as f:
+      snapshot = pickle.load(f)
+    if (snapshot['mtime'], snapshot['size']) == (stat.st_mtime_ns, stat.st_size):
+      return snapshot['data']
+  except (OSError, pickle.UnpicklingError, EOFError, KeyError, TypeError):
+    pass
+  data = yaml_load(path, loader=loader)
+  try:
+    yaml_snapshot_save(path, data)
+  except OSError as e:
+    log_error(f'yaml_load_snapshot: cannot save snapshot for {path}: {e}')
+  return data
+
+
 def yaml_save(data, path):
   '''支持中文, 可以识别 OrderedDict'''
   class OrderedDumper(yaml.SafeDumper):
@@ -251,24 +368,63 @@ def json_saves(data):
   return json.dumps(data)
 
 
-def text_load(path, encoding=None):
-  ''' 读取文本, 尝试不同的解码 '''
-  if not os.path.exists(path):
-    raise ValueError("path `{}` not exist".format(path))
+def text_decode(raw, encoding=None):
+  ''' bytes 转为文本, 未指定 encoding 时先试 utf-8 再用 gbk
+      换行符统一为 \\n, 与文本模式 open() 读取的结果一致 '''
   if encoding is None:  # 猜测 encoding
     try:
-      open(path, 'r', encoding='utf-8').read()
-      encoding = 'utf-8'
+      text = raw.decode('utf-8')
     except UnicodeDecodeError:
-      encoding = 'gbk'
-  with open(path, 'r', encoding=encoding) as f:
-    ret = f.read()
-  return ret
+      text = raw.decode('gbk')
+  else:
+    text = raw.decode(encoding)
+  return text.replace('\r\n', '\n').replace('\r', '\n')
+
+def text_load(path, encoding=None):
+  ''' 读取文本, 尝试不同的解码, 文件只读一次 '''
+  if not os.path.exists(path):
+    raise ValueError("path `{}` not exist".format(path))
+  with open(path, 'rb') as f:
+    raw = f.read()
+  return text_decode(raw, encoding=encoding)
+
+
+def front_matter_load(path, delimiter='---', encoding=None):
+  ''' 逐行读取文件开头两个 --- 之间的部分 (如 Jekyll 的 front matter)
+      读到第二个 --- 即停止, 不读取正文, 忽略开头的 utf-8 BOM '''
+  lines = []
+  started = False
+  with open(path, 'rb') as f:
+    for i, raw in enumerate(f):
+      line = text_decode(raw, encoding=encoding).rstrip('\n')
+      if i == 0:
+        line = line.lstrip('\ufeff')
+      if line.strip() == delimiter:
+        if started:
+          return '\n'.join(lines)
+        started = True
+      elif started:
+        lines.append(line)
+      elif line.strip():
+        break
+  raise ValueError('front matter not found in `{}`'.format(path))
+
+
 def text_save(path, data, encoding='utf-8'):
   with open(path, 'w', encoding=encoding) as f:
     f.write(data)
   return True
 
+def text_save_atomic(path, data, encoding='utf-8'):
+  ''' 先写入临时文件再替换, 写到一半中断时不会损坏原文件 '''
+  temp_path = path + '.tmp'
+  with open(temp_path, 'w', encoding=encoding) as f:
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(temp_path, path)
+  return True
+
 
 def sections(text, is_title=lambda line: line.startswith('#')):
   ''' 通过小节的标题和之后文字生成 {标题: 内容} 的 order dict
@@ -317,13 +473,152 @@ def truncate(text, limit=20, with_end=False, ellipsis='... ', encode=None):
 
 from pprint import pprint
 from datetime import datetime
-# import inspect
+import io
+import queue
+import atexit
+
+LOG_LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+LOG_LEVEL = 'info'                 # 低于此级别的日志不输出
+LOG_MAX_BYTES = 10 * 1024 * 1024   # .log 文件超过此大小时轮转为 .log.1
+LOG_BACKUP_COUNT = 3               # 保留 .log.1 ~ .log.3
+LOG_FLUSH_INTERVAL = 1.0           # 缓冲中的日志最多延迟几秒写入磁盘
+
+
+class LogFile:
+  ''' 日志文件, 第一次写入时打开, 之后保持打开并带缓冲
+      同一路径只有一个 LogFile, 由 LogFile.get(path) 获取 '''
+  _files = {}
+  _files_lock = threading.Lock()
+
+  @classmethod
+  def get(cls, path):
+    with cls._files_lock:
+      log_file = cls._files.get(path)
+      if log_file is None:
+        log_file = cls._files[path] = cls(path)
+      return log_file
+
+  @classmethod
+  def flush_all(cls):
+    for log_file in list(cls._files.values()):
+      log_file.flush()
+
+  @classmethod
+  def close_all(cls):
+    for log_file in list(cls._files.values()):
+      log_file.close()
+
+  def __init__(self, path):
+    self.path = path
+    self.lock = threading.Lock()
+    self.handle = None
+    self.size = 0
+    self.last_flush = 0
+
+  def write(self, text):
+    with self.lock:
+      if self.handle is None:
+        self.handle = open(self.path, 'a', encoding='utf-8', buffering=64 * 1024)
+        self.size = os.path.getsize(self.path)
+        self.last_flush = time.time()
+      self.handle.write(text)
+      self.size += len(text.encode('utf-8'))
+      if self.size >= LOG_MAX_BYTES:
+        self.rotate()
+      elif time.time() - self.last_flush >= LOG_FLUSH_INTERVAL:
+        self.handle.flush()
+        self.last_flush = time.time()
+
+  def rotate(self):
+    ''' xxx.log => xxx.log.1 => xxx.log.2 ..., 超出 LOG_BACKUP_COUNT 的删除 '''
+    self.handle.close()
+    self.handle = None
+    for i in range(LOG_BACKUP_COUNT - 1, 0, -1):
+      if os.path.exists(f'{self.path}.{i}'):
+        os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+    if LOG_BACKUP_COUNT > 0:
+      os.replace(self.path, self.path + '.1')
+    else:
+      os.remove(self.path)
+
+  def flush(self):
+    with self.lock:
+      if self.handle:
+        self.handle.flush()
+        self.last_flush = time.time()
+
+  def close(self):
+    with self.lock:
+      if self.handle:
+        self.handle.close()
+        self.handle = None
+
+
+class LogQueueWriter:
+  ''' 后台线程写入日志文件, 调用 log 的线程只负责入队 '''
+  def __init__(self):
+    self.queue = queue.Queue()
+    self.thread = threading.Thread(target=self.run, name='log-writer', daemon=True)
+    self.thread.start()
+
+  def put(self, log_file, text):
+    self.queue.put((log_file, text))
+
+  def run(self):
+    while True:
+      item = self.queue.get()
+      try:
+        if item is None:
+          return
+        log_file, text = item
+        log_file.write(text)
+      except OSError as e:
+        print(f'logger write error: {e}', file=sys.stderr)
+      finally:
+        self.queue.task_done()
+
+  def stop(self):
+    self.queue.put(None)
+    self.thread.join()
+
+
+_log_queue_writer = None
+
+def enable_log_queue(enabled=True):
+  ''' 开启后日志文件由后台线程写入, 适合抓取时大量输出日志的场合 '''
+  global _log_queue_writer
+  if enabled and _log_queue_writer is None:
+    _log_queue_writer = LogQueueWriter()
+  elif not enabled and _log_queue_writer is not None:
+    _log_queue_writer.stop()
+    _log_queue_writer = None
+
+def log_flush():
+  ''' 等待队列中的日志写完, 并将缓冲写入磁盘 '''
+  if _log_queue_writer:
+    _log_queue_writer.queue.join()
+  LogFile.flush_all()
+
+@atexit.register
+def _log_close():
+  enable_log_queue(False)
+  LogFile.close_all()
+
+
+
 class create_logger:
-  def __init__(self, file_path):
+  ''' log(a, b) 或 data | log, 同时输出到 stdout 和 file_path + '.log'
+      level 为默认级别, 调用时可用 log(..., level='debug') 指定, 低于 LOG_LEVEL 的不输出
+      log_error = create_logger(__file__ + '.error') 默认级别为 error '''
+  def __init__(self, file_path, level=None):
     self.filepath = file_path + '.log'
+    self.level = level or ('error' if file_path.endswith('.error') else 'info')
+
+  def is_enabled(self, level=None):
+    return LOG_LEVELS[level or self.level] >= LOG_LEVELS[LOG_LEVEL]
 
   def custom_print(self, data, prefix='', filepath=None, pretty=False):
-    out = open(filepath, 'a', encoding='utf-8') if filepath else sys.stdout
+    out = io.StringIO()
     if filepath:  # 在输出到文件时增加记录时间戳, 输出到 stdout 不记录时间戳
       prefix = '[' + datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f") + ']' + prefix
 
@@ -333,8 +628,13 @@ class create_logger:
       pprint(data, stream=out, width=80, compact=True, depth=2)
     else:
       print(data, file=out)
-    # if filepath:
-    #   out.close()
+
+    if not filepath:
+      sys.stdout.write(out.getvalue())
+    elif _log_queue_writer:
+      _log_queue_writer.put(LogFile.get(filepath), out.getvalue())
+    else:
+      LogFile.get(filepath).write(out.getvalue())
 
 
   def output(self, values, pretty=False):
@@ -353,13 +653,16 @@ class create_logger:
       self.custom_print(str(e), filepath=self.filepath, prefix='logger output error: ')
 
   def __ror__(self, *other):
-    self.output(other, pretty=True)
+    if self.is_enabled():
+      self.output(other, pretty=True)
     return other
 
-  def __call__(self, *other, pretty=False):
-    self.output(other, pretty=pretty)
+  def __call__(self, *other, pretty=False, level=None):
+    if self.is_enabled(level):
+      self.output(other, pretty=pretty)
 
 
+log_error = create_logger(__file__ + '.error')
 
 
 
@@ -623,17 +926,184 @@ def fix_video_link(mdtxt):
 
 
 # pygments lexers 非常不准
-from pygments.lexers import guess_lexer
 def guess_lang_pygments(code):
-  lang = guess_lexer(code).name.lower()  
+  from pygments.lexers import guess_lexer
+  lang = guess_lexer(code).name.lower()
   if lang == 'text only': lang = 'text'
   return lang
 
+# 关键词规则, 足够快, 常见代码片段可直接给出结果
+# 每条规则命中一次累加权重, 得分最高者需要达到 HEURISTIC_MIN_SCORE
+# 并且是第二名的 HEURISTIC_MARGIN 倍以上, 否则视为不确定, 交给 guesslang
+HEURISTIC_MIN_SCORE = 3
+HEURISTIC_MARGIN = 2
+# 个别语言单条规则不足以确定, 如只有一行 `❯ pip install ...` 时, 也可能是 python 教程中的安装步骤
+HEURISTIC_LANG_MIN_SCORE = {'shell': 4}
+HEURISTIC_RULES = [
+  ('python', 3, r'^\s*(async\s+)?def\s+\w+\s*\(.*\)\s*(->.*)?:'),
+  ('python', 3, r'^\s*class\s+\w+\s*(\(.*\))?\s*:\s*$'),
+  ('python', 3, r'^\s*(from\s+[\w.]+\s+)?import\s+[\w.]+(\s+as\s+\w+)?(\s*,\s*[\w.]+)*\s*$'),
+  ('python', 3, r'^\s*>>>\s'),
+  ('python', 2, r'^\s*(In|Out)\s*(\[\d*\])?\s*:\s'),
+  ('python', 2, r'^\s*(if|elif|else|for|while|with|try|except|finally)\b[^{};]*:\s*(#.*)?$'),
+  ('python', 2, r'[\[{(][^\]})]*\bfor\s+\w+\s+in\b'),
+  ('python', 2, r'\basync\s+for\b'),
+  ('python', 2, r'^\s*@[\w.]+(\(.*\))?\s*$'),
+  ('python', 1, r'\bself\.'),
+  ('python', 1, r'\b(None|True|False|elif|lambda)\b'),
+  ('python', 1, r'\b__\w+__\b'),
+  ('python', 1, r'^\s*(print\(|raise\s)'),
+  ('python', 1, r'^\s*[A-Za-z_][\w.]*\s*=\s*[^=;]*[^;\s{]\s*(#.*)?$'),
+  ('python', 1, r'\S\s+#\s'),
+  ('javascript', 3, r'\bfunction\b\s*\w*\s*\('),
+  ('javascript', 3, r'\bconsole\.\w+\(|\.prototype\.|\bmodule\.exports\b|\brequire\([\'"]'),
+  ('javascript', 2, r'^\s*(var|let|const)\s+\w+'),
+  ('javascript', 2, r'===|!==|=>'),
+  ('javascript', 1, r'^\s*//'),
+  ('javascript', 1, r'^\s*}\s*(else\b.*)?$'),
+  ('javascript', 1, r'\b(undefined|null|this)\b'),
+  ('javascript', 0.5, r';\s*$'),
+  ('shell', 3, r'^\s*[$❯%]\s+\S'),
+  ('shell', 2, r'^\s*(sudo|apt-get|apt|yum|brew|pip3?|npm|yarn|git|docker|curl|wget|export|chmod|mkdir|cd|ls)\s'),
+  ('shell', 1, r'^#!/bin/(ba)?sh'),
+  ('html', 3, r'^\s*<(!DOCTYPE|html|head|body|div|span|p|a|ul|ol|li|table|script|style|link|meta)\b[^>]*>'),
+  ('html', 1, r'</(html|head|body|div|span|p|a|ul|ol|li|table|script|style)>'),
+  ('sql', 3, r'^\s*(SELECT|INSERT\s+INTO|UPDATE|DELETE\s+FROM|CREATE\s+(TABLE|INDEX)|ALTER\s+TABLE|DROP\s+TABLE)\b'),
+  ('sql', 1, r'\b(FROM|WHERE|JOIN|GROUP\s+BY|ORDER\s+BY)\b'),
+  ('markdown', 3, r'!\[[^\]]*\]\([^)]*\)'),
+  ('markdown', 2, r'\[[^\]]+\]\(https?://[^)]*\)'),
+  ('markdown', 1, r'^\s*(\d+、|\d+\.\s|[-*+]\s)\s*\S'),
+  ('markdown', 1, r'\*\*[^*\n]+\*\*'),
+]
+# 只在其他语言的规则都没有命中时计分, 且单独不足以确定
+# `# 标题` 也可能是 python yaml shell 中的注释
+HEURISTIC_FALLBACK_RULES = [
+  ('markdown', 2, r'^#{1,6}\s+\S'),
+]
+_heuristic_rules = None
+_heuristic_fallback_rules = None
+
+def heuristic_rules():
+  ''' 第一次检测代码语言时才编译 HEURISTIC_RULES HEURISTIC_FALLBACK_RULES '''
+  global _heuristic_rules, _heuristic_fallback_rules
+  if _heuristic_rules is None:
+    _heuristic_fallback_rules = [(lang, weight, re.compile(pat, re.M))
+                                 for lang, weight, pat in HEURISTIC_FALLBACK_RULES]
+    _heuristic_rules = [(lang, weight, re.compile(pat, re.M))
+                        for lang, weight, pat in HEURISTIC_RULES]
+  return _heuristic_rules
+
+def guess_lang_heuristic(code):
+  ''' 按关键词规则猜测语言, 不确定时返回 None '''
+  text = code.strip()
+  if not text:
+    return None
+  if text[0] in '{[' and text[-1] in '}]':
+    try:
+      json.loads(text)
+      return 'json'
+    except ValueError:
+      pass
+  scores = {}
+  for lang, weight, pat in heuristic_rules():
+    hits = len(pat.findall(text))
+    if hits:
+      scores[lang] = scores.get(lang, 0) + weight * hits
+  for lang, weight, pat in _heuristic_fallback_rules:
+    if set(scores) - {lang}:  # 其他语言已有命中
+      continue
+    hits = len(pat.findall(text))
+    if hits:
+      scores[lang] = scores.get(lang, 0) + weight * hits
+  if not scores:
+    return None
+  ranked = sorted(scores.values(), reverse=True)
+  best = max(scores, key=scores.get)
+  second = ranked[1] if len(ranked) > 1 else 0
+  if ranked[0] < HEURISTIC_LANG_MIN_SCORE.get(best, HEURISTIC_MIN_SCORE):
+    return None
+  if ranked[0] < HEURISTIC_MARGIN * second:
+    return None
+  return best
+
+
 # guesslang 好一些
+# Guess() 每次创建都要加载 TensorFlow 模型, 进程内只创建一次
+_guesslang_detector = None
+_guesslang_lock = threading.Lock()
+GUESS_LANG_MEMO_SIZE = 2048
+_guess_lang_memo = OrderedDict()  # md5(code) => lang, LRU
+
+GUESS_LANG_HEURISTIC = True  # 先用关键词规则, 不确定的才交给模型
+
+def guesslang_detector():
+  ''' 进程内共用的 guesslang.Guess, 首次调用时才加载模型
+      未安装 guesslang (TensorFlow) 时返回 None '''
+  global _guesslang_detector
+  with _guesslang_lock:
+    if _guesslang_detector is None:
+      try:
+        from guesslang import Guess
+        _guesslang_detector = Guess()
+      except ImportError:
+        _guesslang_detector = False
+  return _guesslang_detector or None
+
+def _guesslang_names(detector, codes):
+  ''' 一次模型调用检测多段代码
+      guesslang 2.x 的 saved model 接受一批文本, 这里直接批量调用,
+      其他版本退回逐段 language_name() '''
+  model = getattr(detector, '_model', None)
+  extension_map = getattr(detector, '_extension_map', None)
+  if model is None or extension_map is None:
+    return [detector.language_name(code) for code in codes]
+  import tensorflow as tf
+  predicted = model.signatures['serving_default'](tf.constant(codes))
+  names = []
+  for scores, classes in zip(predicted['scores'].numpy(), predicted['classes'].numpy()):
+    probabilities = [float(value) for value in scores]
+    if not detector._is_reliable(probabilities):
+      names.append(None)
+    else:
+      best = max(range(len(probabilities)), key=lambda i: probabilities[i])
+      names.append(extension_map[classes[best].decode()])
+  return names
+
+def guess_langs(codes):
+  ''' 批量检测代码语言, 结果以 md5(code) 记忆
+      同一批中相同的代码只检测一次, 规则能确定的不再调用模型,
+      其余合并为一次模型调用, 没有 guesslang 时退回 pygments '''
+  keys = [md5(code) for code in codes]
+  missing = OrderedDict()
+  for key, code in zip(keys, codes):
+    if key not in _guess_lang_memo and code.strip():
+      missing[key] = code
+  if missing and GUESS_LANG_HEURISTIC:
+    for key, code in list(missing.items()):
+      lang = guess_lang_heuristic(code)
+      if lang:
+        _guess_lang_memo[key] = lang
+        del missing[key]
+  if missing:
+    detector = guesslang_detector()
+    if detector:
+      names = _guesslang_names(detector, list(missing.values()))
+    else:
+      names = [guess_lang_pygments(code) for code in missing.values()]
+    for key, name in zip(missing, names):
+      _guess_lang_memo[key] = name.lower() if name else 'text'
+  result = []
+  for key in keys:
+    lang = _guess_lang_memo.get(key, 'text')
+    if key in _guess_lang_memo:
+      _guess_lang_memo.move_to_end(key)
+    result.append(lang)
+  while len(_guess_lang_memo) > GUESS_LANG_MEMO_SIZE:
+    _guess_lang_memo.popitem(last=False)
+  return result
+
 def guess_lang(code):
-  from guesslang import Guess
-  name = Guess().language_name(code)
-  return name.lower()
+  return guess_langs([code])[0]
 
 def fix_code_lang(mdtxt):
   ''' 检测代码语言, 标记在 markdown 代码语法 ```<lang> 位置中 '''
@@ -658,10 +1128,10 @@ def fix_code_lang(mdtxt):
 
   if len(code_ends) < len(code_starts):  # 到结束时仍为代码
     code_ends.append(len(result))
-  for start, end in zip(code_starts, code_ends):
-    code_body = '\n'.join(result[start:end])
-    code_body = trim_leading_spaces(code_body)
-    lang = guess_lang(code_body)
+  code_bodies = [trim_leading_spaces('\n'.join(result[start:end])) 
+                 for start, end in zip(code_starts, code_ends)]
+  langs = guess_langs(code_bodies) if code_bodies else []  # 整页的代码块一起检测
+  for start, end, lang in zip(code_starts, code_ends, langs):
     trans_dict = {'javascript': 'js', 'markdown': 'md'}
     if lang in trans_dict: lang = trans_dict[lang]
     # end 表示不再是代码的行, end 之前可能有空行
@@ -720,6 +1190,7 @@ def trim_leading_spaces(text):
 
 
 def html2md(html_str):
+  import html2text
   h2t = html2text.HTML2Text()
   h2t.body_width = 0
   r = h2t.handle(html_str).strip()
@@ -0,0 +1,209 @@
+'''
+Watcher 抓取结果的 git 提交
+
+  ShellGit       执行 git add && git commit, 不指定 paths 时 git add . 扫描整个工作区
+  FastImportGit  保持一个 git fast-import 进程, 只提交实际写入的文件,
+                 flush 时 checkpoint 写入仓库, 再用 git update-index 同步这些文件的 index
+
+两者接口相同
+  commit(message, paths)   记录一次提交, paths 为本次写入 (或删除) 的文件, None 表示未知
+  flush()                  把累积的提交写入仓库
+  close()
+
+累积的提交数达到 batch_size, 或距第一个未写入的提交超过 batch_seconds 秒时自动 flush
+ShellGit 把累积的提交合并为一个, FastImportGit 仍逐个提交, 只是一起写入
+'''
+
+import os
+import time
+import subprocess
+
+import tools
+
+log = tools.create_logger(__file__)
+log_error = tools.create_logger(__file__ + '.error')
+
+
+EXCLUDE_PATHSPEC = [':(exclude,glob)**/*.yaml.pickle']  # 本地缓存, 如 .tasks.yaml 的解析快照, 不提交
+
+
+def git(repo_path, *args, input=None, check=True, timeout=15):
+  ''' 执行 git 命令, 返回 stdout, 失败时抛出 RuntimeError (同 tools.run_command) '''
+  result = subprocess.run(['git', *args], cwd=repo_path, input=input, timeout=timeout,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  if check and result.returncode != 0:
+    output = (result.stdout + result.stderr).decode('utf-8', 'replace')
+    raise RuntimeError(f'status: FAIL, {result.returncode}, git {args[0]} {output}')
+  return result.stdout.decode('utf-8', 'replace')
+
+
+def open_git(repo_path, backend='fast-import', batch_size=1, batch_seconds=0):
+  if backend == 'fast-import':
+    return FastImportGit(repo_path, batch_size, batch_seconds)
+  if backend == 'shell':
+    return ShellGit(repo_path, batch_size, batch_seconds)
+  raise ValueError(f'unknown git backend `{backend}`, should be fast-import or shell')
+
+
+
+class GitBackend:
+  def __init__(self, repo_path, batch_size=1, batch_seconds=0):
+    self.root = git(repo_path, 'rev-parse', '--show-toplevel').strip()
+    self.batch_size = batch_size
+    self.batch_seconds = batch_seconds
+    self.pending = []        # [(message, paths)]
+    self.pending_since = None
+
+  def relpaths(self, paths):
+    ''' 转为相对于仓库根目录, 以 / 分隔的路径, 去掉仓库以外的路径 '''
+    result = []
+    for path in paths:
+      path = os.path.relpath(os.path.abspath(path), self.root).replace(os.sep, '/')
+      if not path.startswith('../') and path not in result:
+        result.append(path)
+    return result
+
+  def changed_paths(self):
+    ''' 未提交的改动, 需要扫描整个工作区, 只在未给出 paths 时使用 '''
+    output = git(self.root, 'ls-files', '-z', '--modified', '--deleted', '--others', '--exclude-standard',
+                 '--', '.', *EXCLUDE_PATHSPEC)
+    return sorted(set(path for path in output.split('\0') if path))
+
+  def commit(self, message, paths=None):
+    if not self.pending:
+      self.pending_since = time.time()
+    self.pending.append((message, paths))
+    if self.should_flush():
+      self.flush()
+
+  def should_flush(self):
+    if len(self.pending) >= self.batch_size:
+      return True
+    return bool(self.batch_seconds) and time.time() - self.pending_since >= self.batch_seconds
+
+  def flush(self):
+    if self.pending:
+      commits, self.pending = self.pending, []
+      self.write(commits)
+
+  def write(self, commits): raise NotImplementedError
+
+  def close(self):
+    self.flush()
+
+
+
+class ShellGit(GitBackend):
+  ''' 累积的提交合并为一个 commit, 任一提交未给出 paths 时 git add . '''
+  def existing_paths(self, paths):
+    ''' 去掉既不在磁盘上也未被跟踪的路径 (如已合并删除的 .tasks.journal), 否则 git add 报 pathspec 错误 '''
+    missing = [path for path in paths if not os.path.lexists(os.path.join(self.root, path))]
+    if not missing:
+      return paths
+    tracked = set(git(self.root, 'ls-files', '-z', '--', *(':(literal)' + path for path in missing)).split('\0'))
+    return [path for path in paths if path not in missing or path in tracked]
+
+  def write(self, commits):
+    message = '\n'.join(message for message, _ in commits)
+    if any(paths is None for _, paths in commits):
+      git(self.root, 'add', '--', '.', *EXCLUDE_PATHSPEC)
+    else:
+      paths = self.existing_paths(self.relpaths(path for _, paths in commits for path in paths))
+      if not paths:
+        return
+      git(self.root, 'add', '-A', '--', *paths)
+    if subprocess.run(['git', 'diff', '--cached', '--quiet'], cwd=self.root).returncode == 0:
+      return  # 暂存区没有改动
+    git(self.root, 'commit', '-q', '-m', message)
+
+
+
+def quote_path(path):
+  ''' fast-import 中以 " 开头或含换行的路径需要加引号 '''
+  if path.startswith('"') or '\n' in path:
+    return '"' + path.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+  return path
+
+
+class FastImportGit(GitBackend):
+  ''' 向 git fast-import 的 stdin 写入提交, 文件内容直接从磁盘读取,
+      不经过 index, 也不扫描工作区
+      flush 后用 git update-index 只刷新提交过的文件, 之后 git status 与 git add 方式一致
+
+      如果仓库的当前分支在两次 flush 之间被外部改动 (比如手动提交),
+      下一个提交以 from 指定新的分支末端为 parent, 继续提交 '''
+  def __init__(self, repo_path, batch_size=1, batch_seconds=0):
+    super().__init__(repo_path, batch_size, batch_seconds)
+    self.ref = git(self.root, 'symbolic-ref', '-q', 'HEAD').strip()
+    ident = git(self.root, 'var', 'GIT_COMMITTER_IDENT').strip()
+    self.committer = ident.rsplit(' ', 2)[0]  # 去掉末尾的时间戳和时区
+    self.process = None
+    self.tip = None   # fast-import 最后一次写入的 commit
+    self.mark = 0
+
+  def head(self):
+    return git(self.root, 'rev-parse', '-q', '--verify', self.ref, check=False).strip() or None
+
+  def start(self):
+    self.process = subprocess.Popen(['git', 'fast-import', '--quiet', '--done'], cwd=self.root,
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    self.tip = None
+
+  def stop(self):
+    if self.process:
+      self.process.stdin.write(b'done\n')
+      self.process.stdin.close()
+      self.process.wait(timeout=60)
+      self.process = None
+
+  def send(self, *parts):
+    for part in parts:
+      self.process.stdin.write(part.encode('utf-8') if isinstance(part, str) else part)
+
+  def write(self, commits):
+    if self.process is None:
+      self.start()
+    head = self.head()
+    from_tip = head if head != self.tip else None  # 新进程的第一个提交, 或分支被外部改动
+
+    touched = []
+    for message, paths in commits:
+      paths = self.relpaths(paths) if paths is not None else self.changed_paths()
+      self.mark += 1
+      message = message.encode('utf-8')
+      self.send(f'commit {self.ref}\nmark :{self.mark}\n',
+                f'committer {self.committer} {int(time.time())} {time.strftime("%z")}\n',
+                f'data {len(message)}\n', message, b'\n')
+      if from_tip:
+        self.send(f'from {from_tip}\n')
+        from_tip = None
+      for path in paths:
+        full_path = os.path.join(self.root, path)
+        if os.path.isfile(full_path):
+          with open(full_path, 'rb') as f:
+            content = f.read()
+          self.send(f'M 100644 inline {quote_path(path)}\n', f'data {len(content)}\n', content, b'\n')
+        else:
+          self.send(f'D {quote_path(path)}\n')
+        if path not in touched:
+          touched.append(path)
+      self.send(b'\n')
+
+    self.send('checkpoint\n', f'get-mark :{self.mark}\n')
+    try:
+      self.process.stdin.flush()
+      tip = self.process.stdout.readline().decode().strip()
+    except BrokenPipeError:
+      tip = ''
+    if not tip:
+      returncode = self.process.wait(timeout=60)
+      self.process = None
+      raise RuntimeError(f'status: FAIL, git fast-import exited with {returncode}')
+    self.tip = tip
+    if touched:
+      git(self.root, 'update-index', '--add', '--remove', '-z', '--stdin',
+          input='\0'.join(touched).encode('utf-8'))
+
+  def close(self):
+    self.flush()
+    self.stop()
@@ -16,6 +16,9 @@ log = tools.create_logger(__file__)
 log_error = tools.create_logger(__file__ + '.error')
 
 from task import Task
+from task_store import YamlTaskStore
+from task_store import SqliteTaskStore
+import vcs
 from fetcher import UrlType
 from fetcher import parse_type
 from fetcher import purge_url
@@ -31,11 +34,12 @@ from fetcher import Fetcher
 from fetcher import FetcherOption
 from page import Page
 # from werkzeug.contrib.atom import AtomFeed
-from feedgen.feed import FeedGenerator
 
 import pydantic
 
 
+ADD_TASKS_FLUSH_SIZE = 200  # add_tasks 每添加这么多新 task 调用一次 tasks.flush()
+
 
 class TaskEnvOption(pydantic.BaseModel):
   '''收集 .config.yaml 里和 task 环境有关的配置'''
@@ -50,10 +54,19 @@ class WatcherOption(pydantic.BaseModel):
   '''收集 .config.yaml 里和 watcher 自身有关的配置'''
   git_commit_path = ''
   git_commit_batch = 3
+  git_backend = 'fast-import'  # fast-import 只提交写入的文件, shell 为 git add . && git commit
+  git_flush_count = 1          # 累积多少个提交后写入 git 仓库
+  git_flush_seconds = 0        # 第一个未写入的提交超过多少秒后写入, 0 表示不按时间
   rss_title : str = None
   rss_link : str = 'https://xxxx'
   rss_output_path = 'feed.xml'
   epub_output_path : str = None
+  page_workers = 1          # 并发抓取 page 的线程数, 1 为逐个抓取
+  host_rate = 0.5           # 未单独指定的 host, 每秒最多发起的 page 抓取数
+  host_rates = {'zhihu.com': 0.5, 'mp.weixin.qq.com': 0.2, 'v2ex.com': 0.3}
+  attachment_workers = 4      # 并发下载附件 (图片) 的连接数, save_attachments 为 true 时使用
+  journal_compact_size = 200  # .tasks.journal 累积多少条记录后合并回 .tasks.yaml
+  task_store = 'yaml'         # task 存储方式, yaml 或 sqlite (.tasks.sqlite, 适合大量 task)
 
 
 
@@ -63,6 +76,8 @@ class Watcher:
 
   .config.yaml 只读, 指定全局设置, 和 lister
   .tasks.yaml 系统自动覆写, 记录已经抓取过的页面
+  .tasks.journal 在两次覆写 .tasks.yaml 之间, 逐条追加 task 的变化
+  .tasks.sqlite 设置 task_store: sqlite 时代替以上两个文件, 见 task_store.py
 
   当创建 Watcher() 时:
     加载该 folder 下的 .tasks.yaml, 里面是已记录的 lister_tasks 和 page_tasks
@@ -93,23 +108,20 @@ class Watcher:
     self.config = WatcherOption(**config)  # 过滤出和 watcher 自身有关的设置项
     self.task_env_option = TaskEnvOption(**config).dict()
     self.fetcher_option = FetcherOption(**config).dict()
-    self.tasks = {}
-    # load_local_tasks task_dict 预备以 url 作为 key
-    # 1 从 task.json 中载入已有 task
+    # load_local_tasks self.tasks 以 url 作为 key
+    # 1 从 task store 中载入已有 task
     # 2 对于 page task, 加入该 watcher 的 env_option
     # 3 对于 lister task, 加入该 watcher 的 env_option, 以及 listers 里特定的属性
-    if os.path.exists(path + '/.tasks.yaml'):
-      local_tasks_json = tools.yaml_load(os.path.join(self.watcher_path, '.tasks.yaml')) or []
-    else:
-      local_tasks_json = []
-    for item in local_tasks_json:
-      task = Task.create(item, env_option=self.task_env_option, fetcher_option=self.fetcher_option)
-      self.tasks[item['url']] = task
+    self.tasks = self.open_task_store()
+    self._git = None
+    self._attachment_executor = None
+    self._downloader = None
+    self.attachment_jobs = []
     self.lister_urls = config.get('urls', [])
     for item in self.lister_urls:
       if item['url'] not in self.tasks:  # 从 config.yaml 中的 urls 里新增 task
         task = Task.create(item, env_option=self.task_env_option, fetcher_option=self.fetcher_option)
-        self.tasks[item['url']] = task
+        self.tasks.add(task)
 
     # 更新 listers 中的 task, 用户可能修改了某些 lister 的 option
     for item in self.lister_urls:
@@ -117,6 +129,7 @@ class Watcher:
       custom_option = item.get('option')  # lister 自定义设置
       if custom_option: 
         self.tasks[url].patch(custom_option)
+        self.tasks.save(self.tasks[url], 'patch')
 
     # TODO 更新 page_option 中的 task, 用户可能修改了单独某个 page 的 option
 
@@ -128,6 +141,10 @@ class Watcher:
     config = '''
 git_commit_path: ''       # 使用 git 提交记录, 可选上一层目录 '..', 当前目录 '.', 或默认 none
 git_commit_batch: 3       # 每 3 个页面执行一个提交
+git_backend: fast-import  # fast-import 只提交写入的文件, shell 为 git add . && git commit
+git_flush_count: 1        # 累积多少个提交后写入 git 仓库, 配合 git_flush_seconds 可减少写入次数
+page_workers: 1           # 并发抓取 page 的线程数, 大于 1 时按 host_rates 对每个网站限速
+task_store: yaml          # task 存储方式, yaml 或 sqlite, 大量 task 时 sqlite 启动更快
 
 # Task Option
 lister_max_cycle: 30days  # 对 Watcher 目录里的所有 lister 起效, 会被具体设置覆盖
@@ -138,6 +155,7 @@ page_min_cycle: 45days
 
 save_attachments: false
 limit: 300
+stop_after_known: 0       # lister 连续遇到 n 个已记录的页面就停止翻页, 0 表示每次都翻到 limit
 min_voteup: 0
 min_thanks: 0
 text_include: None
@@ -179,7 +197,17 @@ urls:
 
   @classmethod
   def is_watcher(cls, path):
-    return os.path.exists(path) and os.path.exists(path + '/.config.yaml') and os.path.exists(path + '/.tasks.yaml')
+    has_tasks = os.path.exists(path + '/.tasks.yaml') or os.path.exists(path + '/.tasks.sqlite')
+    return os.path.exists(path) and os.path.exists(path + '/.config.yaml') and has_tasks
+
+  def open_task_store(self):
+    ''' 按 task_store 设置打开 task 存储 '''
+    if self.config.task_store == 'yaml':
+      return YamlTaskStore(self.watcher_path, self.task_env_option, self.fetcher_option,
+                           compact_size=self.config.journal_compact_size)
+    if self.config.task_store == 'sqlite':
+      return SqliteTaskStore(self.watcher_path, self.task_env_option, self.fetcher_option)
+    raise ValueError(f'unknown task_store `{self.config.task_store}`, should be yaml or sqlite')
 
   def __str__(self):
     s = '''<Watcher #{}> from `{}`, {} tasks {} pages'''
@@ -191,6 +219,15 @@ urls:
     if path: return os.path.join(self.watcher_path, path)
     else: return None
 
+  @property
+  def git(self):
+    ''' git 提交, 第一次用到时打开 '''
+    if self._git is None:
+      self._git = vcs.open_git(self.git_project_path, backend=self.config.git_backend,
+                               batch_size=self.config.git_flush_count,
+                               batch_seconds=self.config.git_flush_seconds)
+    return self._git
+
   @property
   def pages(self):
     all_pages = tools.all_files(self.watcher_path, patterns='*.md', single_level=True)
@@ -201,7 +238,7 @@ urls:
     return len(self.pages)
 
   @property
-  def tasks_count(self): return len(self.tasks.keys())
+  def tasks_count(self): return len(self.tasks)
 
   def add_task(self, task_desc):
     ''' 添加一个 Task, 以 url 判断是否为已存在的 Task
@@ -218,7 +255,7 @@ urls:
       else: return "seen tasks, not on fetch time"
     else:
       new_task = Task.create(task_desc, self.task_env_option)
-      self.tasks[url] = new_task
+      self.tasks.save(new_task, 'add')
       return "new tasks"
 
   def add_tasks(self, tasks_desc):
@@ -230,49 +267,30 @@ urls:
           prepare    任务已到抓取时间, 等待抓取
           wait       任务不到抓取时间
     '''
-    results = []
-    for item in tasks_desc:
-      add_task_result = self.add_task(item)
-      results.append(add_task_result)
-    log(f'watcher add {len(tasks_desc)} tasks: {dict(Counter(results))}')
-    return Counter(results)
+    results = Counter()
+    for item in tasks_desc:  # 可以是 lister 的生成器, 边探测边添加
+      result = self.add_task(item)
+      results[result] += 1
+      if result == 'new tasks' and results[result] % ADD_TASKS_FLUSH_SIZE == 0:
+        self.tasks.flush()  # 长列表中途退出时, 已添加的 task 不丢失
+    log(f'watcher add {sum(results.values())} tasks: {dict(results)}')
+    return results
 
 
   def save_tasks_yaml(self):
-    ''' 存盘 .tasks.yaml
-        按照添加顺序存放
-    '''
-    tasks = sorted(self.tasks.values(), key=lambda t: t.task_add_time)
-    temp = ''
-    for task in tasks:
-      temp += task.to_yaml_text()
-      temp += '\n'
-    tools.text_save(path=self.watcher_path + '/.tasks.yaml', data=temp)
+    ''' 将全部 task 存盘, 默认的 yaml 存储会覆写 .tasks.yaml 并清空 .tasks.journal '''
+    self.tasks.close()
 
 
   def get_lister_tasks(self):
-    lister_tasks_queue = []
-    for task in self.tasks.values():
-      if task.is_lister_type:
-        lister_tasks_queue.append(task)
-    return lister_tasks_queue
+    return self.tasks.listers()
 
 
   def get_lister_tasks_should_fetch(self):
-    lister_tasks_queue = []
-    for task in self.tasks.values():
-      if task.should_fetch and task.is_lister_type:
-        lister_tasks_queue.append(task)
-    lister_tasks_queue.sort(key=lambda x: -x.priority)
-    return lister_tasks_queue
+    return self.tasks.due('lister')
 
   def get_page_tasks_should_fetch(self):
-    page_tasks_queue = []
-    for task in self.tasks.values():
-      if task.should_fetch and task.is_page_type:
-        page_tasks_queue.append(task)
-    page_tasks_queue.sort(key=lambda x: -x.priority)
-    return page_tasks_queue
+    return self.tasks.due('page')
 
 
 
@@ -285,55 +303,168 @@ urls:
     log(f'watching listers... should fetch {len(lister_tasks_queue)} lister tasks\n')
     for i, task in enumerate(lister_tasks_queue, 1):
       # log('Watcher.watch lister task.run: {}'.format(task))
-      new_tasks_json = task.run()
-      counter = self.add_tasks(new_tasks_json)
+      counter = self.add_tasks(task.iter_run(known_urls=set(self.tasks)))
       is_modified = counter["new tasks"] > 0   # is_modified = add_tasks 时出现了新的 task
       task.schedule(is_modified=is_modified) 
+      self.tasks.save(task, 'schedule')
       log(f'detect lister done ({i}/{len(lister_tasks_queue)}): \n{task}\n\n')
-      self.save_tasks_yaml()
-      yield {'commit_log': f'check lister {i}/{len(lister_tasks_queue)}, {task.brief_tip}'}
+      self.tasks.flush()
+      yield {'commit_log': f'check lister {i}/{len(lister_tasks_queue)}, {task.brief_tip}',
+             'paths': self.tasks.paths}
       # self.remember(commit_log='checked lister {}'.format(i), watcher_path=self.watcher_path)
       tools.time_random_sleep(5, 10)
 
     page_tasks_queue = self.get_page_tasks_should_fetch()
     log(f'watching pages... should fetch {len(page_tasks_queue)} page tasks\n')
-    for tasks_batch in tools.windows(enumerate(page_tasks_queue, 1), self.config.git_commit_batch, yield_tail=True):
+    fetched = enumerate(self.fetch_page_tasks(page_tasks_queue), 1)
+    for tasks_batch in tools.windows(fetched, self.config.git_commit_batch, yield_tail=True):
       # log('Watcher.watch page task: {}'.format(task))
-      for i, task in tasks_batch:
-        page_json = task.run()
+      # 抓取可能在线程池中并发进行, 但存盘和 schedule 总是在这里按顺序执行
+      written = []
+      for i, (task, page_json) in tasks_batch:
         page_json['metadata']['folder'] = self.watcher_path
         page_json['metadata']['version'] = task.version + 1
         page = Page.create(page_json)
-        is_modified = page.is_changed(page.last_page_version)
-        page.write()
+        is_modified = self.page_is_modified(task, page)
+        save_path = page.write()
+        written.append(save_path)
+        if task.fetcher_option.save_attachments:
+          self.save_attachments(save_path, task.url)
         task.schedule(is_modified=is_modified)  # is_modified = 跟上次存储的页面有区别
+        self.tasks.save(task, 'schedule')
         next_watch_time = tools.time_to_humanize(task.next_watch_time)
         log(f'  -> {page.filename} is_modified={is_modified}, next_watch_time={next_watch_time}')
         log(f'page task done ({i}/{len(page_tasks_queue)}): \n{task}\n\n')
 
-      self.save_tasks_yaml()
-      commit_tasks_log = ','.join(task.brief_tip for i, task in tasks_batch)
-      yield {'commit_log': f'save {len(tasks_batch)} pages, {commit_tasks_log}'}
+      self.tasks.flush()
+      commit_tasks_log = ','.join(task.brief_tip for i, (task, _) in tasks_batch)
+      yield {'commit_log': f'save {len(tasks_batch)} pages, {commit_tasks_log}',
+             'paths': written + self.collect_attachments() + self.tasks.paths}
       # self.remember(commit_log='save pages {}'.format(i))
 
-      tools.time_random_sleep(3, 6)
+      if self.config.page_workers <= 1:  # 并发模式由 host 令牌桶限速, 不再整体休眠
+        tools.time_random_sleep(3, 6)
+
+    # 每轮结束时把 journal 合并回 .tasks.yaml, 等待尚未完成的附件
+    self.save_tasks_yaml()
+    attachment_paths = self.collect_attachments(wait=True)
+    self.close_attachments()
+    yield {'commit_log': f'save tasks, {len(lister_tasks_queue)} listers, {len(page_tasks_queue)} pages',
+           'paths': attachment_paths + self.tasks.paths}
+
+
+  def save_attachments(self, save_path, url):
+    ''' 在后台下载页面中的图片并改写为本地链接, 不阻塞后续页面的处理
+        结果由 collect_attachments 收集, 随下一次 git 提交
+        目前只处理知乎页面 (zhimg.com 图片), 其他类型的页面跳过, 也不载入 crawler.zhihu '''
+    if parse_type(url) not in (UrlType.ZhihuColumnPage, UrlType.ZhihuAnswerPage):
+      return None
+    if self._attachment_executor is None:
+      from concurrent.futures import ThreadPoolExecutor
+      from crawler.common import AttachmentDownloader, attachment_store
+      self._downloader = AttachmentDownloader(workers=self.config.attachment_workers, store=attachment_store)
+      self._attachment_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='page-attachment')
+    from fetcher import zhihu
+    job = self._attachment_executor.submit(zhihu.fetch_images_for_markdown, save_path, self._downloader)
+    self.attachment_jobs.append(job)
+    return job
+
+  def collect_attachments(self, wait=False):
+    ''' 返回已完成的附件任务写入的文件, wait=True 时等待全部完成 '''
+    paths, pending = [], []
+    for job in self.attachment_jobs:
+      if not (wait or job.done()):
+        pending.append(job)
+        continue
+      try:
+        paths.extend(job.result())
+      except Exception as e:
+        log_error(f'save attachments failed: {e}')
+    self.attachment_jobs = pending
+    return paths
+
+  def close_attachments(self):
+    if self._attachment_executor:
+      self._attachment_executor.shutdown(wait=True)
+      self._downloader.shutdown(wait=True)
+      self._attachment_executor = self._downloader = None
+      self.attachment_jobs = []
+
+
+  def page_is_modified(self, task, page):
+    ''' task 记录了上次的 content_hash 时直接比对 hash, 不读取上次的页面
+        旧的 task 没有 content_hash, 退回与磁盘上的页面比对
+        比对后把新的 hash 记到 task 中 '''
+    hashes = page.content_hashes
+    if task.content_hash and hashes:
+      changed = page.changed_parts(task.content_hash)
+      if changed:
+        log(f'  -> {page.filename} changed: {", ".join(changed)}')
+      is_modified = bool(changed)
+    else:
+      is_modified = page.is_changed(page.last_page_version)
+    if hashes:
+      task.content_hash = hashes
+    return is_modified
+
+
+  def fetch_page_tasks(self, page_tasks_queue):
+    ''' 抓取 page tasks, 按 page_tasks_queue 的顺序 yield (task, page_json)
+        page_workers <= 1 时逐个抓取
+        page_workers > 1 时使用线程池并发抓取, 每个 host 以令牌桶限速,
+        同时在途的任务不超过 page_workers * 2 个
+    '''
+    workers = self.config.page_workers
+    if workers <= 1:
+      for task in page_tasks_queue:
+        yield task, task.run()
+      return
+
+    limiter = tools.HostRateLimiter(rates=self.config.host_rates, default_rate=self.config.host_rate)
+    def run_task(task):
+      limiter.acquire(task.url)
+      return task.run()
+
+    from concurrent.futures import ThreadPoolExecutor
+    from collections import deque
+    pending = deque()
+    tasks_iter = iter(page_tasks_queue)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+      for task in tasks_iter:
+        pending.append((task, executor.submit(run_task, task)))
+        if len(pending) >= workers * 2:
+          task, future = pending.popleft()
+          yield task, future.result()
+      while pending:
+        task, future = pending.popleft()
+        yield task, future.result()
+    finally:
+      executor.shutdown(wait=True, cancel_futures=True)
 
 
   def watch_once(self):
     log(f'\n  ↓ start watch_once for\n  {self}')
-    for commit_log in self.run():
-      self.remember(commit_log)
+    try:
+      for commit_log in self.run():
+        self.remember(commit_log)
+    finally:
+      self.close_attachments()
+      if self._git:
+        self._git.close()
     log(f'\n  ↑ start watch_once done\n')
 
 
   def remember(self, commit_log, verbose=False):
-    ''' 如果使用 git, 将 watcher 抓取到的内容存储到 project git 仓库 '''
+    ''' 如果使用 git, 将 watcher 抓取到的内容存储到 project git 仓库
+        commit_log 为 dict 时, paths 是本次写入的文件, 只提交这些文件
+        未给出 paths 时提交工作区的全部改动 '''
+    paths = None
     if isinstance(commit_log, dict):
+      paths = commit_log.get('paths')
       commit_log = commit_log.get('commit_log', 'missing commit log')
     if self.git_project_path:
-      cmd = f'cd "{self.git_project_path}" && git add . && git commit -m "{commit_log}"'
-      # log(cmd)
-      tools.run_command(cmd, verbose=verbose, timeout=15)
+      self.git.commit(commit_log, paths)
       log(f'git committed: "{commit_log}"\n')
     else:
       log(commit_log)